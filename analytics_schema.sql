@@ -11,6 +11,11 @@ CREATE TABLE IF NOT EXISTS auth_events (
 );
 
 -- Unique constraint for one connection per athlete per day
+-- (duplicates written before the index existed would make it fail)
+DELETE FROM auth_events a USING auth_events b
+WHERE a.athlete_id = b.athlete_id AND DATE(a.created_at) = DATE(b.created_at) AND a.id > b.id
+  AND NOT EXISTS (SELECT 1 FROM pg_indexes WHERE indexname = 'idx_auth_events_unique_day');
+
 CREATE UNIQUE INDEX IF NOT EXISTS idx_auth_events_unique_day 
 ON auth_events(athlete_id, DATE(created_at));
 
@@ -55,38 +60,98 @@ CREATE INDEX IF NOT EXISTS idx_visits_club_id ON visits(club_id);
 CREATE INDEX IF NOT EXISTS idx_visits_created_at ON visits(created_at);
 CREATE INDEX IF NOT EXISTS idx_visits_date ON visits(DATE(created_at));
 
--- Views for statistics
-CREATE OR REPLACE VIEW stats_unique_connections AS
+-- Rollup tables (maintained by AnalyticsRollup in server.py).
+-- The stats API and the views below read only these, never the raw events.
+CREATE TABLE IF NOT EXISTS analytics_daily_rollup (
+    day DATE NOT NULL,
+    club_id VARCHAR(50) NOT NULL DEFAULT '',
+    page_path VARCHAR(255) NOT NULL DEFAULT '',
+    visits BIGINT NOT NULL DEFAULT 0,
+    unique_sessions BIGINT NOT NULL DEFAULT 0,
+    downloads BIGINT NOT NULL DEFAULT 0,
+    download_users BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, club_id, page_path)
+);
+
+CREATE TABLE IF NOT EXISTS analytics_daily_totals (
+    day DATE PRIMARY KEY,
+    visits BIGINT NOT NULL DEFAULT 0,
+    unique_sessions BIGINT NOT NULL DEFAULT 0,
+    downloads BIGINT NOT NULL DEFAULT 0,
+    connections BIGINT NOT NULL DEFAULT 0,
+    new_connections BIGINT NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS analytics_monthly_totals (
+    month TIMESTAMP PRIMARY KEY,
+    visits BIGINT NOT NULL DEFAULT 0,
+    unique_sessions BIGINT NOT NULL DEFAULT 0
+);
+
+-- HyperLogLog sketches per metric x day x club (server.py HyperLogLog, p=12:
+-- standard error 1.6%, ~95% of range estimates within +-3.3%).
+-- metric: visitors (session_id), downloaders / connections (athlete_id)
+CREATE TABLE IF NOT EXISTS analytics_hll (
+    metric VARCHAR(20) NOT NULL,
+    day DATE NOT NULL,
+    club_id VARCHAR(50) NOT NULL DEFAULT '',
+    sketch BYTEA NOT NULL,
+    PRIMARY KEY (metric, day, club_id)
+);
+
+-- Range / per-club drill-down of the stats API (python3 server.py --check-query-plans)
+CREATE INDEX IF NOT EXISTS idx_daily_rollup_club_day ON analytics_daily_rollup(club_id, day);
+CREATE INDEX IF NOT EXISTS idx_hll_metric_club_day ON analytics_hll(metric, club_id, day);
+
+-- Membership tables for all-time unique counts
+CREATE TABLE IF NOT EXISTS analytics_connected_athletes (
+    athlete_id BIGINT PRIMARY KEY,
+    first_day DATE NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_connected_athletes_first_day ON analytics_connected_athletes(first_day);
+
+CREATE TABLE IF NOT EXISTS analytics_club_downloaders (
+    club_id VARCHAR(50) NOT NULL,
+    athlete_id BIGINT NOT NULL,
+    PRIMARY KEY (club_id, athlete_id)
+);
+
+-- Views for statistics (read from the rollups)
+DROP VIEW IF EXISTS stats_unique_connections;
+CREATE VIEW stats_unique_connections AS
 SELECT 
-    DATE(created_at) as date,
-    COUNT(DISTINCT athlete_id) as unique_connections
-FROM auth_events
-GROUP BY DATE(created_at)
+    day as date,
+    connections as unique_connections
+FROM analytics_daily_totals
+WHERE connections > 0
 ORDER BY date DESC;
 
-CREATE OR REPLACE VIEW stats_downloads_by_club AS
+DROP VIEW IF EXISTS stats_downloads_by_club;
+CREATE VIEW stats_downloads_by_club AS
 SELECT 
-    club_id,
-    COUNT(*) as total_downloads,
-    COUNT(DISTINCT athlete_id) as unique_users
-FROM downloads
-GROUP BY club_id;
+    NULLIF(r.club_id, '') as club_id,
+    SUM(r.downloads)::bigint as total_downloads,
+    (SELECT COUNT(*) FROM analytics_club_downloaders d WHERE d.club_id = r.club_id) as unique_users
+FROM analytics_daily_rollup r
+WHERE r.downloads > 0
+GROUP BY r.club_id;
 
-CREATE OR REPLACE VIEW stats_visits_by_day AS
+DROP VIEW IF EXISTS stats_visits_by_day;
+CREATE VIEW stats_visits_by_day AS
 SELECT 
-    DATE(created_at) as date,
-    COUNT(*) as total_visits,
-    COUNT(DISTINCT session_id) as unique_visits
-FROM visits
-GROUP BY DATE(created_at)
+    day as date,
+    visits as total_visits,
+    unique_sessions as unique_visits
+FROM analytics_daily_totals
+WHERE visits > 0
 ORDER BY date DESC;
 
-CREATE OR REPLACE VIEW stats_visits_by_month AS
+DROP VIEW IF EXISTS stats_visits_by_month;
+CREATE VIEW stats_visits_by_month AS
 SELECT 
-    DATE_TRUNC('month', created_at) as month,
-    COUNT(*) as total_visits,
-    COUNT(DISTINCT session_id) as unique_visits
-FROM visits
-GROUP BY DATE_TRUNC('month', created_at)
+    month,
+    visits as total_visits,
+    unique_sessions as unique_visits
+FROM analytics_monthly_totals
 ORDER BY month DESC;
-
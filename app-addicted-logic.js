@@ -55,22 +55,49 @@ class SznApp {
         return null;
     }
     
-    async trackAnalytics(eventType, data = {}) {
+    trackAnalytics(eventType, data = {}) {
+        // События копятся и отправляются пачкой (см. flushAnalytics)
+        this.analyticsQueue = this.analyticsQueue || [];
+        this.analyticsQueue.push({
+            type: eventType,
+            session_id: this.sessionId,
+            athlete_id: this.athleteId,
+            club_id: this.currentClub,
+            ...data
+        });
+        
+        if (!this.analyticsTimer) {
+            this.analyticsTimer = setTimeout(() => this.flushAnalytics(), 2000);
+        }
+    }
+    
+    async flushAnalytics(useBeacon = false) {
+        clearTimeout(this.analyticsTimer);
+        this.analyticsTimer = null;
+        
+        const events = this.analyticsQueue || [];
+        if (!events.length) {
+            return;
+        }
+        this.analyticsQueue = [];
+        const body = JSON.stringify(events);
+        
         try {
-            const payload = {
-                type: eventType,
-                session_id: this.sessionId,
-                athlete_id: this.athleteId,
-                club_id: this.currentClub,
-                ...data
-            };
+            // sendBeacon survives page unload; fall back to fetch otherwise
+            if (useBeacon && navigator.sendBeacon) {
+                const blob = new Blob([body], { type: 'application/json' });
+                if (navigator.sendBeacon('/route/api/analytics/event', blob)) {
+                    return;
+                }
+            }
             
             const response = await fetch('/route/api/analytics/event', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json'
                 },
-                body: JSON.stringify(payload)
+                body: body,
+                keepalive: true
             });
             
             if (!response.ok) {
@@ -97,6 +124,14 @@ class SznApp {
             page_path: window.location.pathname
         });
         
+        // Отправляем накопленные события при уходе со страницы
+        document.addEventListener('visibilitychange', () => {
+            if (document.visibilityState === 'hidden') {
+                this.flushAnalytics(true);
+            }
+        });
+        window.addEventListener('pagehide', () => this.flushAnalytics(true));
+        
         setTimeout(() => {
             console.log('✅ SznApp with addicted Logic initialized');
             // Синхронизируем кнопки метрик после инициализации
@@ -204,7 +239,8 @@ class SznApp {
 
     async fetchStravaData(endpoint) {
         try {
-            const apiUrl = `https://www.strava.com/api/v3${endpoint}`;
+            // Запросы идут через серверный прокси (кэш ответов и учёт лимитов Strava)
+            const apiUrl = `/api/strava/v3${endpoint}`;
             const response = await fetch(apiUrl, {
                 headers: {
                     'Authorization': `Bearer ${this.stravaToken}`,
@@ -13,6 +13,7 @@ CREATE TABLE IF NOT EXISTS athletes (
     country VARCHAR(255),
     profile_picture TEXT,
     access_token_hash VARCHAR(64),
+    access_token_expires_at TIMESTAMP,
     strava_created_at TIMESTAMP,
     strava_updated_at TIMESTAMP,
     connected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -46,10 +47,50 @@ CREATE TABLE IF NOT EXISTS user_sessions (
     FOREIGN KEY (athlete_id) REFERENCES athletes(athlete_id) ON DELETE CASCADE
 );
 
+-- Table: activities (сводка и трек тренировок из Strava, заполняется ActivitySync)
+CREATE TABLE IF NOT EXISTS activities (
+    activity_id BIGINT PRIMARY KEY,
+    athlete_id BIGINT NOT NULL,
+    name TEXT,
+    sport_type VARCHAR(64),
+    start_date TIMESTAMP NOT NULL,  -- UTC
+    distance DOUBLE PRECISION,
+    moving_time INTEGER,
+    elapsed_time INTEGER,
+    total_elevation_gain DOUBLE PRECISION,
+    average_speed DOUBLE PRECISION,
+    summary_polyline TEXT,
+    polyline TEXT,  -- полный трек, есть только после загрузки деталей
+    summary JSONB NOT NULL,  -- объект из /athlete/activities как есть
+    detail JSONB,  -- объект из /activities/{id}
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Table: activity_sync_state (курсоры синхронизации активностей по атлетам)
+CREATE TABLE IF NOT EXISTS activity_sync_state (
+    athlete_id BIGINT PRIMARY KEY,
+    newest_start_date TIMESTAMP,  -- курсор after= для инкрементальной синхронизации
+    oldest_start_date TIMESTAMP,  -- курсор before= для догрузки истории
+    backfill_complete BOOLEAN DEFAULT FALSE,
+    last_synced_at TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
 -- Indexes for better performance
 CREATE INDEX IF NOT EXISTS idx_athletes_athlete_id ON athletes(athlete_id);
 CREATE INDEX IF NOT EXISTS idx_athletes_email ON athletes(email) WHERE email IS NOT NULL;
 CREATE INDEX IF NOT EXISTS idx_athletes_active ON athletes(is_active);
+-- Keyset pagination of the admin users listing: (connected_at, athlete_id) cursor, optional country/city filter
+CREATE INDEX IF NOT EXISTS idx_athletes_active_connected ON athletes(connected_at DESC, athlete_id DESC) WHERE is_active = TRUE;
+CREATE INDEX IF NOT EXISTS idx_athletes_country_connected ON athletes(country, connected_at DESC, athlete_id DESC) WHERE is_active = TRUE;
+CREATE INDEX IF NOT EXISTS idx_athletes_city_connected ON athletes(city, connected_at DESC, athlete_id DESC) WHERE is_active = TRUE;
+-- Token -> athlete lookup for proxied Strava requests
+CREATE INDEX IF NOT EXISTS idx_athletes_token_hash ON athletes(access_token_hash);
+-- Существующие базы: срок действия токена (expires_at из OAuth-обмена, UTC)
+ALTER TABLE athletes ADD COLUMN IF NOT EXISTS access_token_expires_at TIMESTAMP;
+-- Activity list of one athlete, newest first (also serves before=/after= ranges)
+CREATE INDEX IF NOT EXISTS idx_activities_athlete_start ON activities(athlete_id, start_date DESC);
 CREATE INDEX IF NOT EXISTS idx_tokens_athlete_id ON tokens(athlete_id);
 CREATE INDEX IF NOT EXISTS idx_sessions_athlete_id ON user_sessions(athlete_id);
 CREATE INDEX IF NOT EXISTS idx_sessions_token ON user_sessions(session_token);
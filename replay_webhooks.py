@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# Local stand-in for Strava's push subscription: replays recorded webhook callbacks against the server.
+#
+# First performs the subscription validation handshake (GET with hub.challenge)
+# the way Strava does, then POSTs each event and checks that it was
+# acknowledged with 200 inside Strava's 2-second window. Events come from an
+# NDJSON file recorded by the server (STRAVA_WEBHOOK_RECORD=path) or, without
+# --events, from a built-in sample of create/update/delete/deauthorize events.
+# The server only accepts events of its STRAVA_WEBHOOK_SUBSCRIPTION_ID, so the
+# built-in samples are sent with --subscription-id.
+#
+# Usage: python3 replay_webhooks.py [--url http://localhost:8000/api/strava/webhook] [--events recorded.ndjson]
+#                                   [--subscription-id 120475]
+
+import argparse
+import json
+import os
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# Strava повторяет доставку, если 200 не пришёл за 2 секунды
+ACK_DEADLINE = 2.0
+
+SAMPLE_EVENTS = [
+    {'object_type': 'activity', 'object_id': 1360128428, 'aspect_type': 'create', 'owner_id': 134815,
+     'subscription_id': 120475, 'event_time': 1516126040, 'updates': {}},
+    {'object_type': 'activity', 'object_id': 1360128428, 'aspect_type': 'update', 'owner_id': 134815,
+     'subscription_id': 120475, 'event_time': 1516126100, 'updates': {'title': 'Messy'}},
+    {'object_type': 'activity', 'object_id': 1360128428, 'aspect_type': 'update', 'owner_id': 134815,
+     'subscription_id': 120475, 'event_time': 1516126160, 'updates': {'type': 'Ride', 'private': 'true'}},
+    {'object_type': 'activity', 'object_id': 1360128428, 'aspect_type': 'delete', 'owner_id': 134815,
+     'subscription_id': 120475, 'event_time': 1516126220, 'updates': {}},
+    {'object_type': 'athlete', 'object_id': 134815, 'aspect_type': 'update', 'owner_id': 134815,
+     'subscription_id': 120475, 'event_time': 1516126280, 'updates': {'authorized': 'false'}},
+]
+
+
+def load_events(path):
+    events = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                events.append(json.loads(line))
+            except ValueError as e:
+                print(f"⚠️ Skipping line {line_number}: {e}")
+    return events
+
+
+def validate_subscription(url, verify_token):
+    """GET handshake: the server must echo hub.challenge"""
+    challenge = f'replay-{int(time.time())}'
+    query = urllib.parse.urlencode({'hub.mode': 'subscribe', 'hub.challenge': challenge, 'hub.verify_token': verify_token})
+    try:
+        with urllib.request.urlopen(f'{url}?{query}', timeout=ACK_DEADLINE) as response:
+            body = json.loads(response.read().decode())
+    except (urllib.error.URLError, ValueError) as e:
+        print(f"❌ Subscription validation failed: {e}")
+        return False
+    if body.get('hub.challenge') != challenge:
+        print(f"❌ Subscription validation returned {body}")
+        return False
+    print("✅ Subscription validation handshake OK")
+    return True
+
+
+def post_event(url, event):
+    """POST one event; returns (status, seconds)"""
+    request = urllib.request.Request(url, data=json.dumps(event).encode(), method='POST',
+                                     headers={'Content-Type': 'application/json'})
+    started = time.monotonic()
+    try:
+        with urllib.request.urlopen(request, timeout=ACK_DEADLINE * 5) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except urllib.error.URLError as e:
+        print(f"❌ {e}")
+        status = None
+    return status, time.monotonic() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay Strava webhook callbacks against a local server')
+    parser.add_argument('--url', default='http://localhost:8000/api/strava/webhook', help='webhook endpoint (default: %(default)s)')
+    parser.add_argument('--events', help='NDJSON file of recorded events (default: built-in samples)')
+    parser.add_argument('--verify-token', default=os.environ.get('STRAVA_WEBHOOK_VERIFY_TOKEN', ''),
+                        help='hub.verify_token for the handshake (default: $STRAVA_WEBHOOK_VERIFY_TOKEN)')
+    parser.add_argument('--subscription-id', type=int,
+                        default=int(os.environ.get('STRAVA_WEBHOOK_SUBSCRIPTION_ID') or SAMPLE_EVENTS[0]['subscription_id']),
+                        help='subscription_id of the built-in samples (default: $STRAVA_WEBHOOK_SUBSCRIPTION_ID)')
+    parser.add_argument('--skip-validation', action='store_true', help='only POST the events')
+    parser.add_argument('--delay', type=float, default=0.0, help='seconds between events')
+    args = parser.parse_args()
+
+    if not args.skip_validation and not validate_subscription(args.url, args.verify_token):
+        sys.exit(1)
+
+    if args.events:
+        events = load_events(args.events)
+    else:
+        events = [dict(event, subscription_id=args.subscription_id) for event in SAMPLE_EVENTS]
+    failures = 0
+    latencies = []
+    for event in events:
+        status, elapsed = post_event(args.url, event)
+        latencies.append(elapsed)
+        ok = status == 200 and elapsed < ACK_DEADLINE
+        failures += not ok
+        print(f"{'✅' if ok else '❌'} {event.get('object_type')} {event.get('aspect_type')} {event.get('object_id')}: "
+              f"{status} in {elapsed * 1000:.0f}ms")
+        if args.delay:
+            time.sleep(args.delay)
+
+    if latencies:
+        latencies.sort()
+        print(f"📊 {len(events)} events, {failures} failed, ack p50 {latencies[len(latencies) // 2] * 1000:.0f}ms, "
+              f"max {latencies[-1] * 1000:.0f}ms")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
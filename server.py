@@ -4,27 +4,70 @@
 
 print("🚀 Bootstrapping addicted server...", flush=True)
 
+import abc
+import asyncio
+import base64
+import concurrent.futures
+import csv
 import http.server
+import io
+import math
 import socketserver
 import webbrowser
 import os
+import sys
 import json
+import shutil
+import signal
+import socket
+import sqlite3
+import ssl
 import time
-from datetime import datetime
-from collections import defaultdict
-from urllib.parse import urlparse, parse_qs
+import gzip
+import hashlib
+import hmac
+import http.client
+import importlib
+import mmap
+import struct
+import tempfile
+import queue
+import random
+import threading
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from collections import defaultdict, deque, namedtuple, OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import unquote, urlencode, urlparse, parse_qs
 
 # PostgreSQL support
 try:
     import psycopg2
-    from psycopg2.extras import RealDictCursor
+    from psycopg2.extras import RealDictCursor, execute_values
     from psycopg2 import errors as psycopg2_errors
     POSTGRES_AVAILABLE = True
 except ImportError:
     POSTGRES_AVAILABLE = False
     print("⚠️ PostgreSQL not available. Install psycopg2-binary for database support.")
 
-def get_db_connection():
+# Brotli support (optional, gzip is always available)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+def database_configured():
+    """Check whether a PostgreSQL connection can be attempted at all"""
+    return POSTGRES_AVAILABLE and bool(os.environ.get('DATABASE_URL', '').strip())
+
+def get_db_connection(max_retries=None):
     """Get PostgreSQL connection from DATABASE_URL"""
     if not POSTGRES_AVAILABLE:
         return None
@@ -52,7 +95,8 @@ def get_db_connection():
         database_url = railway_internal_url
         print("🔗 Using Railway internal database URL")
     
-    max_retries = int(os.environ.get('DATABASE_CONNECT_RETRIES', '3'))
+    if max_retries is None:
+        max_retries = int(os.environ.get('DATABASE_CONNECT_RETRIES', '3'))
     base_delay = float(os.environ.get('DATABASE_CONNECT_DELAY', '1.5'))
     
     for attempt in range(1, max_retries + 1):
@@ -100,6 +144,257 @@ def get_db_connection():
                 print("⚠️ Exhausted all database connection attempts. Falling back.")
     return None
 
+class CircuitBreaker:
+    """Fail fast on DB connects while the database is known to be down.
+
+    After `threshold` consecutive connect failures the breaker opens and
+    callers skip connecting for `cooldown` seconds; then one trial attempt is
+    let through (half-open) and its outcome closes or re-opens the breaker.
+    """
+
+    def __init__(self, threshold=3, cooldown=15.0):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._state = 'closed'
+        self._failures = 0
+        self._opened_at = 0.0
+        self._counters = defaultdict(int)
+
+    def allow(self):
+        """True if a connection attempt may be made now"""
+        with self._lock:
+            if self._state == 'closed':
+                return True
+            if self._state == 'open' and time.monotonic() - self._opened_at >= self.cooldown:
+                self._state = 'half_open'
+                return True
+            self._counters['short_circuited'] += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._state != 'closed':
+                print("✅ Database reachable again, circuit breaker closed")
+            self._state = 'closed'
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == 'half_open' or (self._state == 'closed' and self._failures >= self.threshold):
+                if self._state == 'closed':
+                    print(f"⚠️ Database unreachable ({self._failures} failures), skipping connects for {self.cooldown:.0f}s")
+                self._state = 'open'
+                self._opened_at = time.monotonic()
+                self._counters['opened'] += 1
+
+    @property
+    def is_open(self):
+        return self._state != 'closed'
+
+    def stats(self):
+        with self._lock:
+            return {'state': self._state, 'consecutive_failures': self._failures, **self._counters}
+
+db_breaker = CircuitBreaker(
+    threshold=int(os.environ.get('DATABASE_BREAKER_THRESHOLD', '3')),
+    cooldown=float(os.environ.get('DATABASE_BREAKER_COOLDOWN', '15')),
+)
+
+class DatabaseConnectionPool:
+    """Bounded, thread-safe pool of PostgreSQL connections.
+
+    Connections are opened lazily (single attempt, no backoff) up to max_size,
+    returned connections are kept for reuse and pinged before checkout once they
+    have been idle for longer than idle_check_after seconds.
+    """
+
+    def __init__(self, min_size=1, max_size=10, checkout_timeout=5.0,
+                 idle_check_after=30.0, max_idle_time=300.0):
+        self.min_size = max(0, min_size)
+        self.max_size = max(1, max_size, self.min_size)
+        self.checkout_timeout = checkout_timeout
+        self.idle_check_after = idle_check_after
+        self.max_idle_time = max_idle_time
+        self._cond = threading.Condition()
+        self._idle = []  # [(conn, released_at)] - LIFO, свежие соединения сверху
+        self._size = 0  # открытые соединения (idle + выданные)
+        self._in_use = set()  # id() выданных соединений, защита от двойного release
+        self._counters = defaultdict(int)
+
+    def _connect(self):
+        """Open a new connection without the blocking retry/backoff loop"""
+        return get_db_connection(max_retries=1)
+
+    def _discard(self, conn):
+        """Close a connection and free its slot"""
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._counters['discarded'] += 1
+            self._cond.notify()
+
+    def _is_healthy(self, conn, idle_for):
+        """Cheap liveness check for a connection taken from the idle list"""
+        if conn.closed:
+            return False
+        if idle_for < self.idle_check_after:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            conn.rollback()
+            with self._cond:
+                self._counters['health_checks'] += 1
+            return True
+        except Exception as e:
+            print(f"⚠️ Pooled connection failed health check: {e}")
+            return False
+
+    def acquire(self, timeout=None):
+        """Borrow a connection; returns None if the DB is unavailable or the pool is exhausted"""
+        if not database_configured():
+            return None
+
+        timeout = self.checkout_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        started = time.monotonic()
+
+        while True:
+            conn = None
+            idle_for = 0.0
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._counters['timeouts'] += 1
+                        print(f"⚠️ DB pool checkout timed out after {timeout:.1f}s ({self._size} connections in use)")
+                        return None
+                    self._counters['waits'] += 1
+                    self._cond.wait(remaining)
+
+                if self._idle:
+                    conn, released_at = self._idle.pop()
+                    idle_for = time.monotonic() - released_at
+                else:
+                    self._size += 1
+
+            if conn is None:
+                if not db_breaker.allow():
+                    # БД недавно была недоступна - не тратим время на подключение
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    return None
+                try:
+                    conn = self._connect()
+                except Exception as e:
+                    print(f"❌ DB pool connect error: {e}")
+                    conn = None
+                if conn is None:
+                    db_breaker.record_failure()
+                    with self._cond:
+                        self._size -= 1
+                        self._counters['connect_failures'] += 1
+                        self._cond.notify()
+                    return None
+                db_breaker.record_success()
+                with self._cond:
+                    self._counters['created'] += 1
+            elif idle_for > self.max_idle_time and self._size > self.min_size:
+                self._discard(conn)
+                continue
+            elif not self._is_healthy(conn, idle_for):
+                self._discard(conn)
+                continue
+
+            with self._cond:
+                self._in_use.add(id(conn))
+                self._counters['checkouts'] += 1
+                self._counters['wait_ms_total'] += int((time.monotonic() - started) * 1000)
+            return conn
+
+    def release(self, conn):
+        """Return a borrowed connection, rolling back any open transaction"""
+        if conn is None:
+            return
+        with self._cond:
+            if id(conn) not in self._in_use:
+                return
+            self._in_use.discard(id(conn))
+        if conn.closed:
+            self._discard(conn)
+            return
+        try:
+            if conn.status != psycopg2.extensions.STATUS_READY:
+                conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def warm(self):
+        """Open min_size connections (at least one) up front so first requests don't pay the handshake"""
+        conns = []
+        for _ in range(max(1, self.min_size)):
+            conn = self.acquire(timeout=0)
+            if conn is None:
+                break
+            conns.append(conn)
+        for conn in conns:
+            self.release(conn)
+        return len(conns)
+
+    def close_all(self):
+        """Close idle connections (used on shutdown)"""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def stats(self):
+        """Snapshot of pool usage counters"""
+        with self._cond:
+            stats = dict(self._counters)
+            stats.update({
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+            })
+        return stats
+
+db_pool = DatabaseConnectionPool(
+    min_size=int(os.environ.get('DATABASE_POOL_MIN', '1')),
+    max_size=int(os.environ.get('DATABASE_POOL_MAX', '10')),
+    checkout_timeout=float(os.environ.get('DATABASE_POOL_TIMEOUT', '5')),
+    idle_check_after=float(os.environ.get('DATABASE_POOL_IDLE_CHECK', '30')),
+    max_idle_time=float(os.environ.get('DATABASE_POOL_MAX_IDLE', '300')),
+)
+
+@contextmanager
+def db_connection(timeout=None):
+    """Borrow a pooled connection for the duration of a with-block (yields None if unavailable)"""
+    conn = db_pool.acquire(timeout)
+    try:
+        yield conn
+    finally:
+        if conn is not None:
+            db_pool.release(conn)
+
 ANALYTICS_TABLE_STATEMENTS = [
     """
     CREATE TABLE IF NOT EXISTS auth_events (
@@ -134,10 +429,68 @@ ANALYTICS_TABLE_STATEMENTS = [
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         FOREIGN KEY (athlete_id) REFERENCES athletes(athlete_id) ON DELETE SET NULL
     )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS analytics_daily_rollup (
+        day DATE NOT NULL,
+        club_id VARCHAR(50) NOT NULL DEFAULT '',
+        page_path VARCHAR(255) NOT NULL DEFAULT '',
+        visits BIGINT NOT NULL DEFAULT 0,
+        unique_sessions BIGINT NOT NULL DEFAULT 0,
+        downloads BIGINT NOT NULL DEFAULT 0,
+        download_users BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, club_id, page_path)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS analytics_daily_totals (
+        day DATE PRIMARY KEY,
+        visits BIGINT NOT NULL DEFAULT 0,
+        unique_sessions BIGINT NOT NULL DEFAULT 0,
+        downloads BIGINT NOT NULL DEFAULT 0,
+        connections BIGINT NOT NULL DEFAULT 0,
+        new_connections BIGINT NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS analytics_monthly_totals (
+        month TIMESTAMP PRIMARY KEY,
+        visits BIGINT NOT NULL DEFAULT 0,
+        unique_sessions BIGINT NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS analytics_connected_athletes (
+        athlete_id BIGINT PRIMARY KEY,
+        first_day DATE NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS analytics_hll (
+        metric VARCHAR(20) NOT NULL,
+        day DATE NOT NULL,
+        club_id VARCHAR(50) NOT NULL DEFAULT '',
+        sketch BYTEA NOT NULL,
+        PRIMARY KEY (metric, day, club_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS analytics_club_downloaders (
+        club_id VARCHAR(50) NOT NULL,
+        athlete_id BIGINT NOT NULL,
+        PRIMARY KEY (club_id, athlete_id)
+    )
     """
 ]
 
 ANALYTICS_INDEX_STATEMENTS = [
+    # Дубли, накопленные до уникального индекса, иначе он не создастся
+    """
+    DELETE FROM auth_events a USING auth_events b
+    WHERE a.athlete_id = b.athlete_id AND DATE(a.created_at) = DATE(b.created_at) AND a.id > b.id
+      AND NOT EXISTS (SELECT 1 FROM pg_indexes WHERE indexname = 'idx_auth_events_unique_day')
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_auth_events_unique_day ON auth_events(athlete_id, (DATE(created_at)))",
     "CREATE INDEX IF NOT EXISTS idx_auth_events_athlete_id ON auth_events(athlete_id)",
     "CREATE INDEX IF NOT EXISTS idx_auth_events_created_at ON auth_events(created_at)",
     "CREATE INDEX IF NOT EXISTS idx_auth_events_date ON auth_events((DATE(created_at)))",
@@ -149,46 +502,54 @@ ANALYTICS_INDEX_STATEMENTS = [
     "CREATE INDEX IF NOT EXISTS idx_visits_athlete_id ON visits(athlete_id)",
     "CREATE INDEX IF NOT EXISTS idx_visits_club_id ON visits(club_id)",
     "CREATE INDEX IF NOT EXISTS idx_visits_created_at ON visits(created_at)",
-    "CREATE INDEX IF NOT EXISTS idx_visits_date ON visits((DATE(created_at)))"
+    "CREATE INDEX IF NOT EXISTS idx_visits_date ON visits((DATE(created_at)))",
+    "CREATE INDEX IF NOT EXISTS idx_connected_athletes_first_day ON analytics_connected_athletes(first_day)",
+    "CREATE INDEX IF NOT EXISTS idx_daily_rollup_club_day ON analytics_daily_rollup(club_id, day)",
+    "CREATE INDEX IF NOT EXISTS idx_hll_metric_club_day ON analytics_hll(metric, club_id, day)"
 ]
 
+# Статистические представления читают только rollup-таблицы (см. AnalyticsRollup)
 ANALYTICS_VIEW_STATEMENTS = [
+    "DROP VIEW IF EXISTS stats_unique_connections",
     """
-    CREATE OR REPLACE VIEW stats_unique_connections AS
+    CREATE VIEW stats_unique_connections AS
     SELECT 
-        DATE(created_at) as date,
-        COUNT(DISTINCT athlete_id) as unique_connections
-    FROM auth_events
-    GROUP BY DATE(created_at)
+        day as date,
+        connections as unique_connections
+    FROM analytics_daily_totals
+    WHERE connections > 0
     ORDER BY date DESC
     """,
+    "DROP VIEW IF EXISTS stats_downloads_by_club",
     """
-    CREATE OR REPLACE VIEW stats_downloads_by_club AS
+    CREATE VIEW stats_downloads_by_club AS
     SELECT 
-        club_id,
-        COUNT(*) as total_downloads,
-        COUNT(DISTINCT athlete_id) as unique_users
-    FROM downloads
-    GROUP BY club_id
+        NULLIF(r.club_id, '') as club_id,
+        SUM(r.downloads)::bigint as total_downloads,
+        (SELECT COUNT(*) FROM analytics_club_downloaders d WHERE d.club_id = r.club_id) as unique_users
+    FROM analytics_daily_rollup r
+    WHERE r.downloads > 0
+    GROUP BY r.club_id
     """,
+    "DROP VIEW IF EXISTS stats_visits_by_day",
     """
-    CREATE OR REPLACE VIEW stats_visits_by_day AS
+    CREATE VIEW stats_visits_by_day AS
     SELECT 
-        DATE(created_at) as date,
-        COUNT(*) as total_visits,
-        COUNT(DISTINCT session_id) as unique_visits
-    FROM visits
-    GROUP BY DATE(created_at)
+        day as date,
+        visits as total_visits,
+        unique_sessions as unique_visits
+    FROM analytics_daily_totals
+    WHERE visits > 0
     ORDER BY date DESC
     """,
+    "DROP VIEW IF EXISTS stats_visits_by_month",
     """
-    CREATE OR REPLACE VIEW stats_visits_by_month AS
+    CREATE VIEW stats_visits_by_month AS
     SELECT 
-        DATE_TRUNC('month', created_at) as month,
-        COUNT(*) as total_visits,
-        COUNT(DISTINCT session_id) as unique_visits
-    FROM visits
-    GROUP BY DATE_TRUNC('month', created_at)
+        month,
+        visits as total_visits,
+        unique_sessions as unique_visits
+    FROM analytics_monthly_totals
     ORDER BY month DESC
     """
 ]
@@ -201,155 +562,3049 @@ def ensure_analytics_schema(cursor):
         except Exception as e:
             print(f"⚠️ Analytics ensure error: {e}\n   Statement: {statement.strip()[:80]}...")
 
-def execute_sql_statements(cursor, sql_content, description="SQL"):
-    """Execute SQL statements, handling each one separately to avoid transaction issues"""
-    import re
-    
-    # Remove single-line comments (-- ...) but preserve line structure
-    lines = sql_content.split('\n')
-    cleaned_lines = []
-    for line in lines:
-        comment_pos = line.find('--')
-        if comment_pos >= 0:
-            line = line[:comment_pos]
-        cleaned_lines.append(line)
-    sql_content = '\n'.join(cleaned_lines)
-    
-    # Удаляем блоковые комментарии /* ... */ которые могут содержать MySQL синтаксис
-    sql_content = re.sub(r'/\*.*?\*/', '', sql_content, flags=re.DOTALL)
-    
-    # Split SQL into statements manually to support dollar-quoted functions
-    statements = []
-    current = []
-    in_single_quote = False
-    in_double_quote = False
-    in_dollar_quote = False
-    dollar_tag = ''
-    i = 0
-    length = len(sql_content)
-    
-    while i < length:
-        char = sql_content[i]
-        next_chars = sql_content[i:]
-        
-        # Handle start/end of dollar-quoted string ($$ or $tag$)
-        if not in_single_quote and not in_double_quote:
-            if char == '$':
-                # Attempt to match dollar tag
-                match = re.match(r'\$[A-Za-z0-9_]*\$', sql_content[i:])
-                if match:
-                    tag = match.group(0)
-                    if not in_dollar_quote:
-                        in_dollar_quote = True
-                        dollar_tag = tag
-                    elif tag == dollar_tag:
-                        in_dollar_quote = False
-                        dollar_tag = ''
-                    current.append(tag)
-                    i += len(tag)
-                    continue
-        
-        # Handle single quote strings
-        if not in_double_quote and not in_dollar_quote and char == "'":
-            if not in_single_quote:
-                in_single_quote = True
-            else:
-                # Check for escaped quote (two single quotes)
-                if i + 1 < length and sql_content[i + 1] == "'":
-                    current.append("'" * 2)
-                    i += 2
-                    continue
-                in_single_quote = False
-            current.append(char)
-            i += 1
-            continue
-        
-        # Handle double quote strings
-        if not in_single_quote and not in_dollar_quote and char == '"':
-            if not in_double_quote:
-                in_double_quote = True
+# Bulk INSERT statement and execute_values() row template per event table
+# (created_at is always the last column)
+ANALYTICS_EVENT_SQL = {
+    'visits': (
+        "INSERT INTO visits (session_id, athlete_id, club_id, ip_address, user_agent, page_path, created_at) VALUES %s",
+        None,
+    ),
+    'downloads': (
+        "INSERT INTO downloads (athlete_id, club_id, ip_address, user_agent, file_format, created_at) VALUES %s",
+        None,
+    ),
+    # Одно подключение на атлета в день - как в save_athlete_data. DISTINCT ON
+    # убирает дубли внутри пачки, NOT EXISTS - с уже записанными днями,
+    # ON CONFLICT срабатывает на idx_auth_events_unique_day при гонке воркеров
+    'auth_events': (
+        """
+        INSERT INTO auth_events (athlete_id, ip_address, user_agent, created_at)
+        SELECT DISTINCT ON (v.athlete_id, DATE(v.created_at))
+            v.athlete_id, v.ip_address, v.user_agent, v.created_at
+        FROM (VALUES %s) AS v(athlete_id, ip_address, user_agent, created_at)
+        WHERE NOT EXISTS (
+            SELECT 1 FROM auth_events a
+            WHERE a.athlete_id = v.athlete_id AND DATE(a.created_at) = DATE(v.created_at)
+        )
+        ORDER BY v.athlete_id, DATE(v.created_at), v.created_at
+        ON CONFLICT DO NOTHING
+        """,
+        "(%s::bigint, %s, %s, %s::timestamp)",
+    ),
+}
+
+def utc_naive(value):
+    """Aware datetime -> naive UTC, the way created_at is stored.
+
+    The event tables use TIMESTAMP without time zone; an aware value would be
+    converted to the session time zone and DATE(created_at) in the rollups
+    would no longer match the UTC days of the sketches.
+    """
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+# Файлы сервера (хранилище атлетов, спул аналитики) лежат вне раздаваемого каталога
+APP_DATA_DIR = os.environ.get('APP_DATA_DIR', os.path.join(os.path.expanduser('~'), '.local', 'share', 'addicted'))
+
+class AnalyticsSpool:
+    """Append-only NDJSON spool for analytics events the database could not take.
+
+    Each process appends to its own segment (analytics-<ms>-<pid>.open) and
+    fsyncs once per appended batch. A full segment - or the current one before
+    a replay - is sealed by renaming it to .ndjson. A replayer claims a sealed
+    segment by renaming it to .replaying, bulk-loads it and deletes it; if the
+    load fails the segment is put back. Delivery is at-least-once.
+    """
+
+    def __init__(self, directory, segment_bytes=8 * 1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self._lock = threading.Lock()
+        self._file = None
+        self._path = None
+        self._pid = None
+        self._counters = defaultdict(int)
+
+    def _segment_path(self, suffix):
+        return os.path.join(self.directory, f'analytics-{int(time.time() * 1000):013d}-{os.getpid()}{suffix}')
+
+    def _recover_orphans(self):
+        """Seal .open/.replaying segments left behind by processes that are gone"""
+        for filename in os.listdir(self.directory):
+            if not filename.startswith('analytics-') or filename.endswith('.ndjson'):
+                continue
+            base, _, suffix = filename.rpartition('.')
+            try:
+                pid = int(base.rsplit('-', 1)[1])
+                os.kill(pid, 0)
+                continue  # процесс жив - сегмент ещё используется
+            except (ValueError, IndexError):
+                pass
+            except ProcessLookupError:
+                pass
+            except PermissionError:
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                os.rename(path, os.path.join(self.directory, base + '.ndjson'))
+            except OSError:
+                pass
+
+    def _open_segment(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if self._pid != os.getpid():
+            # Новый процесс (или после fork) - подбираем брошенные сегменты
+            self._file = None
+            self._pid = os.getpid()
+            self._recover_orphans()
+        self._path = self._segment_path('.open')
+        self._file = open(self._path, 'ab')
+
+    def _seal_locked(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        sealed = self._path[:-len('.open')] + '.ndjson'
+        os.rename(self._path, sealed)
+
+    def append(self, events):
+        """Durably append (table, row) events; returns the number spooled"""
+        lines = [
+            json.dumps({'table': table, 'row': list(row)}, default=lambda o: o.isoformat()).encode() + b'\n'
+            for table, row in events
+        ]
+        with self._lock:
+            try:
+                if self._file is None or self._pid != os.getpid():
+                    self._open_segment()
+                self._file.write(b''.join(lines))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                if self._file.tell() >= self.segment_bytes:
+                    self._seal_locked()
+            except OSError as e:
+                print(f"❌ Analytics spool write failed, dropping {len(lines)} events: {e}")
+                self._counters['write_errors'] += 1
+                return 0
+            self._counters['spooled'] += len(lines)
+        return len(lines)
+
+    def has_pending(self):
+        try:
+            return any(name.startswith('analytics-') for name in os.listdir(self.directory))
+        except OSError:
+            return False
+
+    def replay(self, load_events):
+        """Feed sealed segments to load_events(events) -> bool, deleting the ones it accepted"""
+        with self._lock:
+            if self._pid == os.getpid():
+                self._seal_locked()
             else:
-                in_double_quote = False
-            current.append(char)
-            i += 1
-            continue
-        
-        # Statement delimiter ';' (when not inside quotes)
-        if char == ';' and not in_single_quote and not in_double_quote and not in_dollar_quote:
-            statement = ''.join(current).strip()
-            if statement:
-                statements.append(statement)
-            current = []
-            i += 1
-            continue
+                self._pid = os.getpid()
+                self._recover_orphans()
         
-        current.append(char)
-        i += 1
-    
-    # Append remaining statement
-    statement = ''.join(current).strip()
-    if statement:
-        statements.append(statement)
-    
-    # Merge trailing fragments like "$$ language 'plpgsql'" with previous statement
-    merged_statements = []
-    for stmt in statements:
-        normalized = stmt.lstrip().lower()
-        if merged_statements and (
-            normalized.startswith('$$') or
-            normalized.startswith('language')
-        ):
-            merged_statements[-1] = merged_statements[-1].rstrip() + '\n' + stmt
-        else:
-            merged_statements.append(stmt)
-    statements = merged_statements
-    
-    # Execute each statement separately (autocommit is already enabled)
-    executed = 0
-    errors = 0
-    
-    for statement in statements:
-        statement = statement.strip()
-        if not statement:
-            continue
+        replayed = 0
+        for filename in sorted(os.listdir(self.directory)):
+            if not (filename.startswith('analytics-') and filename.endswith('.ndjson')):
+                continue
+            path = os.path.join(self.directory, filename)
+            claimed = path[:-len('.ndjson')].rsplit('-', 1)[0] + f'-{os.getpid()}.replaying'
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue  # другой воркер уже забрал этот сегмент
+            
+            events = []
+            with open(claimed, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        row = record['row']
+                        row[-1] = datetime.fromisoformat(row[-1]) if isinstance(row[-1], str) else row[-1]
+                        events.append((record['table'], tuple(row)))
+                    except (ValueError, KeyError, TypeError, IndexError):
+                        # Оборванная запись (сбой посреди write) - пропускаем
+                        self._counters['corrupt_lines'] += 1
+            
+            if events and not load_events(events):
+                os.rename(claimed, path)
+                break
+            os.remove(claimed)
+            replayed += len(events)
+            self._counters['replayed'] += len(events)
         
+        if replayed:
+            print(f"✅ Replayed {replayed} spooled analytics events")
+        return replayed
+
+    def stats(self):
+        pending = 0
         try:
-            cursor.execute(statement)
-            executed += 1
-        except Exception as e:
-            error_msg = str(e).lower()
-            # Check if error is acceptable (object already exists)
-            if 'already exists' in error_msg or \
-               ('duplicate' in error_msg and 'key' in error_msg) or \
-               ('relation' in error_msg and 'already exists' in error_msg):
-                executed += 1  # Count as successful
-            else:
-                errors += 1
-                print(f"⚠️ {description} error: {e}")
-                # Show preview of problematic statement (first line)
-                first_line = statement.split('\n')[0][:100]
-                print(f"   First line: {first_line}...")
-    
-    return executed, errors
+            for filename in os.listdir(self.directory):
+                if filename.startswith('analytics-'):
+                    pending += os.path.getsize(os.path.join(self.directory, filename))
+        except OSError:
+            pass
+        with self._lock:
+            return {'pending_bytes': pending, **self._counters}
 
-def init_database():
-    """Initialize database with schema"""
-    conn = get_db_connection()
-    if not conn:
-        print("⚠️ No database connection, skipping DB init")
-        return
-    
-    try:
-        # Set autocommit mode to avoid transaction issues
-        conn.autocommit = True
-        cursor = conn.cursor()
-        
-        # Read main schema from file
-        schema_file = 'database_schema.sql'
-        if os.path.exists(schema_file):
-            with open(schema_file, 'r', encoding='utf-8') as f:
-                schema_sql = f.read()
-                executed, errors = execute_sql_statements(cursor, schema_sql, "Main schema")
+analytics_spool = AnalyticsSpool(
+    os.environ.get('ANALYTICS_SPOOL_DIR', os.path.join(APP_DATA_DIR, 'spool')),
+    segment_bytes=int(float(os.environ.get('ANALYTICS_SPOOL_SEGMENT_MB', '8')) * 1024 * 1024),
+)
+
+STATS_GRANULARITIES = ('day', 'week', 'month', 'year')
+
+def period_start(day, granularity):
+    """First day of the day/week/month/year bucket containing day (weeks start on Monday, like DATE_TRUNC)"""
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    if granularity == 'year':
+        return day.replace(month=1, day=1)
+    return day
+
+def stats_range_queries(club_id=None):
+    """SQL for the range stats API, keyed by name.
+
+    Every query restricts the leading columns of an index to an equality
+    plus a day range (analytics_daily_totals / analytics_daily_rollup
+    primary keys, idx_daily_rollup_club_day, analytics_hll primary key /
+    idx_hll_metric_club_day), so its cost follows the requested range and
+    not the table size. tests/test_query_plans.py verifies that.
+    """
+    if club_id is None:
+        series = """
+            SELECT DATE_TRUNC(%(granularity)s, day)::date as period,
+                   SUM(visits)::bigint as visits, SUM(downloads)::bigint as downloads,
+                   SUM(connections)::bigint as connections
+            FROM analytics_daily_totals
+            WHERE day BETWEEN %(from)s AND %(to)s
+            GROUP BY 1
+            ORDER BY 1
+        """
+        club_filter = ""
+    else:
+        series = """
+            SELECT DATE_TRUNC(%(granularity)s, day)::date as period,
+                   SUM(visits)::bigint as visits, SUM(downloads)::bigint as downloads
+            FROM analytics_daily_rollup
+            WHERE club_id = %(club_id)s AND day BETWEEN %(from)s AND %(to)s
+            GROUP BY 1
+            ORDER BY 1
+        """
+        club_filter = " AND club_id = %(club_id)s"
+    return {
+        'series': series,
+        'pages': f"""
+            SELECT NULLIF(page_path, '') as page_path, SUM(visits)::bigint as visits
+            FROM analytics_daily_rollup
+            WHERE day BETWEEN %(from)s AND %(to)s{club_filter} AND visits > 0
+            GROUP BY page_path
+            ORDER BY visits DESC
+            LIMIT 20
+        """,
+        'sketches': f"""
+            SELECT day, sketch
+            FROM analytics_hll
+            WHERE metric = %(metric)s AND day BETWEEN %(from)s AND %(to)s{club_filter}
+        """,
+    }
+
+class HyperLogLog:
+    """Mergeable cardinality sketch (HyperLogLog with linear counting for small sets).
+
+    With precision p there are m = 2**p one-byte registers; the standard
+    error of count() is 1.04 / sqrt(m) - 1.6% for the default p=12, so about
+    95% of estimates are within +-3.3% of the true count. Small sets (below
+    2.5 * m) use linear counting and are nearly exact. Merging is a
+    register-wise max, so adding the same value twice or merging
+    overlapping sketches never inflates the count.
+    """
+
+    _POWERS = [2.0 ** -r for r in range(65)]
+
+    def __init__(self, precision=12, registers=None):
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.m)
+
+    def add(self, value):
+        digest = hashlib.blake2b(str(value).encode(), digest_size=8).digest()
+        h = int.from_bytes(digest, 'big')
+        index = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('Cannot merge HyperLogLog sketches of different precision')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(self._POWERS[r] for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        """Serialize as <precision byte><zlib-compressed registers> (small for sparse days)"""
+        return bytes([self.precision]) + zlib.compress(bytes(self.registers))
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = bytes(data)
+        return cls(data[0], zlib.decompress(data[1:]))
+
+class AnalyticsSketches:
+    """Per-day HyperLogLog sketches in analytics_hll, updated at ingest.
+
+    Metrics: 'visitors' (session_id per day and club), 'downloaders'
+    (athlete_id per day and club) and 'connections' (athlete_id per day,
+    club ''). Days are UTC dates of created_at. Uniques over a month, a
+    year or any range are estimated by merging the day sketches (see
+    HyperLogLog for the error bound). Re-adding replayed events is
+    harmless because sketches are idempotent.
+    """
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    @staticmethod
+    def _row_items(table, row):
+        """(metric, club_id, value, created_at) for a raw event row, or None"""
+        if table == 'visits':
+            session_id, club_id, created_at = row[0], row[2], row[-1]
+            return ('visitors', club_id, session_id, created_at) if session_id else None
+        if table == 'downloads':
+            athlete_id, club_id, created_at = row[0], row[1], row[-1]
+            return ('downloaders', club_id, athlete_id, created_at) if athlete_id is not None else None
+        if table == 'auth_events':
+            athlete_id, created_at = row[0], row[-1]
+            return ('connections', '', athlete_id, created_at) if athlete_id is not None else None
+        return None
+
+    def sketch_rows(self, table, rows):
+        """Build the per-(metric, day, club) sketches for a batch of raw rows"""
+        sketches = {}
+        for row in rows:
+            item = self._row_items(table, row)
+            if item is None:
+                continue
+            metric, club_id, value, created_at = item
+            if isinstance(created_at, str):
+                created_at = datetime.fromisoformat(created_at)
+            if created_at.tzinfo is not None:
+                created_at = created_at.astimezone(timezone.utc)
+            key = (metric, created_at.date(), club_id or '')
+            sketch = sketches.get(key)
+            if sketch is None:
+                sketch = sketches[key] = HyperLogLog(self.precision)
+            sketch.add(value)
+        return sketches
+
+    def update(self, conn, table, rows):
+        """Merge a batch of raw rows into the stored sketches.
+
+        One transaction and three statements per batch whatever the number of
+        keys: new keys are inserted, the rest are locked, merged in memory and
+        written back once each.
+        """
+        sketches = self.sketch_rows(table, rows)
+        if not sketches:
+            return 0
+        # Фиксированный порядок ключей - без взаимных блокировок между воркерами
+        keys = sorted(sketches)
+        try:
+            cursor = conn.cursor()
+            inserted = execute_values(cursor, """
+                INSERT INTO analytics_hll (metric, day, club_id, sketch) VALUES %s
+                ON CONFLICT DO NOTHING
+                RETURNING metric, day, club_id
+            """, [(*key, psycopg2.Binary(sketches[key].to_bytes())) for key in keys],
+                page_size=len(keys), fetch=True)
+            inserted = {tuple(row) for row in inserted}
+            existing = [key for key in keys if key not in inserted]
+            if existing:
+                stored = execute_values(cursor, """
+                    SELECT h.metric, h.day, h.club_id, h.sketch
+                    FROM analytics_hll h
+                    JOIN (VALUES %s) AS k(metric, day, club_id)
+                      ON h.metric = k.metric AND h.day = k.day AND h.club_id = k.club_id
+                    ORDER BY h.metric, h.day, h.club_id
+                    FOR UPDATE OF h
+                """, existing, template='(%s, %s::date, %s)', page_size=len(existing), fetch=True)
+                merged = []
+                for metric, day, club_id, data in stored:
+                    sketch = sketches[(metric, day, club_id)].merge(HyperLogLog.from_bytes(data))
+                    merged.append((metric, day, club_id, psycopg2.Binary(sketch.to_bytes())))
+                execute_values(cursor, """
+                    UPDATE analytics_hll h SET sketch = v.sketch
+                    FROM (VALUES %s) AS v(metric, day, club_id, sketch)
+                    WHERE h.metric = v.metric AND h.day = v.day AND h.club_id = v.club_id
+                """, merged, template='(%s, %s::date, %s, %s::bytea)', page_size=len(merged))
+            conn.commit()
+        except Exception as e:
+            if conn.closed:
+                raise
+            conn.rollback()
+            self._count('errors')
+            print(f"⚠️ Error updating {table} sketches: {e}")
+            return 0
+        self._count('updates', len(sketches))
+        return len(sketches)
+
+    def merged_by_period(self, cursor, metric, start_day, end_day, granularity='day', club_id=None):
+        """Merge the day sketches of metric into {period start: sketch} for days in [start_day, end_day]"""
+        cursor.execute(stats_range_queries(club_id)['sketches'], {
+            'metric': metric, 'from': start_day, 'to': end_day, 'club_id': club_id,
+        })
+        periods = {}
+        for row in cursor.fetchall():
+            day, data = (row['day'], row['sketch']) if isinstance(row, dict) else row
+            period = period_start(day, granularity)
+            sketch = HyperLogLog.from_bytes(data)
+            if period in periods:
+                periods[period].merge(sketch)
+            else:
+                periods[period] = sketch
+        self._count('merges')
+        return periods
+
+    def merged(self, cursor, metric, start_day, end_day, club_id=None):
+        """Merge the sketches of metric for days in [start_day, end_day] (optionally one club)"""
+        result = HyperLogLog(self.precision)
+        for sketch in self.merged_by_period(cursor, metric, start_day, end_day, 'year', club_id).values():
+            result.merge(sketch)
+        return result
+
+    def estimate(self, cursor, metric, start_day, end_day, club_id=None):
+        """Estimated number of distinct values of metric in a day range"""
+        return self.merged(cursor, metric, start_day, end_day, club_id).count()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+analytics_sketches = AnalyticsSketches(
+    precision=int(os.environ.get('ANALYTICS_HLL_PRECISION', '12')),
+)
+
+# Пересчёт rollup-таблиц за дни >= %(since)s. Каждый запрос идёт по индексу
+# created_at и пересчитывает ячейки целиком, поэтому повторный прогон безопасен.
+ANALYTICS_ROLLUP_STATEMENTS = [
+    """
+    INSERT INTO analytics_daily_rollup (day, club_id, page_path, visits, unique_sessions)
+    SELECT DATE(created_at), COALESCE(club_id, ''), COALESCE(page_path, ''), COUNT(*), COUNT(DISTINCT session_id)
+    FROM visits
+    WHERE created_at >= %(since)s
+    GROUP BY 1, 2, 3
+    ON CONFLICT (day, club_id, page_path) DO UPDATE
+    SET visits = EXCLUDED.visits, unique_sessions = EXCLUDED.unique_sessions
+    """,
+    """
+    INSERT INTO analytics_daily_rollup (day, club_id, page_path, downloads, download_users)
+    SELECT DATE(created_at), COALESCE(club_id, ''), '', COUNT(*), COUNT(DISTINCT athlete_id)
+    FROM downloads
+    WHERE created_at >= %(since)s
+    GROUP BY 1, 2
+    ON CONFLICT (day, club_id, page_path) DO UPDATE
+    SET downloads = EXCLUDED.downloads, download_users = EXCLUDED.download_users
+    """,
+    """
+    INSERT INTO analytics_daily_totals (day, visits, unique_sessions)
+    SELECT DATE(created_at), COUNT(*), COUNT(DISTINCT session_id)
+    FROM visits
+    WHERE created_at >= %(since)s
+    GROUP BY 1
+    ON CONFLICT (day) DO UPDATE
+    SET visits = EXCLUDED.visits, unique_sessions = EXCLUDED.unique_sessions
+    """,
+    """
+    INSERT INTO analytics_daily_totals (day, downloads)
+    SELECT DATE(created_at), COUNT(*)
+    FROM downloads
+    WHERE created_at >= %(since)s
+    GROUP BY 1
+    ON CONFLICT (day) DO UPDATE SET downloads = EXCLUDED.downloads
+    """,
+    """
+    INSERT INTO analytics_daily_totals (day, connections)
+    SELECT DATE(created_at), COUNT(DISTINCT athlete_id)
+    FROM auth_events
+    WHERE created_at >= %(since)s
+    GROUP BY 1
+    ON CONFLICT (day) DO UPDATE SET connections = EXCLUDED.connections
+    """,
+    # Уникальные за месяц дописывает AnalyticsRollup из HLL-скетчей
+    """
+    INSERT INTO analytics_monthly_totals (month, visits)
+    SELECT DATE_TRUNC('month', day), SUM(visits)
+    FROM analytics_daily_totals
+    WHERE day >= DATE_TRUNC('month', %(since)s::timestamp)
+    GROUP BY 1
+    ON CONFLICT (month) DO UPDATE SET visits = EXCLUDED.visits
+    """,
+    # Уникальные за всё время - через таблицы членства, а не COUNT(DISTINCT) по сырым событиям
+    """
+    INSERT INTO analytics_connected_athletes (athlete_id, first_day)
+    SELECT athlete_id, MIN(DATE(created_at))
+    FROM auth_events
+    WHERE created_at >= %(since)s AND athlete_id IS NOT NULL
+    GROUP BY athlete_id
+    ON CONFLICT (athlete_id) DO UPDATE
+    SET first_day = LEAST(analytics_connected_athletes.first_day, EXCLUDED.first_day)
+    """,
+    """
+    UPDATE analytics_daily_totals t
+    SET new_connections = (SELECT COUNT(*) FROM analytics_connected_athletes c WHERE c.first_day = t.day)
+    WHERE t.day >= %(since)s
+    """,
+    """
+    INSERT INTO analytics_club_downloaders (club_id, athlete_id)
+    SELECT DISTINCT COALESCE(club_id, ''), athlete_id
+    FROM downloads
+    WHERE created_at >= %(since)s AND athlete_id IS NOT NULL
+    ON CONFLICT DO NOTHING
+    """,
+]
+
+class ResponseCache:
+    """TTL cache of computed JSON responses with single-flight recomputation.
+
+    get(key, compute) returns a CachedAsset (content-hash ETag plus
+    precompressed variants) so handlers can answer 304s and send it via
+    send_cached_asset. An entry is reused until it is ttl seconds old or
+    bump() has advanced the version since it was computed. On a miss only
+    one thread runs compute(); concurrent callers for the same key wait for
+    its result instead of hitting the database too. compute() returning
+    None (e.g. database unavailable) is passed through and not cached.
+    Keys may come from request parameters, so the cache is an LRU of at most
+    max_entries; expired and stale-version entries are dropped on every store.
+    """
+
+    def __init__(self, ttl=30.0, wait_timeout=30.0, max_entries=256):
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        self.max_entries = max(1, max_entries)
+        self._version = 0
+        self._entries = OrderedDict()  # key -> (version, expires, CachedAsset), LRU order
+        self._inflight = {}  # key -> [Event, result]
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+
+    def bump(self):
+        """Invalidate all entries (the underlying data changed)"""
+        with self._lock:
+            self._version += 1
+
+    def get(self, key, compute):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == self._version and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self._counters['hits'] += 1
+                return entry[2]
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = [threading.Event(), None]
+                version = self._version
+                self._counters['misses'] += 1
+            else:
+                self._counters['coalesced'] += 1
+        
+        if not leader:
+            flight[0].wait(self.wait_timeout)
+            return flight[1]
+        
+        try:
+            body = compute()
+            if body is not None:
+                flight[1] = build_cached_asset(body, time.time_ns(), True)
+                with self._lock:
+                    # Версия на момент старта: если данные успели измениться, запись сразу устареет
+                    self._entries[key] = (version, time.monotonic() + self.ttl, flight[1])
+                    self._entries.move_to_end(key)
+                    self._evict()
+            return flight[1]
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight[0].set()
+
+    def _evict(self):
+        # Вызывается под self._lock: сначала устаревшие записи, потом самые давно использованные
+        now = time.monotonic()
+        for key in [k for k, (version, expires, _) in self._entries.items() if version != self._version or expires <= now]:
+            del self._entries[key]
+            self._counters['expired'] += 1
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._counters['evictions'] += 1
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'version': self._version, **self._counters}
+
+stats_cache = ResponseCache(
+    ttl=float(os.environ.get('STATS_CACHE_TTL', '30')),
+    max_entries=int(os.environ.get('STATS_CACHE_MAX_ENTRIES', '256')),
+)
+
+# Статистика - данные админки: браузер хранит копию, но всегда перепроверяет ETag
+STATS_CACHE_CONTROL = 'private, no-cache'
+
+class AnalyticsRollup:
+    """Periodic compaction of raw analytics events into rollup tables.
+
+    Each run refreshes the days from the newest rolled-up day onwards (plus
+    any older days marked dirty, e.g. by a spool replay), so its cost depends
+    on recent traffic only. The first run on an empty rollup backfills
+    everything. An advisory lock keeps worker processes from compacting at
+    the same time; a worker that loses the race keeps its dirty days for the
+    next run. Monthly unique visitors come from merged HLL sketches, and a
+    database that has events but no sketches yet is backfilled once. The
+    stats API reads only the rollups, so it lags raw events by up to one
+    interval; each successful run bumps the cache version so freshly rolled
+    up events show up on the next poll.
+    """
+
+    LOCK_KEY = 0x616e6c74  # 'anlt'
+
+    def __init__(self, interval=60.0, sketches=None, cache=None):
+        self.interval = interval
+        self.sketches = sketches
+        self.cache = cache
+        self._sketches_checked = False
+        self._next_run = 0.0
+        self._dirty_from = None
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+        self._last_run_ms = 0.0
+        self._last_since = None
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def mark_dirty(self, day):
+        """Make the next compaction re-aggregate everything from day onwards"""
+        with self._lock:
+            if self._dirty_from is None or day < self._dirty_from:
+                self._dirty_from = day
+
+    def maybe_compact(self):
+        if time.monotonic() < self._next_run:
+            return False
+        self._next_run = time.monotonic() + self.interval
+        return self.compact()
+
+    def compact(self):
+        """Re-aggregate recent days into the rollup tables; returns False if skipped"""
+        if not database_configured() or db_breaker.is_open:
+            return False
+        with self._lock:
+            dirty_from, self._dirty_from = self._dirty_from, None
+        
+        started = time.monotonic()
+        with db_connection() as conn:
+            if conn is None:
+                if dirty_from is not None:
+                    self.mark_dirty(dirty_from)
+                return False
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT pg_try_advisory_xact_lock(%s)", (self.LOCK_KEY,))
+                if not cursor.fetchone()[0]:
+                    conn.rollback()
+                    if dirty_from is not None:
+                        self.mark_dirty(dirty_from)
+                    self._count('skipped_locked')
+                    return False
+                cursor.execute("SELECT MAX(day) FROM analytics_daily_totals")
+                since = cursor.fetchone()[0] or datetime(1970, 1, 1).date()
+                if dirty_from is not None:
+                    # День назад - запас на разницу часовых поясов БД и приложения
+                    since = min(since, dirty_from - timedelta(days=1))
+                for statement in ANALYTICS_ROLLUP_STATEMENTS:
+                    cursor.execute(statement, {'since': since})
+                if self.sketches is not None:
+                    self._update_monthly_uniques(cursor, since)
+                conn.commit()
+                if self.sketches is not None and not self._sketches_checked:
+                    self._backfill_sketches(conn)
+            except Exception as e:
+                if not conn.closed:
+                    conn.rollback()
+                if dirty_from is not None:
+                    self.mark_dirty(dirty_from)
+                self._count('errors')
+                print(f"⚠️ Analytics rollup failed: {e}")
+                return False
+        
+        with self._lock:
+            self._counters['runs'] += 1
+            self._last_run_ms = (time.monotonic() - started) * 1000
+            self._last_since = since
+        if self.cache is not None:
+            self.cache.bump()
+        return True
+
+    def _update_monthly_uniques(self, cursor, since):
+        month = since.replace(day=1)
+        cursor.execute("SELECT month FROM analytics_monthly_totals WHERE month >= %s", (month,))
+        for (month_start,) in cursor.fetchall():
+            month_start = month_start.date()
+            next_month = (month_start + timedelta(days=32)).replace(day=1)
+            unique = self.sketches.estimate(cursor, 'visitors', month_start, next_month - timedelta(days=1))
+            cursor.execute(
+                "UPDATE analytics_monthly_totals SET unique_sessions = %s WHERE month = %s",
+                (unique, month_start),
+            )
+
+    def _backfill_sketches(self, conn):
+        """Build sketches from the raw tables once (a marker row records completion)"""
+        cursor = conn.cursor()
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM analytics_hll WHERE metric = 'backfilled')")
+        if not cursor.fetchone()[0]:
+            # Колонки в том же порядке, что ожидает AnalyticsSketches._row_items
+            sources = {
+                'visits': "SELECT session_id, athlete_id, club_id, created_at FROM visits WHERE session_id IS NOT NULL",
+                'downloads': "SELECT athlete_id, club_id, created_at FROM downloads WHERE athlete_id IS NOT NULL",
+                'auth_events': "SELECT athlete_id, created_at FROM auth_events WHERE athlete_id IS NOT NULL",
+            }
+            for table, sql in sources.items():
+                conn.commit()
+                stream = conn.cursor(name=f'hll_backfill_{table}', withhold=True)
+                try:
+                    stream.execute(sql)
+                    while True:
+                        rows = stream.fetchmany(5000)
+                        if not rows:
+                            break
+                        self.sketches.update(conn, table, rows)
+                finally:
+                    stream.close()
+            # Прерванный backfill просто повторится - повторное добавление в скетч безвредно
+            cursor.execute("""
+                INSERT INTO analytics_hll (metric, day, club_id, sketch) VALUES ('backfilled', CURRENT_DATE, '', %s)
+                ON CONFLICT DO NOTHING
+            """, (psycopg2.Binary(HyperLogLog(self.sketches.precision).to_bytes()),))
+            print("✅ Analytics sketches backfilled from raw events")
+        conn.commit()
+        self._sketches_checked = True
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._counters,
+                'last_run_ms': round(self._last_run_ms, 1),
+                'last_since': self._last_since.isoformat() if self._last_since else None,
+            }
+
+analytics_rollup = AnalyticsRollup(
+    interval=float(os.environ.get('ANALYTICS_ROLLUP_INTERVAL', '60')),
+    sketches=analytics_sketches,
+    cache=stats_cache,
+)
+
+class AnalyticsWriter:
+    """Write-behind queue for analytics events.
+
+    Handlers enqueue (table, row) tuples and return immediately; a background
+    thread drains the queue and writes each table's rows with one multi-row
+    INSERT when batch_size rows are pending or flush_interval has passed.
+    Batches the DB can't take (down, breaker open, connection lost) go to the
+    on-disk spool, which is replayed every replay_interval seconds once the
+    DB is back. Events are dropped (and counted) only when the queue is full.
+    Written rows are also merged into the HLL sketches. The same thread runs
+    the rollup compaction.
+    """
+
+    def __init__(self, batch_size=200, flush_interval=2.0, max_queue=10000, spool=None, replay_interval=30.0,
+                 rollup=None, sketches=None):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.spool = spool
+        self.rollup = rollup
+        self.sketches = sketches
+        self.replay_interval = replay_interval
+        self._next_replay = 0.0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._counters = defaultdict(int)
+        self._last_flush_ms = 0.0
+        self._max_flush_ms = 0.0
+
+    def _count(self, name, value=1):
+        with self._stats_lock:
+            self._counters[name] += value
+
+    def _ensure_started(self):
+        # Поток запускается лениво - так он создаётся уже в дочернем процессе после fork
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name='analytics-writer', daemon=True)
+                self._thread.start()
+
+    def start(self):
+        """Start the writer thread (it also starts lazily on the first event)"""
+        self._ensure_started()
+
+    def enqueue(self, table, row):
+        """Queue one event row; returns False if it had to be dropped"""
+        return self.enqueue_many([(table, row)])
+
+    def enqueue_many(self, events):
+        """Queue a list of (table, row) events as one unit so they are flushed together"""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(events)
+        except queue.Full:
+            self._count('dropped_queue_full', len(events))
+            return False
+        self._count('enqueued', len(events))
+        return True
+
+    def _run(self):
+        while not self._stopping.is_set():
+            batch = self._collect()
+            if batch:
+                self.flush(batch)
+            if self.spool is not None and time.monotonic() >= self._next_replay:
+                self._next_replay = time.monotonic() + self.replay_interval
+                self.replay_spool()
+            if self.rollup is not None:
+                self.rollup.maybe_compact()
+        # Финальный сброс при остановке
+        batch = []
+        while True:
+            try:
+                batch.extend(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self.flush(batch)
+
+    def _collect(self):
+        """Wait for the first event, then gather more until batch_size or flush_interval"""
+        try:
+            batch = list(self._queue.get(timeout=0.5))
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size and not self._stopping.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.extend(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self, batch):
+        """Write a batch of (table, row) events, one INSERT per table"""
+        started = time.monotonic()
+        rows_by_table = defaultdict(list)
+        for table, row in batch:
+            rows_by_table[table].append(row)
+        
+        with db_connection() as conn:
+            if conn is None:
+                self._spool_events(batch)
+                return
+            for table, rows in rows_by_table.items():
+                try:
+                    written = self._insert_rows(conn, table, rows)
+                except Exception as e:
+                    print(f"⚠️ Lost database connection while writing {table}: {e}")
+                    self._spool_events([(table, row) for row in rows])
+                    continue
+                self._count('written', written)
+                self._count('failed', len(rows) - written)
+                if self.sketches is not None and written:
+                    self.sketches.update(conn, table, rows)
+        
+        elapsed_ms = (time.monotonic() - started) * 1000
+        with self._stats_lock:
+            self._counters['batches'] += 1
+            self._last_flush_ms = elapsed_ms
+            self._max_flush_ms = max(self._max_flush_ms, elapsed_ms)
+
+    def _spool_events(self, events):
+        # Без DATABASE_URL (локальная разработка) копить события на диске незачем
+        if self.spool is not None and database_configured() and self.spool.append(events):
+            self._count('spooled', len(events))
+        else:
+            self._count('dropped_db_unavailable', len(events))
+
+    def _insert_rows(self, conn, table, rows):
+        """Multi-row INSERT; on error retry row by row so one bad event doesn't sink the batch.
+
+        Raises if the connection itself is gone, so the caller can spool the rows.
+        """
+        sql, template = ANALYTICS_EVENT_SQL[table]
+        rows = [tuple(row[:-1]) + (utc_naive(row[-1]),) for row in rows]
+        try:
+            cursor = conn.cursor()
+            execute_values(cursor, sql, rows, template=template, page_size=len(rows))
+            conn.commit()
+            return len(rows)
+        except Exception as e:
+            if conn.closed:
+                raise
+            conn.rollback()
+            print(f"⚠️ Batch insert into {table} failed ({len(rows)} rows), retrying one by one: {e}")
+        
+        written = 0
+        for row in rows:
+            try:
+                cursor = conn.cursor()
+                execute_values(cursor, sql, [row], template=template)
+                conn.commit()
+                written += 1
+            except Exception as e:
+                if conn.closed:
+                    raise
+                conn.rollback()
+                print(f"⚠️ Error recording {table} event: {e}")
+        return written
+
+    def replay_spool(self):
+        """Bulk-load spooled events once the database is reachable again"""
+        if db_breaker.is_open or not self.spool.has_pending():
+            return 0
+        with db_connection() as conn:
+            if conn is None:
+                return 0
+            
+            def load_events(events):
+                rows_by_table = defaultdict(list)
+                for table, row in events:
+                    rows_by_table[table].append(row)
+                if self.rollup is not None and events:
+                    # Старые события попадают в уже свёрнутые дни - их надо пересчитать
+                    self.rollup.mark_dirty(min(row[-1] for _, row in events).date())
+                try:
+                    for table, rows in rows_by_table.items():
+                        for i in range(0, len(rows), self.batch_size):
+                            chunk = rows[i:i + self.batch_size]
+                            written = self._insert_rows(conn, table, chunk)
+                            self._count('replay_written', written)
+                            self._count('replay_failed', len(chunk) - written)
+                            if self.sketches is not None and written:
+                                self.sketches.update(conn, table, chunk)
+                except Exception as e:
+                    print(f"⚠️ Spool replay interrupted: {e}")
+                    return False
+                return True
+            
+            return self.spool.replay(load_events)
+
+    def stop(self, timeout=10.0):
+        """Flush everything still queued and stop the writer thread"""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+
+    def stats(self):
+        """Snapshot of queue depth, throughput and flush latency"""
+        with self._stats_lock:
+            stats = dict(self._counters)
+            stats.update({
+                'queue_depth': self._queue.qsize(),
+                'last_flush_ms': round(self._last_flush_ms, 1),
+                'max_flush_ms': round(self._max_flush_ms, 1),
+            })
+        return stats
+
+analytics_writer = AnalyticsWriter(
+    batch_size=int(os.environ.get('ANALYTICS_BATCH_SIZE', '200')),
+    flush_interval=float(os.environ.get('ANALYTICS_FLUSH_INTERVAL', '2')),
+    max_queue=int(os.environ.get('ANALYTICS_QUEUE_MAX', '10000')),
+    spool=analytics_spool,
+    replay_interval=float(os.environ.get('ANALYTICS_SPOOL_REPLAY_INTERVAL', '30')),
+    rollup=analytics_rollup,
+    sketches=analytics_sketches,
+)
+
+ANALYTICS_MAX_BATCH_EVENTS = int(os.environ.get('ANALYTICS_MAX_BATCH_EVENTS', '500'))
+
+def parse_ndjson_events(body):
+    """Split an NDJSON body into (event, parse_error) pairs, one per non-empty line"""
+    parsed = []
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+        try:
+            parsed.append((json.loads(line), None))
+        except json.JSONDecodeError:
+            parsed.append((None, 'invalid JSON'))
+    return parsed
+
+def _optional_text(event, field, max_length, default=None):
+    value = event.get(field, default)
+    if value is None:
+        return default
+    if not isinstance(value, str):
+        raise ValueError(f'{field} must be a string')
+    if len(value) > max_length:
+        raise ValueError(f'{field} is longer than {max_length} characters')
+    return value
+
+def validate_analytics_event(event):
+    """Check one analytics event payload; returns normalized fields or raises ValueError"""
+    if not isinstance(event, dict):
+        raise ValueError('event must be an object')
+    
+    event_type = event.get('type')
+    if event_type not in ('visit', 'download'):
+        raise ValueError(f'unknown event type: {event_type!r}')
+    
+    athlete_id = event.get('athlete_id')
+    if athlete_id is not None:
+        if isinstance(athlete_id, bool):
+            raise ValueError('athlete_id must be an integer')
+        try:
+            athlete_id = int(athlete_id)
+        except (TypeError, ValueError):
+            raise ValueError('athlete_id must be an integer')
+    
+    fields = {
+        'type': event_type,
+        'athlete_id': athlete_id,
+        'club_id': _optional_text(event, 'club_id', 50),
+    }
+    if event_type == 'visit':
+        fields['session_id'] = _optional_text(event, 'session_id', 255)
+        fields['page_path'] = _optional_text(event, 'page_path', 255, default='/')
+    return fields
+
+STATS_MAX_RANGE_DAYS = int(os.environ.get('STATS_MAX_RANGE_DAYS', '3660'))
+STATS_MAX_POINTS = 400
+
+def parse_stats_params(query):
+    """Validate from/to/club_id/granularity of a range stats request (raises ValueError)"""
+    params = parse_qs(query)
+    
+    def single(name):
+        values = params.get(name)
+        return values[-1].strip() if values else None
+    
+    try:
+        to_day = datetime.strptime(single('to'), '%Y-%m-%d').date() if single('to') else datetime.now(timezone.utc).date()
+        from_day = datetime.strptime(single('from'), '%Y-%m-%d').date() if single('from') else to_day - timedelta(days=29)
+    except ValueError:
+        raise ValueError('from/to must be dates in YYYY-MM-DD format')
+    if from_day > to_day:
+        raise ValueError('from must not be after to')
+    if (to_day - from_day).days >= STATS_MAX_RANGE_DAYS:
+        raise ValueError(f'Range is limited to {STATS_MAX_RANGE_DAYS} days')
+    
+    granularity = (single('granularity') or 'day').lower()
+    if granularity not in STATS_GRANULARITIES:
+        raise ValueError(f"granularity must be one of: {', '.join(STATS_GRANULARITIES)}")
+    if len({period_start(from_day + timedelta(days=i), granularity)
+            for i in range(0, (to_day - from_day).days + 1)}) > STATS_MAX_POINTS:
+        raise ValueError(f'Too many {granularity} points, use a coarser granularity')
+    
+    club_id = single('club_id') or None
+    if club_id is not None and len(club_id) > 50:
+        raise ValueError('Invalid club_id')
+    return {'from': from_day, 'to': to_day, 'club_id': club_id, 'granularity': granularity}
+
+def build_stats_range(params):
+    """Compute the range stats JSON from the rollups and sketches (None if the database is unavailable)"""
+    with db_connection() as conn:
+        if not conn:
+            return None
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        queries = stats_range_queries(params['club_id'])
+        
+        cursor.execute(queries['series'], params)
+        series = [dict(row) for row in cursor.fetchall()]
+        cursor.execute(queries['pages'], params)
+        top_pages = [dict(row) for row in cursor.fetchall()]
+        
+        # Уникальные по периодам и за весь диапазон - слиянием HLL-скетчей
+        counters = ['visits', 'downloads']
+        metrics = {'unique_visitors': 'visitors', 'unique_downloaders': 'downloaders'}
+        if params['club_id'] is None:
+            counters.append('connections')
+            metrics['unique_connections'] = 'connections'
+        totals = {name: sum(point[name] for point in series) for name in counters}
+        by_period = {point['period']: point for point in series}
+        for name, metric in metrics.items():
+            periods = analytics_sketches.merged_by_period(
+                cursor, metric, params['from'], params['to'], params['granularity'], params['club_id'])
+            overall = HyperLogLog(analytics_sketches.precision)
+            for period, sketch in periods.items():
+                overall.merge(sketch)
+                point = by_period.get(period)
+                if point is None:
+                    point = by_period[period] = {'period': period}
+                point[name] = sketch.count()
+            totals[name] = overall.count()
+    
+    for point in by_period.values():
+        for name in counters + list(metrics):
+            point.setdefault(name, 0)
+    return json.dumps({
+        'from': params['from'],
+        'to': params['to'],
+        'club_id': params['club_id'],
+        'granularity': params['granularity'],
+        'totals': totals,
+        'series': [by_period[period] for period in sorted(by_period)],
+        'top_pages': top_pages,
+        # Относительная стандартная ошибка уникальных (HyperLogLog)
+        'unique_error': round(1.04 / math.sqrt(1 << analytics_sketches.precision), 4),
+    }, default=str).encode()
+
+ROLLUP_TABLES = ('analytics_daily_totals', 'analytics_daily_rollup', 'analytics_hll')
+
+def explain_stats_range_queries(cursor):
+    """EXPLAIN every range stats query with seq scans disabled: {label: [(node type, relation, index)]}.
+
+    With enable_seqscan off the planner still picks a Seq Scan only when no
+    index can serve the query, so any Seq Scan in the result means a query or
+    index change broke index use. The caller rolls the transaction back.
+    """
+    today = datetime.now(timezone.utc).date()
+    params = {'from': today - timedelta(days=29), 'to': today, 'club_id': 'probe',
+              'granularity': 'day', 'metric': 'visitors'}
+    cursor.execute("SET LOCAL enable_seqscan = off")
+    plans = {}
+    for club_id in (None, 'probe'):
+        for name, sql in stats_range_queries(club_id).items():
+            cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            nodes, pending = [], [cursor.fetchone()[0][0]['Plan']]
+            while pending:
+                node = pending.pop()
+                nodes.append(node)
+                pending.extend(node.get('Plans', []))
+            plans[f"{name}{' (club)' if club_id else ''}"] = [
+                (node['Node Type'], node['Relation Name'], node.get('Index Name'))
+                for node in nodes if 'Relation Name' in node
+            ]
+    return plans
+
+def check_stats_query_plans():
+    """Print the scans of every range stats query; False if any of them is a Seq Scan.
+
+    Run with: python3 server.py --check-query-plans (tests/test_query_plans.py
+    asserts the same against DATABASE_URL).
+    """
+    with db_connection() as conn:
+        if conn is None:
+            print("❌ Database not available, cannot check query plans")
+            return False
+        try:
+            plans = explain_stats_range_queries(conn.cursor())
+        finally:
+            conn.rollback()
+    passed = True
+    for label, scans in plans.items():
+        seq_scans = sorted({relation for node_type, relation, _ in scans if node_type == 'Seq Scan'})
+        if seq_scans:
+            passed = False
+            print(f"❌ {label}: sequential scan on {', '.join(seq_scans)}")
+        else:
+            print(f"✅ {label}: {'; '.join(sorted({f'{t} on {index or relation}' for t, relation, index in scans}))}")
+    return passed
+
+ADMIN_USER_COLUMNS = ['athlete_id', 'username', 'firstname', 'lastname', 'email',
+                      'city', 'country', 'connected_at', 'last_seen_at']
+ADMIN_USERS_PAGE_SIZE = 100
+ADMIN_USERS_MAX_PAGE_SIZE = 500
+
+def encode_users_cursor(connected_at, athlete_id):
+    """Opaque keyset cursor for the admin users listing"""
+    if isinstance(connected_at, datetime):
+        connected_at = connected_at.isoformat()
+    raw = json.dumps([connected_at, athlete_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_users_cursor(token):
+    """Inverse of encode_users_cursor (raises ValueError on a malformed cursor)"""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        connected_at, athlete_id = json.loads(raw)
+        datetime.fromisoformat(connected_at)
+        return connected_at, int(athlete_id)
+    except (TypeError, ValueError, json.JSONDecodeError):
+        raise ValueError('Invalid cursor')
+
+def parse_admin_users_params(query):
+    """limit/cursor/city/country of an admin users request (raises ValueError)"""
+    params = parse_qs(query)
+    
+    def single(name):
+        values = params.get(name)
+        return values[-1].strip() if values and values[-1].strip() else None
+    
+    try:
+        limit = int(single('limit') or ADMIN_USERS_PAGE_SIZE)
+    except ValueError:
+        raise ValueError('limit must be an integer')
+    cursor = single('cursor')
+    return {
+        'limit': max(1, min(limit, ADMIN_USERS_MAX_PAGE_SIZE)),
+        'cursor': decode_users_cursor(cursor) if cursor else None,
+        'city': single('city'),
+        'country': single('country'),
+        'format': (single('format') or 'ndjson').lower(),
+    }
+
+def admin_users_where(params, keyset=True, placeholder='%s'):
+    """WHERE clause and arguments for the admin users filters (and keyset cursor).
+
+    placeholder is the parameter marker of the backend: '%s' for psycopg2,
+    '?' for sqlite3.
+    """
+    conditions = ['is_active = TRUE']
+    args = []
+    for name in ('country', 'city'):
+        if params.get(name):
+            conditions.append(f'{name} = {placeholder}')
+            args.append(params[name])
+    if keyset and params.get('cursor'):
+        conditions.append(f'(connected_at, athlete_id) < ({placeholder}, {placeholder})')
+        args.extend(params['cursor'])
+    return ' AND '.join(conditions), args
+
+def admin_users_query(params, keyset=True):
+    """SELECT for the admin users listing/export.
+
+    Rows come in (connected_at DESC, athlete_id DESC) order, served by the
+    partial indexes idx_athletes_active_connected / _country_connected /
+    _city_connected; the next page starts strictly after the cursor row, so
+    deep pages cost the same as the first one.
+    """
+    where, args = admin_users_where(params, keyset)
+    sql = f"""
+        SELECT {', '.join(ADMIN_USER_COLUMNS)}
+        FROM athletes
+        WHERE {where}
+        ORDER BY connected_at DESC, athlete_id DESC
+    """
+    if keyset:
+        sql += " LIMIT %s"
+        args.append(params['limit'] + 1)
+    return sql, args
+
+class LocalAthleteStore:
+    """Embedded SQLite store for athletes while PostgreSQL is unavailable.
+
+    Uses the athletes table and keyset indexes from database_schema.sql in
+    WAL mode, so logins (upserts) don't block admin reads. Connections are
+    per thread and per process (safe after fork). Timestamps are stored as
+    ISO strings, which sort chronologically, so the admin listing uses the
+    same (connected_at, athlete_id) cursor as the PostgreSQL path.
+    """
+
+    SCHEMA = [
+        """
+        CREATE TABLE IF NOT EXISTS athletes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            athlete_id INTEGER UNIQUE NOT NULL,
+            username TEXT,
+            firstname TEXT,
+            lastname TEXT,
+            email TEXT,
+            city TEXT,
+            country TEXT,
+            profile_picture TEXT,
+            access_token_hash TEXT,
+            strava_created_at TEXT,
+            strava_updated_at TEXT,
+            connected_at TEXT NOT NULL,
+            last_seen_at TEXT,
+            is_active BOOLEAN DEFAULT TRUE,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_athletes_active_connected ON athletes(connected_at DESC, athlete_id DESC) WHERE is_active = TRUE",
+        "CREATE INDEX IF NOT EXISTS idx_athletes_country_connected ON athletes(country, connected_at DESC, athlete_id DESC) WHERE is_active = TRUE",
+        "CREATE INDEX IF NOT EXISTS idx_athletes_city_connected ON athletes(city, connected_at DESC, athlete_id DESC) WHERE is_active = TRUE",
+    ]
+
+    UPSERT_SQL = """
+        INSERT INTO athletes (
+            athlete_id, username, firstname, lastname, email,
+            city, country, profile_picture, access_token_hash,
+            strava_created_at, strava_updated_at, connected_at, last_seen_at
+        )
+        VALUES (:athlete_id, :username, :firstname, :lastname, :email,
+                :city, :country, :profile_picture, :access_token_hash,
+                :strava_created_at, :strava_updated_at, :connected_at, :last_seen_at)
+        ON CONFLICT (athlete_id) DO UPDATE SET
+            username = excluded.username,
+            firstname = excluded.firstname,
+            lastname = excluded.lastname,
+            email = excluded.email,
+            city = excluded.city,
+            country = excluded.country,
+            profile_picture = excluded.profile_picture,
+            access_token_hash = COALESCE(excluded.access_token_hash, athletes.access_token_hash),
+            strava_updated_at = excluded.strava_updated_at,
+            connected_at = MIN(athletes.connected_at, excluded.connected_at),
+            last_seen_at = MAX(COALESCE(athletes.last_seen_at, ''), COALESCE(excluded.last_seen_at, '')),
+            updated_at = CURRENT_TIMESTAMP
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with conn:
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def upsert(self, athlete):
+        """Insert or update one athlete (dict with the athletes column names)"""
+        now = datetime.now().isoformat()
+        row = {name: athlete.get(name) for name in (
+            'athlete_id', 'username', 'firstname', 'lastname', 'email', 'city', 'country',
+            'profile_picture', 'access_token_hash', 'strava_created_at', 'strava_updated_at',
+            'connected_at', 'last_seen_at')}
+        row['connected_at'] = row['connected_at'] or now
+        row['last_seen_at'] = row['last_seen_at'] or now
+        conn = self._connect()
+        with conn:
+            conn.execute(self.UPSERT_SQL, row)
+        with self._lock:
+            self._counters['upserts'] += 1
+
+    def page(self, params):
+        """One admin listing page: {'users', 'next_cursor'} (+ 'total'/'recent' on the first page)"""
+        conn = self._connect()
+        where, args = admin_users_where(params, placeholder='?')
+        rows = conn.execute(f"""
+            SELECT {', '.join(ADMIN_USER_COLUMNS)}
+            FROM athletes
+            WHERE {where}
+            ORDER BY connected_at DESC, athlete_id DESC
+            LIMIT ?
+        """, args + [params['limit'] + 1]).fetchall()
+        users = [dict(row) for row in rows]
+        
+        response = {'users': users[:params['limit']], 'next_cursor': None}
+        if len(users) > params['limit']:
+            last = users[params['limit'] - 1]
+            response['next_cursor'] = encode_users_cursor(last['connected_at'], last['athlete_id'])
+        if params['cursor'] is None:
+            where, args = admin_users_where(params, keyset=False, placeholder='?')
+            week_ago = (datetime.now() - timedelta(days=7)).isoformat()
+            total, recent = conn.execute(f"""
+                SELECT COUNT(*), COUNT(*) FILTER (WHERE connected_at > ?)
+                FROM athletes
+                WHERE {where}
+            """, [week_ago] + args).fetchone()
+            response.update({'total': total, 'recent': recent})
+        return response
+
+    def iter_rows(self, params, batch_size=1000):
+        """Yield lists of matching athletes (export order) without loading them all"""
+        conn = self._connect()
+        where, args = admin_users_where(params, keyset=False, placeholder='?')
+        cursor = conn.execute(f"""
+            SELECT {', '.join(ADMIN_USER_COLUMNS)}
+            FROM athletes
+            WHERE {where}
+            ORDER BY connected_at DESC, athlete_id DESC
+        """, args)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [dict(row) for row in rows]
+
+    SYNC_COLUMNS = ['athlete_id', 'username', 'firstname', 'lastname', 'email', 'city', 'country',
+                    'profile_picture', 'access_token_hash', 'strava_created_at', 'strava_updated_at',
+                    'connected_at', 'last_seen_at', 'is_active']
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM athletes").fetchone()[0]
+
+    def iter_athletes(self, batch_size=1000):
+        """Yield lists of full athlete rows (SYNC_COLUMNS, by athlete_id) for syncing to PostgreSQL"""
+        cursor = self._connect().execute(
+            f"SELECT {', '.join(self.SYNC_COLUMNS)} FROM athletes ORDER BY athlete_id")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [dict(row) for row in rows]
+
+    def import_json_files(self, data_dir='data'):
+        """One-shot import of legacy data/athlete_*.json files.
+
+        Each imported file is renamed to *.json.imported, so a restart doesn't
+        import it again; importing the same athlete twice is a harmless upsert.
+        """
+        try:
+            filenames = sorted(f for f in os.listdir(data_dir) if f.startswith('athlete_') and f.endswith('.json'))
+        except OSError:
+            return 0
+        imported = 0
+        for filename in filenames:
+            path = os.path.join(data_dir, filename)
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                data.setdefault('strava_created_at', data.get('created_at'))
+                data.setdefault('strava_updated_at', data.get('updated_at'))
+                data.setdefault('last_seen_at', data.get('connected_at'))
+                self.upsert(data)
+                os.rename(path, path + '.imported')
+                imported += 1
+            except Exception as e:
+                print(f"⚠️ Could not import {filename}: {e}")
+        if imported:
+            with self._lock:
+                self._counters['imported'] += imported
+            print(f"✅ Imported {imported} athlete JSON files into {self.path}")
+        return imported
+
+    def stats(self):
+        with self._lock:
+            return {'path': self.path, **self._counters}
+
+athlete_store = LocalAthleteStore(
+    os.environ.get('ATHLETE_STORE_PATH', os.path.join(APP_DATA_DIR, 'athletes.sqlite3')),
+)
+
+def migrate_legacy_data(legacy_dir='data'):
+    """Move the athlete store and spool from their old in-tree location (data/) to APP_DATA_DIR"""
+    moves = [(os.path.join(legacy_dir, 'athletes.sqlite3' + suffix), athlete_store.path + suffix)
+             for suffix in ('', '-wal', '-shm')]
+    legacy_spool = os.path.join(legacy_dir, 'spool')
+    if os.path.isdir(legacy_spool):
+        moves += [(os.path.join(legacy_spool, name), os.path.join(analytics_spool.directory, name))
+                  for name in os.listdir(legacy_spool)]
+    for source, target in moves:
+        if not os.path.isfile(source) or os.path.abspath(source) == os.path.abspath(target):
+            continue
+        if os.path.exists(target):
+            print(f"⚠️ Not moving {source}: {target} already exists")
+            continue
+        os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+        shutil.move(source, target)
+        print(f"📦 Moved {source} -> {target}")
+
+# Upsert used by AthleteWriter; one row per athlete (the writer coalesces duplicates)
+ATHLETE_UPSERT_SQL = """
+    INSERT INTO athletes (
+        athlete_id, username, firstname, lastname, email,
+        city, country, profile_picture, access_token_hash, access_token_expires_at,
+        strava_created_at, strava_updated_at, last_seen_at
+    )
+    VALUES %s
+    ON CONFLICT (athlete_id)
+    DO UPDATE SET
+        username = EXCLUDED.username,
+        firstname = EXCLUDED.firstname,
+        lastname = EXCLUDED.lastname,
+        email = EXCLUDED.email,
+        city = EXCLUDED.city,
+        country = EXCLUDED.country,
+        profile_picture = EXCLUDED.profile_picture,
+        access_token_hash = EXCLUDED.access_token_hash,
+        access_token_expires_at = EXCLUDED.access_token_expires_at,
+        strava_updated_at = EXCLUDED.strava_updated_at,
+        last_seen_at = GREATEST(athletes.last_seen_at, EXCLUDED.last_seen_at)
+"""
+
+ATHLETE_UPSERT_COLUMNS = (
+    'athlete_id', 'username', 'firstname', 'lastname', 'email', 'city', 'country',
+    'profile_picture', 'access_token_hash', 'access_token_expires_at', 'strava_created_at', 'strava_updated_at',
+    'last_seen_at',
+)
+
+class AthleteWriter:
+    """Write-behind persistence for OAuth logins.
+
+    The token exchange hands the athlete record over and answers the client
+    immediately; a background thread upserts pending athletes into
+    PostgreSQL in batches (one multi-row INSERT ... ON CONFLICT), falling
+    back to the local athlete store when the DB is unavailable. Pending
+    records are keyed by athlete_id, so repeated logins of the same athlete
+    before a flush collapse into one write with the latest data. The pending
+    set is bounded: when it is full, submit() returns False and the caller
+    writes synchronously instead of dropping the login. stop() drains
+    everything that is still pending.
+    """
+
+    def __init__(self, batch_size=100, flush_interval=1.0, max_pending=1000):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_pending = max(1, max_pending)
+        self._pending = OrderedDict()  # athlete_id -> record
+        self._cond = threading.Condition()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stopping = False
+        self._counters = defaultdict(int)
+
+    def _ensure_started(self):
+        # Как и analytics_writer - поток стартует лениво, уже после fork
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name='athlete-writer', daemon=True)
+                self._thread.start()
+
+    def start(self):
+        """Start the writer thread (it also starts lazily on the first login)"""
+        self._ensure_started()
+
+    def submit(self, record):
+        """Queue an athlete record (dict with ATHLETE_UPSERT_COLUMNS); False if the caller must write it itself"""
+        self._ensure_started()
+        athlete_id = record.get('athlete_id')
+        with self._cond:
+            if self._stopping:
+                return False
+            if athlete_id in self._pending:
+                # Повторный вход до записи - сохраняем только последние данные
+                self._pending[athlete_id] = record
+                self._counters['coalesced'] += 1
+                return True
+            if len(self._pending) >= self.max_pending:
+                self._counters['rejected_full'] += 1
+                return False
+            self._pending[athlete_id] = record
+            self._counters['submitted'] += 1
+            self._cond.notify()
+        return True
+
+    def _take_batch(self):
+        with self._cond:
+            batch = []
+            while self._pending and len(batch) < self.batch_size:
+                batch.append(self._pending.popitem(last=False)[1])
+            return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopping:
+                    self._cond.wait(timeout=0.5)
+                if self._stopping and not self._pending:
+                    return
+                # Даём накопиться пачке (и схлопнуться повторным входам)
+                deadline = time.monotonic() + self.flush_interval
+                while not self._stopping and len(self._pending) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(timeout=remaining)
+            batch = self._take_batch()
+            if batch:
+                self.write(batch)
+
+    def write(self, records):
+        """Persist records to PostgreSQL, or to the local store if the DB is unavailable"""
+        started = time.monotonic()
+        with db_connection() as conn:
+            if conn is not None:
+                try:
+                    cursor = conn.cursor()
+                    execute_values(cursor, ATHLETE_UPSERT_SQL,
+                                   [tuple(r.get(c) for c in ATHLETE_UPSERT_COLUMNS) for r in records],
+                                   page_size=len(records))
+                    conn.commit()
+                    self._count('written_db', len(records))
+                    print(f"✅ Saved {len(records)} athlete(s) to DB in {(time.monotonic() - started) * 1000:.0f}ms")
+                    return
+                except Exception as e:
+                    print(f"⚠️ Error saving athletes to database: {e}")
+                    if not conn.closed:
+                        conn.rollback()
+        
+        for record in records:
+            try:
+                last_seen = record.get('last_seen_at')
+                athlete_store.upsert(dict(record, last_seen_at=last_seen.isoformat() if last_seen else None))
+                self._count('written_local')
+                print(f"💾 Saved athlete data (local store): {record.get('firstname')} {record.get('lastname')} (ID: {record.get('athlete_id')})")
+            except Exception as e:
+                self._count('failed')
+                print(f"⚠️ Error saving athlete data: {e}")
+
+    def _count(self, name, value=1):
+        with self._cond:
+            self._counters[name] += value
+
+    def stop(self, timeout=10.0):
+        """Write everything still pending and stop the thread (graceful shutdown)"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join(timeout)
+        # Если поток не запускался или не успел - дописываем сами
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                break
+            self.write(batch)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._counters)
+            stats['pending'] = len(self._pending)
+        return stats
+
+athlete_writer = AthleteWriter(
+    batch_size=int(os.environ.get('ATHLETE_WRITER_BATCH_SIZE', '100')),
+    flush_interval=float(os.environ.get('ATHLETE_WRITER_FLUSH_INTERVAL', '1.0')),
+    max_pending=int(os.environ.get('ATHLETE_WRITER_MAX_PENDING', '1000')),
+)
+
+OutboundResponse = namedtuple('OutboundResponse', ['status', 'headers', 'body', 'elapsed_ms'])
+
+class OutboundHTTPError(Exception):
+    """Outbound request failed without a usable response (timeout, connection error, client busy)"""
+
+class OutboundHTTPClient:
+    """Keep-alive HTTP(S) client for calls to external APIs (Strava).
+
+    Connections are pooled per origin and reused, so only the first request
+    pays for the TCP/TLS handshake. Every request has a connect timeout, a
+    per-read timeout and an overall deadline; at most max_concurrency
+    requests are in flight, and callers beyond that wait up to queue_timeout
+    before failing fast. 5xx responses (and connection errors) are retried
+    with exponential backoff and full jitter, honouring Retry-After when it
+    fits in the deadline. A 429 is returned at once: Strava's limit windows
+    outlast any deadline, so a retry would only burn quota - StravaQuota
+    holds requests back until the window resets. Non-idempotent requests (POST by default,
+    e.g. the single-use OAuth code exchange) are retried only when the
+    connection could not be made, never once the request was sent, and only
+    reuse connections idle for less than safe_reuse_idle seconds, which the
+    server is unlikely to have closed. Any URL works, including plain
+    http://, so the client can be pointed at a local fake endpoint in tests.
+    """
+
+    RETRY_STATUSES = (500, 502, 503, 504)
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+    def __init__(self, connect_timeout=3.0, read_timeout=10.0, deadline=20.0, max_retries=2,
+                 backoff=0.5, max_concurrency=8, queue_timeout=5.0, max_idle_per_origin=4, safe_reuse_idle=2.0):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.queue_timeout = queue_timeout
+        self.max_idle_per_origin = max_idle_per_origin
+        self.safe_reuse_idle = safe_reuse_idle
+        self._slots = threading.BoundedSemaphore(max(1, max_concurrency))
+        self._ssl_context = ssl.create_default_context()
+        self._idle = defaultdict(list)  # (scheme, host, port) -> [(connection, idle since)]
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+        self._latency = defaultdict(lambda: deque(maxlen=500))  # host -> recent latencies (ms)
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def _checkout(self, origin, max_idle=None):
+        stale = []
+        try:
+            with self._lock:
+                while self._idle[origin]:
+                    conn, idle_since = self._idle[origin].pop()
+                    if max_idle is not None and time.monotonic() - idle_since > max_idle:
+                        stale.append(conn)
+                        continue
+                    self._counters['connections_reused'] += 1
+                    return conn, True
+        finally:
+            for conn in stale:
+                conn.close()
+        scheme, host, port = origin
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=self.connect_timeout, context=self._ssl_context)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.connect_timeout)
+        conn.connect()
+        # После соединения таймаут действует на каждое чтение ответа
+        conn.sock.settimeout(self.read_timeout)
+        self._count('connections_opened')
+        return conn, False
+
+    def _checkin(self, origin, conn):
+        with self._lock:
+            if len(self._idle[origin]) < self.max_idle_per_origin:
+                self._idle[origin].append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def _retry_delay(self, attempt, retry_after):
+        if retry_after:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                try:
+                    return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+                except (TypeError, ValueError, IndexError):
+                    pass
+        return random.uniform(0, self.backoff * (2 ** attempt))
+
+    def request(self, method, url, body=None, headers=None, retries=None, idempotent=None):
+        """Send a request and return OutboundResponse (any status); raises OutboundHTTPError"""
+        parsed = urlparse(url)
+        scheme = parsed.scheme or 'https'
+        origin = (scheme, parsed.hostname, parsed.port or (443 if scheme == 'https' else 80))
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        headers = dict(headers or {})
+        retries = self.max_retries if retries is None else retries
+        if idempotent is None:
+            idempotent = method.upper() in self.IDEMPOTENT_METHODS
+        max_idle = None if idempotent else self.safe_reuse_idle
+        
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            self._count('rejected_busy')
+            raise OutboundHTTPError(f'Too many concurrent requests to {origin[1]}')
+        try:
+            started = time.monotonic()
+            deadline = started + self.deadline
+            attempt = 0
+            while True:
+                attempt_started = time.monotonic()
+                response, error = None, None
+                conn = None
+                sent = False
+                try:
+                    conn, reused = self._checkout(origin, max_idle)
+                    try:
+                        conn.request(method, path, body=body, headers=headers)
+                        sent = True
+                        raw = conn.getresponse()
+                    except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                        # Неидемпотентный запрос, ушедший на сервер, повторять нельзя - он мог выполниться
+                        if not reused or (sent and not idempotent):
+                            raise
+                        # Сервер закрыл простаивавшее соединение - повторяем на новом
+                        conn.close()
+                        sent = False
+                        conn, _ = self._checkout_fresh(origin)
+                        conn.request(method, path, body=body, headers=headers)
+                        sent = True
+                        raw = conn.getresponse()
+                    data = raw.read()
+                    response = OutboundResponse(raw.status, dict(raw.getheaders()), data,
+                                                (time.monotonic() - attempt_started) * 1000)
+                    if raw.will_close:
+                        conn.close()
+                    else:
+                        self._checkin(origin, conn)
+                    conn = None
+                except (OSError, http.client.HTTPException) as e:
+                    error = e
+                    if conn is not None:
+                        conn.close()
+                
+                self._record(origin[1], response, error, attempt_started)
+                if idempotent:
+                    retryable = error is not None or response.status in self.RETRY_STATUSES
+                else:
+                    retryable = error is not None and not sent
+                if not retryable or attempt >= retries:
+                    break
+                delay = self._retry_delay(attempt, response.headers.get('Retry-After') if response else None)
+                if time.monotonic() + delay >= deadline:
+                    break
+                self._count('retries')
+                time.sleep(delay)
+                attempt += 1
+            
+            if response is None:
+                raise OutboundHTTPError(f'{method} {origin[1]} failed after {attempt + 1} attempt(s): {error}')
+            return response
+        finally:
+            self._slots.release()
+
+    def _checkout_fresh(self, origin):
+        with self._lock:
+            stale = self._idle.pop(origin, [])
+        for conn, _ in stale:
+            conn.close()
+        return self._checkout(origin)
+
+    def _record(self, host, response, error, started):
+        elapsed_ms = (time.monotonic() - started) * 1000
+        with self._lock:
+            self._counters['requests'] += 1
+            if error is not None:
+                self._counters['errors'] += 1
+            else:
+                self._counters[f'status_{response.status // 100}xx'] += 1
+            self._latency[host].append(elapsed_ms)
+
+    def close(self):
+        """Close all idle pooled connections"""
+        with self._lock:
+            idle, self._idle = self._idle, defaultdict(list)
+        for connections in idle.values():
+            for conn, _ in connections:
+                conn.close()
+
+    def stats(self):
+        """Counters plus per-host latency percentiles over the recent requests"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['idle_connections'] = sum(len(c) for c in self._idle.values())
+            latency = {}
+            for host, samples in self._latency.items():
+                ordered = sorted(samples)
+                if not ordered:
+                    continue
+                pick = lambda q: round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 1)
+                latency[host] = {'count': len(ordered), 'p50_ms': pick(0.5), 'p95_ms': pick(0.95),
+                                 'p99_ms': pick(0.99), 'max_ms': round(ordered[-1], 1)}
+            stats['latency'] = latency
+        return stats
+
+strava_http = OutboundHTTPClient(
+    connect_timeout=float(os.environ.get('STRAVA_CONNECT_TIMEOUT', '3')),
+    read_timeout=float(os.environ.get('STRAVA_READ_TIMEOUT', '10')),
+    deadline=float(os.environ.get('STRAVA_REQUEST_DEADLINE', '20')),
+    max_retries=int(os.environ.get('STRAVA_MAX_RETRIES', '2')),
+    max_concurrency=int(os.environ.get('STRAVA_MAX_CONCURRENCY', '8')),
+)
+
+# Переопределяется для тестов против локального фейкового сервера
+STRAVA_TOKEN_URL = os.environ.get('STRAVA_TOKEN_URL', 'https://www.strava.com/oauth/token')
+
+STRAVA_API_URL = os.environ.get('STRAVA_API_URL', 'https://www.strava.com/api/v3')
+
+# Эндпоинты Strava, доступные через прокси: TTL кэша и разрешённые параметры запроса
+STRAVA_PROXY_LIST_TTL = float(os.environ.get('STRAVA_PROXY_LIST_TTL', '120'))
+STRAVA_PROXY_ACTIVITY_TTL = float(os.environ.get('STRAVA_PROXY_ACTIVITY_TTL', '900'))
+STRAVA_LIST_PARAMS = ('after', 'before', 'page', 'per_page')
+STRAVA_DEFAULT_PER_PAGE = 30
+
+def strava_proxy_route(api_path, query):
+    """(ttl, normalized query) for a proxied Strava endpoint, or None if it isn't allowed"""
+    if api_path == '/athlete/activities':
+        params = parse_qs(query)
+        normalized = urlencode(sorted((name, params[name][0]) for name in STRAVA_LIST_PARAMS if name in params))
+        return STRAVA_PROXY_LIST_TTL, normalized
+    parts = api_path.strip('/').split('/')
+    if len(parts) == 2 and parts[0] == 'activities' and parts[1].isdigit():
+        return STRAVA_PROXY_ACTIVITY_TTL, ''
+    return None
+
+class StravaQuota:
+    """Tracks the app-wide Strava rate limit from response headers.
+
+    Strava reports the 15-minute and daily limits and the usage so far in
+    X-RateLimit-Limit / X-RateLimit-Usage ("short,daily"; the read-only
+    X-ReadRateLimit-* pair is preferred when present, since the proxy only
+    reads). Usage is known as of the last response and is assumed to reset
+    when its window (quarter hour / UTC day) rolls over. Each process learns
+    the shared usage from its own responses.
+    """
+
+    SHORT_WINDOW = 900
+
+    def __init__(self, reserve=10):
+        self.reserve = reserve
+        self._lock = threading.Lock()
+        self._limits = None  # (short, daily)
+        self._usage = (0, 0)
+        self._observed = None  # (short window index, UTC day) of the last observation
+        self._throttled_window = None  # short window of the last 429
+        self._counters = defaultdict(int)
+
+    @staticmethod
+    def _windows(now):
+        return int(now // StravaQuota.SHORT_WINDOW), int(now // 86400)
+
+    def update(self, headers, throttled=False):
+        """Record usage from a Strava response; throttled=True for a 429"""
+        headers = {name.lower(): value for name, value in headers.items()}
+        prefix = 'x-readratelimit-' if 'x-readratelimit-usage' in headers else 'x-ratelimit-'
+        try:
+            limits = tuple(int(v) for v in headers[prefix + 'limit'].split(','))[:2]
+            usage = tuple(int(v) for v in headers[prefix + 'usage'].split(','))[:2]
+        except (KeyError, ValueError):
+            limits, usage = None, None
+        with self._lock:
+            if limits and usage and len(limits) == 2 and len(usage) == 2:
+                self._limits, self._usage = limits, usage
+            if throttled:
+                self._counters['throttled'] += 1
+                # Даже без заголовков лимита не ходим в Strava до конца окна
+                self._throttled_window = self._windows(time.time())[0]
+                if self._limits:
+                    # Strava отказал - считаем окно исчерпанным до его смены
+                    self._usage = (max(self._usage[0], self._limits[0]), self._usage[1])
+            self._observed = self._windows(time.time())
+
+    def _remaining(self, now):
+        # Вызывается под self._lock
+        if self._limits is None:
+            return None
+        short_window, day = self._windows(now)
+        short_used, daily_used = self._usage
+        if self._observed[0] != short_window:
+            short_used = 0
+        if self._observed[1] != day:
+            short_used, daily_used = 0, 0
+        return self._limits[0] - short_used, self._limits[1] - daily_used
+
+    def headroom(self):
+        """Fraction of the tighter window still available (1.0 while nothing is known)"""
+        with self._lock:
+            remaining = self._remaining(time.time())
+            if remaining is None:
+                return 1.0
+            return max(0.0, min(remaining[0] / self._limits[0], remaining[1] / self._limits[1]))
+
+    def retry_after(self):
+        """Seconds until requests are allowed again, or 0 if there is quota left"""
+        now = time.time()
+        with self._lock:
+            remaining = self._remaining(now)
+            throttled = self._throttled_window == self._windows(now)[0]
+            if remaining is None:
+                return int(self.SHORT_WINDOW - now % self.SHORT_WINDOW) + 1 if throttled else 0
+            if remaining[1] <= self.reserve:
+                return int(86400 - now % 86400) + 1
+            if remaining[0] <= self.reserve:
+                return int(self.SHORT_WINDOW - now % self.SHORT_WINDOW) + 1
+            return 0
+
+    def stats(self):
+        with self._lock:
+            remaining = self._remaining(time.time())
+            stats = dict(self._counters)
+            stats['limits'] = list(self._limits) if self._limits else None
+            stats['remaining'] = list(remaining) if remaining else None
+        return stats
+
+# fresh: тело только что получено от Strava (не из кэша, не устаревшая копия)
+ProxyResult = namedtuple('ProxyResult', ['status', 'asset', 'retry_after', 'fresh'], defaults=(False,))
+
+class StravaProxy:
+    """Server-side proxy for Strava API reads with a per-athlete response cache.
+
+    Successful responses are cached as CachedAssets (ETag + compressed
+    variants) keyed by (athlete, endpoint, normalized query), where the
+    athlete is identified by a hash of the bearer token. The cache is an LRU
+    bounded by total bytes and entries, and each athlete may hold at most
+    max_entries_per_athlete of them. Identical requests already in flight
+    are coalesced: only one goes to Strava, the rest wait for its result.
+    When the quota is nearly used up or Strava is unreachable, an expired
+    entry is served if there is one; otherwise the caller gets 429/504.
+    After a full page of activities the next page is prefetched in the
+    background, but only while the quota headroom is above prefetch_headroom.
+    """
+
+    def __init__(self, client, quota, base_url, max_bytes=16 * 1024 * 1024, max_entries=2000,
+                 max_entries_per_athlete=50, prefetch_headroom=0.5, wait_timeout=30.0):
+        self.client = client
+        self.quota = quota
+        self.base_url = base_url.rstrip('/')
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.max_entries_per_athlete = max(1, max_entries_per_athlete)
+        self.prefetch_headroom = prefetch_headroom
+        self.wait_timeout = wait_timeout
+        self._entries = OrderedDict()  # (athlete, path, query) -> (expires, CachedAsset)
+        self._per_athlete = defaultdict(int)
+        self._bytes = 0
+        self._inflight = {}  # key -> [Event, ProxyResult]
+        self._prefetcher = None
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+
+    def get(self, token, api_path, query, ttl, prefetch=False):
+        """ProxyResult for GET api_path?query on behalf of the token's athlete"""
+        athlete = hashlib.sha256(token.encode()).hexdigest()[:32]
+        key = (athlete, api_path, query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self._counters['prefetch_skipped' if prefetch else 'hits'] += 1
+                return ProxyResult(200, entry[1], 0)
+            stale = entry[1] if entry is not None else None
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = [threading.Event(), None]
+                self._counters['prefetched' if prefetch else 'misses'] += 1
+            else:
+                self._counters['coalesced'] += 1
+        
+        if not leader:
+            if not flight[0].wait(self.wait_timeout) or flight[1] is None:
+                return ProxyResult(504, build_cached_asset(b'{"error": "Strava request timed out"}', time.time_ns(), False), 0)
+            # Свежий ответ обрабатывает только ведущий запрос
+            return flight[1]._replace(fresh=False)
+        
+        try:
+            flight[1] = self._fetch(key, token, ttl, stale)
+            if not prefetch and flight[1].status == 200:
+                self._maybe_prefetch(token, api_path, query, ttl, flight[1].asset)
+            return flight[1]
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight[0].set()
+
+    def _fetch(self, key, token, ttl, stale):
+        athlete, api_path, query = key
+        retry_after = self.quota.retry_after()
+        if retry_after:
+            return self._fallback(stale, 429, 'Strava rate limit reached, try again later', retry_after)
+        
+        url = self.base_url + api_path + (f'?{query}' if query else '')
+        try:
+            response = self.client.request('GET', url, headers={
+                'Authorization': f'Bearer {token}',
+                'Accept': 'application/json',
+            })
+        except OutboundHTTPError as e:
+            print(f"⚠️ Strava API unavailable: {e}")
+            return self._fallback(stale, 504, 'Strava is not responding, please try again', 0)
+        
+        self.quota.update(response.headers, throttled=response.status == 429)
+        if response.status == 429:
+            return self._fallback(stale, 429, 'Strava rate limit reached, try again later', self.quota.retry_after() or 60)
+        
+        asset = build_cached_asset(response.body, time.time_ns(), True)
+        if response.status == 200:
+            self._store(key, asset, ttl)
+        elif response.status == 401:
+            # Токен отозван или истёк - ответы этого атлета больше не отдаём
+            self.invalidate(athlete)
+        return ProxyResult(response.status, asset, 0, response.status == 200)
+
+    def _fallback(self, stale, status, message, retry_after):
+        if stale is not None:
+            self._count('stale_served')
+            return ProxyResult(200, stale, 0)
+        self._count('rejected_quota' if status == 429 else 'upstream_errors')
+        return ProxyResult(status, build_cached_asset(json.dumps({'error': message}).encode(), time.time_ns(), False),
+                           retry_after)
+
+    def _store(self, key, asset, ttl):
+        athlete = key[0]
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1].memory
+                self._per_athlete[athlete] -= 1
+            self._entries[key] = (time.monotonic() + ttl, asset)
+            self._bytes += asset.memory
+            self._per_athlete[athlete] += 1
+            if self._per_athlete[athlete] > self.max_entries_per_athlete:
+                # Один атлет не вытесняет остальных: удаляем его самую старую запись
+                oldest = next(k for k in self._entries if k[0] == athlete)
+                self._evict(oldest)
+            while (self._bytes > self.max_bytes or len(self._entries) > self.max_entries) and len(self._entries) > 1:
+                self._evict(next(iter(self._entries)))
+
+    def _evict(self, key):
+        # Вызывается под self._lock
+        _, asset = self._entries.pop(key)
+        self._bytes -= asset.memory
+        self._per_athlete[key[0]] -= 1
+        if not self._per_athlete[key[0]]:
+            del self._per_athlete[key[0]]
+        self._counters['evictions'] += 1
+
+    def invalidate(self, athlete):
+        """Drop all cached responses of one athlete (token hash)"""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == athlete]:
+                self._evict(key)
+
+    def _maybe_prefetch(self, token, api_path, query, ttl, asset):
+        if api_path != '/athlete/activities':
+            return
+        params = dict(parse_qs(query))
+        try:
+            page = int(params.get('page', ['1'])[0])
+            per_page = int(params.get('per_page', [str(STRAVA_DEFAULT_PER_PAGE)])[0])
+            full_page = len(json.loads(asset.body)) >= per_page
+        except (ValueError, TypeError):
+            return
+        if not full_page or self.quota.headroom() < self.prefetch_headroom:
+            return
+        params['page'] = [str(page + 1)]
+        next_query = urlencode(sorted((name, values[0]) for name, values in params.items()))
+        with self._lock:
+            if self._prefetcher is None:
+                # Создаётся лениво - уже в рабочем процессе после fork
+                self._prefetcher = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix='strava-prefetch')
+            prefetcher = self._prefetcher
+        try:
+            prefetcher.submit(self.get, token, api_path, next_query, ttl, True)
+        except RuntimeError:
+            pass  # executor already shut down
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def close(self):
+        with self._lock:
+            prefetcher, self._prefetcher = self._prefetcher, None
+        if prefetcher is not None:
+            prefetcher.shutdown(wait=False)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'athletes': len(self._per_athlete), 'bytes': self._bytes,
+                    'inflight': len(self._inflight), **self._counters}
+
+strava_quota = StravaQuota(
+    reserve=int(os.environ.get('STRAVA_QUOTA_RESERVE', '10')),
+)
+
+strava_proxy = StravaProxy(
+    strava_http, strava_quota, STRAVA_API_URL,
+    max_bytes=int(os.environ.get('STRAVA_PROXY_CACHE_MB', '16')) * 1024 * 1024,
+    max_entries_per_athlete=int(os.environ.get('STRAVA_PROXY_MAX_PER_ATHLETE', '50')),
+    prefetch_headroom=float(os.environ.get('STRAVA_PREFETCH_HEADROOM', '0.5')),
+)
+
+# Колонки activities, заполняемые из объекта активности Strava
+ACTIVITY_UPSERT_SQL = """
+    INSERT INTO activities (
+        activity_id, athlete_id, name, sport_type, start_date, distance, moving_time,
+        elapsed_time, total_elevation_gain, average_speed, summary_polyline, summary
+    )
+    VALUES %s
+    ON CONFLICT (activity_id) DO UPDATE SET
+        name = EXCLUDED.name,
+        sport_type = EXCLUDED.sport_type,
+        start_date = EXCLUDED.start_date,
+        distance = EXCLUDED.distance,
+        moving_time = EXCLUDED.moving_time,
+        elapsed_time = EXCLUDED.elapsed_time,
+        total_elevation_gain = EXCLUDED.total_elevation_gain,
+        average_speed = EXCLUDED.average_speed,
+        summary_polyline = EXCLUDED.summary_polyline,
+        summary = EXCLUDED.summary,
+        updated_at = CURRENT_TIMESTAMP
+"""
+ACTIVITY_UPSERT_TEMPLATE = '(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s::jsonb)'
+
+def parse_strava_time(value):
+    """Strava ISO timestamp ('2023-09-11T08:00:00Z') -> naive UTC datetime"""
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).astimezone(timezone.utc).replace(tzinfo=None)
+
+def activity_row(athlete_id, activity):
+    """ACTIVITY_UPSERT_SQL row for one Strava activity object"""
+    return (
+        activity['id'],
+        athlete_id,
+        activity.get('name'),
+        activity.get('sport_type') or activity.get('type'),
+        parse_strava_time(activity['start_date']),
+        activity.get('distance'),
+        activity.get('moving_time'),
+        activity.get('elapsed_time'),
+        activity.get('total_elevation_gain'),
+        activity.get('average_speed'),
+        (activity.get('map') or {}).get('summary_polyline'),
+        json.dumps(activity),
+    )
+
+class ActivitySync:
+    """Keeps a copy of each athlete's Strava activities in PostgreSQL.
+
+    A background thread runs sync jobs (one pending job per athlete, repeated
+    requests coalesce). Each job first pulls activities newer than the
+    athlete's newest stored start time (after= cursor), then continues the
+    history backfill from the oldest stored start time (before= cursor), one
+    page of page_size activities per INSERT, at most max_pages pages per job
+    and only while the Strava quota has headroom; the cursors live in
+    activity_sync_state, so an interrupted backfill resumes where it stopped.
+
+    Access tokens are never stored: jobs carry the token of the request that
+    scheduled them. A token is resolved to its athlete only if this process
+    saw it issued by the OAuth exchange or Strava's /athlete accepted it, and
+    only until its expires_at (athletes.access_token_expires_at). Once an
+    athlete's activities cover a request, the proxy answers it from the
+    database instead of Strava.
+    """
+
+    def __init__(self, client, quota, base_url, page_size=200, max_pages=10, sync_interval=300.0,
+                 backfill_headroom=0.3, max_pending=500):
+        self.client = client
+        self.quota = quota
+        self.base_url = base_url.rstrip('/')
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.sync_interval = sync_interval
+        self.backfill_headroom = backfill_headroom
+        self.max_pending = max_pending
+        self._pending = OrderedDict()  # athlete_id -> access token
+        self._details = deque()  # (access token, /activities/{id} body) to store
+        self._tokens = OrderedDict()  # token hash -> (athlete_id or None, expires as time.time())
+        self._access = OrderedDict()  # athlete_id -> (access token, expires), только в памяти - для вебхуков
+        self._cond = threading.Condition()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stopping = False
+        self._counters = defaultdict(int)
+
+    def _count(self, name, value=1):
+        with self._cond:
+            self._counters[name] += value
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name='activity-sync', daemon=True)
+                self._thread.start()
+
+    @staticmethod
+    def _token_hash(token):
+        # Тот же хэш, что пишется в athletes.access_token_hash
+        return hashlib.sha256(token.encode()).hexdigest()[:16]
+
+    def remember(self, token, athlete_id, expires_at=None):
+        """Map a token to its athlete until expires_at (epoch seconds; called after the OAuth exchange)"""
+        with self._cond:
+            self._cache_token(self._token_hash(token), athlete_id, expires_at or time.time() + 6 * 3600)
+            self._remember_access(athlete_id, token, expires_at)
+
+    def _cache_token(self, key, athlete_id, expires):
+        # Вызывается под self._cond
+        self._tokens[key] = (athlete_id, expires)
+        self._tokens.move_to_end(key)
+        while len(self._tokens) > 10000:
+            self._tokens.popitem(last=False)
+
+    def _remember_access(self, athlete_id, token, expires_at=None):
+        # Вызывается под self._cond; токен Strava живёт 6 часов
+        ttl = expires_at - time.time() if expires_at else 6 * 3600
+        self._access[athlete_id] = (token, time.monotonic() + ttl)
+        self._access.move_to_end(athlete_id)
+        while len(self._access) > 10000:
+            self._access.popitem(last=False)
+
+    def token_for(self, athlete_id):
+        """A recently seen access token of the athlete, or None"""
+        with self._cond:
+            access = self._access.get(athlete_id)
+            if access is None or access[1] <= time.monotonic():
+                return None
+            return access[0]
+
+    def forget(self, athlete_id):
+        """Drop in-memory tokens and pending jobs of an athlete (deauthorization)"""
+        with self._cond:
+            self._access.pop(athlete_id, None)
+            self._pending.pop(athlete_id, None)
+            for key in [k for k, (aid, _) in self._tokens.items() if aid == athlete_id]:
+                del self._tokens[key]
+
+    def resolve(self, token):
+        """athlete_id for an access token, or None if it is unknown, expired or not confirmed by Strava"""
+        key = self._token_hash(token)
+        with self._cond:
+            cached = self._tokens.get(key)
+            if cached is not None and cached[1] > time.time():
+                return cached[0]
+        expires_at = None
+        with db_connection() as conn:
+            if conn is None:
+                return None
+            cursor = conn.cursor()
+            cursor.execute("SELECT access_token_expires_at FROM athletes WHERE access_token_hash = %s LIMIT 1", (key,))
+            row = cursor.fetchone()
+            conn.rollback()
+            if row and row[0] is not None:
+                expires_at = row[0].replace(tzinfo=timezone.utc).timestamp()
+        if expires_at is not None and expires_at <= time.time():
+            # Истёкший токен из БД данных не получает - пусть клиент обновит его через Strava
+            self._count('tokens_expired')
+            with self._cond:
+                self._cache_token(key, None, time.time() + 3600)
+            return None
+        
+        # Хэш в БД ещё не доказывает, что токен действующий (отозван, утёк) - один раз спрашиваем Strava
+        athlete_id, ttl = self._verify(token)
+        expires = time.time() + ttl
+        if athlete_id is not None and expires_at is not None:
+            expires = min(expires, expires_at)
+        with self._cond:
+            self._cache_token(key, athlete_id, expires)
+        return athlete_id
+
+    def _verify(self, token):
+        """(athlete_id or None, seconds to trust the answer) from Strava's /athlete"""
+        if self.quota.retry_after():
+            return None, 60
+        try:
+            response = self.client.request('GET', f'{self.base_url}/athlete', headers={
+                'Authorization': f'Bearer {token}',
+                'Accept': 'application/json',
+            })
+        except OutboundHTTPError as e:
+            print(f"⚠️ Strava token check failed: {e}")
+            return None, 60
+        self.quota.update(response.headers, throttled=response.status == 429)
+        if response.status in (401, 403):
+            self._count('tokens_rejected')
+            return None, 3600
+        if response.status != 200:
+            return None, 60
+        try:
+            athlete_id = json.loads(response.body).get('id')
+        except (ValueError, AttributeError):
+            return None, 60
+        self._count('tokens_verified')
+        return athlete_id, (6 * 3600 if athlete_id else 60)
+
+    def schedule(self, athlete_id, token):
+        """Queue a sync job for the athlete; False if the queue is full"""
+        if not athlete_id or not database_configured():
+            return False
+        self._ensure_started()
+        with self._cond:
+            self._remember_access(athlete_id, token)
+            if athlete_id in self._pending:
+                self._pending[athlete_id] = token
+                self._counters['coalesced'] += 1
+                return True
+            if len(self._pending) >= self.max_pending:
+                self._counters['rejected_full'] += 1
+                return False
+            self._pending[athlete_id] = token
+            self._counters['scheduled'] += 1
+            self._cond.notify()
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._details and not self._stopping:
+                    self._cond.wait(timeout=0.5)
+                if self._stopping:
+                    return
+                if self._details:
+                    # Детали короткие - не ждут, пока догрузится чья-то история
+                    detail = self._details.popleft()
+                else:
+                    detail = None
+                    athlete_id, token = self._pending.popitem(last=False)
+            if detail is not None:
+                self._save_detail(*detail)
+                continue
+            try:
+                self.sync(athlete_id, token)
+            except Exception as e:
+                self._count('failed')
+                print(f"⚠️ Activity sync failed for athlete {athlete_id}: {e}")
+
+    def _fetch_page(self, token, params):
+        """One page of /athlete/activities, or None if Strava can't be asked right now"""
+        if self.quota.retry_after():
+            return None
+        try:
+            response = self.client.request('GET', f'{self.base_url}/athlete/activities?{urlencode(params)}', headers={
+                'Authorization': f'Bearer {token}',
+                'Accept': 'application/json',
+            })
+        except OutboundHTTPError as e:
+            print(f"⚠️ Strava activities page failed: {e}")
+            self._count('page_errors')
+            return None
+        self.quota.update(response.headers, throttled=response.status == 429)
+        if response.status != 200:
+            print(f"⚠️ Strava activities page failed: {response.status}")
+            return None
+        self._count('pages')
+        return json.loads(response.body)
+
+    def sync(self, athlete_id, token):
+        """Pull new activities, then continue the backfill (bounded by max_pages and quota)"""
+        with db_connection() as conn:
+            if conn is None:
+                return
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT newest_start_date, oldest_start_date, backfill_complete
+                FROM activity_sync_state WHERE athlete_id = %s
+            """, (athlete_id,))
+            newest, oldest, complete = cursor.fetchone() or (None, None, False)
+            conn.rollback()
+            pages = 0
+            
+            # 1. Новые активности: after= самой свежей сохранённой
+            if newest is not None or complete:
+                page, latest = 1, newest
+                after = int(newest.replace(tzinfo=timezone.utc).timestamp()) if newest is not None else 0
+                while pages < self.max_pages:
+                    activities = self._fetch_page(token, {'after': after, 'page': page, 'per_page': self.page_size})
+                    if activities is None:
+                        # Курсор не двигаем; пока новое не дочитано, запросы идут в Strava, следующий заход повторит
+                        self._mark_dirty(conn, athlete_id)
+                        return
+                    pages += 1
+                    starts = [parse_strava_time(a['start_date']) for a in activities]
+                    latest = max(starts + ([latest] if latest is not None else []), default=None)
+                    self._store_page(conn, athlete_id, activities)
+                    if len(activities) < self.page_size:
+                        # Курсор двигаем только когда дочитали всё новое
+                        newest = latest
+                        self._save_state(conn, athlete_id, newest=newest)
+                        break
+                    page += 1
+            
+            # 2. История: страницами назад от самой старой сохранённой
+            while not complete and pages < self.max_pages and self.quota.headroom() >= self.backfill_headroom:
+                params = {'per_page': self.page_size}
+                if oldest is not None:
+                    params['before'] = int(oldest.replace(tzinfo=timezone.utc).timestamp())
+                activities = self._fetch_page(token, params)
+                if activities is None:
+                    return
+                pages += 1
+                self._store_page(conn, athlete_id, activities)
+                starts = [parse_strava_time(a['start_date']) for a in activities]
+                if starts:
+                    oldest = min(starts)
+                    newest = max([newest] + starts) if newest is not None else max(starts)
+                complete = len(activities) < self.page_size
+                self._save_state(conn, athlete_id, newest=newest, oldest=oldest, complete=complete)
+            
+            self._save_state(conn, athlete_id)
+            print(f"✅ Activity sync for athlete {athlete_id}: {pages} page(s){'' if complete else ', backfill continues'}")
+
+    def _store_page(self, conn, athlete_id, activities):
+        if activities:
+            cursor = conn.cursor()
+            execute_values(cursor, ACTIVITY_UPSERT_SQL, [activity_row(athlete_id, a) for a in activities],
+                           template=ACTIVITY_UPSERT_TEMPLATE, page_size=len(activities))
+            conn.commit()
+            self._count('activities_stored', len(activities))
+
+    def _save_state(self, conn, athlete_id, newest=None, oldest=None, complete=None):
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO activity_sync_state (athlete_id, newest_start_date, oldest_start_date,
+                                             backfill_complete, last_synced_at)
+            VALUES (%s, %s, %s, COALESCE(%s, FALSE), CURRENT_TIMESTAMP)
+            ON CONFLICT (athlete_id) DO UPDATE SET
+                newest_start_date = COALESCE(EXCLUDED.newest_start_date, activity_sync_state.newest_start_date),
+                oldest_start_date = COALESCE(EXCLUDED.oldest_start_date, activity_sync_state.oldest_start_date),
+                backfill_complete = COALESCE(%s, activity_sync_state.backfill_complete),
+                last_synced_at = CURRENT_TIMESTAMP,
+                updated_at = CURRENT_TIMESTAMP
+        """, (athlete_id, newest, oldest, complete, complete))
+        conn.commit()
+
+    def list_body(self, token, query):
+        """JSON body for /athlete/activities from the database, or None if it isn't covered yet"""
+        athlete_id = self.resolve(token)
+        if athlete_id is None:
+            return None
+        params = parse_qs(query)
+        try:
+            per_page = min(200, int(params.get('per_page', [STRAVA_DEFAULT_PER_PAGE])[0]))
+            offset = (max(1, int(params.get('page', ['1'])[0])) - 1) * per_page
+            before = int(params['before'][0]) if 'before' in params else None
+            after = int(params['after'][0]) if 'after' in params else None
+        except ValueError:
+            return None
+        
+        with db_connection() as conn:
+            if conn is None:
+                return None
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT backfill_complete, last_synced_at IS NULL,
+                       last_synced_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+                FROM activity_sync_state WHERE athlete_id = %s
+            """, (self.sync_interval, athlete_id))
+            state = cursor.fetchone()
+            if state is None:
+                conn.rollback()
+                self.schedule(athlete_id, token)
+                return None
+            complete, dirty, outdated = state
+            if dirty or outdated:
+                self.schedule(athlete_id, token)
+            if dirty:
+                # Вебхук сообщил о новой активности, а забрать её было нечем - до синхронизации идём в Strava
+                conn.rollback()
+                self._count('db_misses')
+                return None
+            
+            conditions, args = ['athlete_id = %s'], [athlete_id]
+            if before is not None:
+                conditions.append("start_date < to_timestamp(%s) AT TIME ZONE 'UTC'")
+                args.append(before)
+            if after is not None:
+                conditions.append("start_date > to_timestamp(%s) AT TIME ZONE 'UTC'")
+                args.append(after)
+            # Как и Strava: с after= (без before=) - по возрастанию даты
+            order = 'ASC' if after is not None and before is None else 'DESC'
+            cursor.execute(f"""
+                SELECT summary::text FROM activities
+                WHERE {' AND '.join(conditions)}
+                ORDER BY start_date {order}
+                LIMIT %s OFFSET %s
+            """, args + [per_page, offset])
+            rows = [row[0] for row in cursor.fetchall()]
+            conn.rollback()
+        
+        # Пока история не догружена, отдаём из БД только полные страницы без диапазонов дат
+        if not complete and (before is not None or after is not None or len(rows) < per_page):
+            self._count('db_misses')
+            return None
+        self._count('db_hits')
+        return ('[' + ','.join(rows) + ']').encode()
+
+    def detail_body(self, token, activity_id):
+        """JSON body for /activities/{id} from the database, or None if its details aren't stored"""
+        athlete_id = self.resolve(token)
+        if athlete_id is None:
+            return None
+        with db_connection() as conn:
+            if conn is None:
+                return None
+            cursor = conn.cursor()
+            cursor.execute("SELECT detail::text FROM activities WHERE activity_id = %s AND athlete_id = %s AND detail IS NOT NULL",
+                           (activity_id, athlete_id))
+            row = cursor.fetchone()
+            conn.rollback()
+        self._count('db_hits' if row else 'db_misses')
+        return row[0].encode() if row else None
+
+    def save_detail(self, token, body):
+        """Queue a /activities/{id} response freshly fetched through the proxy for storage; False if the queue is full"""
+        self._ensure_started()
+        with self._cond:
+            if self._stopping or len(self._details) >= self.max_pending:
+                self._counters['details_rejected'] += 1
+                return False
+            self._details.append((token, body))
+            self._cond.notify()
+        return True
+
+    def _save_detail(self, token, body):
+        try:
+            athlete_id = self.resolve(token)
+            if athlete_id is not None:
+                self._store_detail(athlete_id, body)
+        except Exception as e:
+            print(f"⚠️ Error saving activity details: {e}")
+
+    def _store_detail(self, athlete_id, body):
+        activity = json.loads(body)
+        if (activity.get('athlete') or {}).get('id') != athlete_id:
+            return  # чужая (публичная) активность - не наша копия
+        with db_connection() as conn:
+            if conn is None:
+                return
+            cursor = conn.cursor()
+            execute_values(cursor, ACTIVITY_UPSERT_SQL, [activity_row(athlete_id, activity)],
+                           template=ACTIVITY_UPSERT_TEMPLATE)
+            cursor.execute("UPDATE activities SET detail = %s::jsonb, polyline = %s WHERE activity_id = %s",
+                           (body.decode(), (activity.get('map') or {}).get('polyline'), activity['id']))
+            conn.commit()
+        self._count('details_stored')
+
+    def refresh_activity(self, athlete_id, activity_id):
+        """Re-fetch one activity from Strava; False if that failed (the athlete is marked dirty instead)"""
+        token = self.token_for(athlete_id)
+        if token is None or self.quota.retry_after():
+            self.mark_dirty(athlete_id)
+            return False
+        try:
+            response = self.client.request('GET', f'{self.base_url}/activities/{activity_id}', headers={
+                'Authorization': f'Bearer {token}',
+                'Accept': 'application/json',
+            })
+        except OutboundHTTPError as e:
+            print(f"⚠️ Strava activity {activity_id} refresh failed: {e}")
+            self.mark_dirty(athlete_id)
+            return False
+        self.quota.update(response.headers, throttled=response.status == 429)
+        if response.status == 404:
+            # Активность удалили или сделали недоступной
+            self.delete_activity(athlete_id, activity_id)
+            return True
+        if response.status != 200:
+            self.mark_dirty(athlete_id)
+            return False
+        self._store_detail(athlete_id, response.body)
+        return True
+
+    def confirm_deauthorized(self, athlete_id):
+        """Ask Strava whether the athlete really revoked access: True (token refused), False (still valid) or None (can't tell)"""
+        token = self.token_for(athlete_id)
+        if token is None or self.quota.retry_after():
+            return None
+        try:
+            response = self.client.request('GET', f'{self.base_url}/athlete', headers={
+                'Authorization': f'Bearer {token}',
+                'Accept': 'application/json',
+            })
+        except OutboundHTTPError as e:
+            print(f"⚠️ Strava deauthorization check failed: {e}")
+            return None
+        self.quota.update(response.headers, throttled=response.status == 429)
+        if response.status == 401:
+            return True
+        if response.status == 200:
+            return False
+        return None
+
+    def recheck(self, athlete_id):
+        """Unconfirmed deauthorization: serve nothing from the database until Strava accepts a token again"""
+        # Токены заново проверяются через /athlete (resolve), списки идут в Strava до следующей синхронизации
+        self.forget(athlete_id)
+        self.mark_dirty(athlete_id)
+
+    def apply_updates(self, athlete_id, activity_id, updates):
+        """Apply webhook 'updates' (title/type) directly when the activity can't be re-fetched"""
+        with db_connection() as conn:
+            if conn is None:
+                return
+            cursor = conn.cursor()
+            if 'title' in updates:
+                cursor.execute("""
+                    UPDATE activities SET name = %s, summary = jsonb_set(summary, '{name}', to_jsonb(%s::text)),
+                        detail = NULL, updated_at = CURRENT_TIMESTAMP
+                    WHERE activity_id = %s AND athlete_id = %s
+                """, (updates['title'], updates['title'], activity_id, athlete_id))
+            if 'type' in updates:
+                cursor.execute("""
+                    UPDATE activities SET sport_type = %s, detail = NULL, updated_at = CURRENT_TIMESTAMP
+                    WHERE activity_id = %s AND athlete_id = %s
+                """, (updates['type'], activity_id, athlete_id))
+            conn.commit()
+
+    def delete_activity(self, athlete_id, activity_id):
+        with db_connection() as conn:
+            if conn is None:
+                return
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM activities WHERE activity_id = %s AND athlete_id = %s", (activity_id, athlete_id))
+            conn.commit()
+        self._count('activities_deleted')
+
+    def delete_athlete(self, athlete_id):
+        """Remove all activity data of an athlete who revoked access"""
+        self.forget(athlete_id)
+        with db_connection() as conn:
+            if conn is None:
+                return
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM activities WHERE athlete_id = %s", (athlete_id,))
+            cursor.execute("DELETE FROM activity_sync_state WHERE athlete_id = %s", (athlete_id,))
+            cursor.execute("UPDATE athletes SET is_active = FALSE, access_token_hash = NULL WHERE athlete_id = %s",
+                           (athlete_id,))
+            conn.commit()
+
+    def mark_dirty(self, athlete_id):
+        """Make the next request of the athlete go to Strava and schedule a sync"""
+        with db_connection() as conn:
+            if conn is None:
+                return
+            self._mark_dirty(conn, athlete_id)
+
+    def _mark_dirty(self, conn, athlete_id):
+        cursor = conn.cursor()
+        cursor.execute("UPDATE activity_sync_state SET last_synced_at = NULL WHERE athlete_id = %s", (athlete_id,))
+        conn.commit()
+        self._count('marked_dirty')
+
+    def stop(self):
+        """Stop after the current page; pending jobs are dropped (cursors are persisted, next login resumes)"""
+        with self._cond:
+            self._stopping = True
+            self._pending.clear()
+            self._details.clear()
+            self._cond.notify_all()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(5.0)
+
+    def stats(self):
+        with self._cond:
+            return {'pending': len(self._pending), 'pending_details': len(self._details),
+                    'known_tokens': len(self._tokens), **self._counters}
+
+activity_sync = ActivitySync(
+    strava_http, strava_quota, STRAVA_API_URL,
+    max_pages=int(os.environ.get('ACTIVITY_SYNC_MAX_PAGES', '10')),
+    sync_interval=float(os.environ.get('ACTIVITY_SYNC_INTERVAL', '300')),
+    backfill_headroom=float(os.environ.get('ACTIVITY_BACKFILL_HEADROOM', '0.3')),
+)
+
+# Strava push subscription: verify_token задаётся при создании подписки
+STRAVA_WEBHOOK_VERIFY_TOKEN = os.environ.get('STRAVA_WEBHOOK_VERIFY_TOKEN', '')
+STRAVA_WEBHOOK_SUBSCRIPTION_ID = os.environ.get('STRAVA_WEBHOOK_SUBSCRIPTION_ID', '')
+
+class StravaWebhookWorker:
+    """Applies Strava push events to the stored activities in the background.
+
+    The webhook handler only validates and enqueues an event, so Strava gets
+    its 200 well within the 2-second window; a full queue answers 503 and
+    Strava retries the delivery. Nothing is deleted on the event's word
+    alone: for any activity event the activity is re-fetched with a recently
+    seen token of its owner, and only a 404 removes the row; without a token
+    the athlete is marked for re-sync (title/type changes are applied
+    directly). An athlete deauthorization removes that athlete's activity
+    data once Strava refuses their token; if that can't be checked, the
+    athlete's tokens are re-verified and nothing is served from the database
+    meanwhile. stop() processes what is queued.
+    When record_path is set, every accepted event is appended to it as
+    NDJSON, for replay with replay_webhooks.py.
+    """
+
+    def __init__(self, sync, max_queue=1000, record_path=None):
+        self.sync = sync
+        self.record_path = record_path
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name='strava-webhook', daemon=True)
+                self._thread.start()
+
+    def enqueue(self, event):
+        """Queue a validated push event; False if the queue is full"""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self._count('rejected_full')
+            return False
+        self._count('received')
+        if self.record_path:
+            try:
+                with self._lock, open(self.record_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(event) + '\n')
+            except OSError as e:
+                print(f"⚠️ Could not record webhook event: {e}")
+        return True
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                event = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            self._process(event)
+        # Дообрабатываем очередь при остановке
+        while True:
+            try:
+                event = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self._process(event)
+
+    def _process(self, event):
+        started = time.monotonic()
+        try:
+            self.process(event)
+            self._count('processed')
+        except Exception as e:
+            self._count('failed')
+            print(f"⚠️ Error processing Strava webhook event {event}: {e}")
+        with self._lock:
+            self._counters['processing_ms'] += int((time.monotonic() - started) * 1000)
+
+    def process(self, event):
+        """Apply one push event to the database"""
+        object_type, aspect = event['object_type'], event['aspect_type']
+        athlete_id, object_id = event['owner_id'], event['object_id']
+        updates = event.get('updates') or {}
+        
+        if object_type == 'athlete':
+            if str(updates.get('authorized', '')).lower() == 'false':
+                confirmed = self.sync.confirm_deauthorized(athlete_id)
+                if confirmed:
+                    self.sync.delete_athlete(athlete_id)
+                    print(f"🔒 Athlete {athlete_id} deauthorized, activity data removed")
+                elif confirmed is None:
+                    self._count('deauth_unconfirmed')
+                    self.sync.recheck(athlete_id)
+                else:
+                    self._count('forged')
+                    print(f"⚠️ Deauthorization of athlete {athlete_id} not confirmed by Strava, ignored")
+            return
+        
+        # Удаление тоже проверяем у Strava: только 404 удаляет строку. Без токена - пометка на синхронизацию
+        if self.sync.refresh_activity(athlete_id, object_id):
+            return
+        # Токена нет: что можем - применяем из самого события, остальное подтянет следующая синхронизация
+        if aspect == 'update' and updates:
+            self.sync.apply_updates(athlete_id, object_id, updates)
+
+    def stop(self, timeout=10.0):
+        self._stopping.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {'queued': self._queue.qsize(), **self._counters}
+
+def parse_webhook_event(data):
+    """Validate a Strava push event body; raises ValueError"""
+    if not isinstance(data, dict):
+        raise ValueError('Event must be a JSON object')
+    if data.get('object_type') not in ('activity', 'athlete'):
+        raise ValueError('Unknown object_type')
+    if data.get('aspect_type') not in ('create', 'update', 'delete'):
+        raise ValueError('Unknown aspect_type')
+    for field in ('object_id', 'owner_id'):
+        if not isinstance(data.get(field), int):
+            raise ValueError(f'{field} must be an integer')
+    return {name: data.get(name) for name in
+            ('object_type', 'object_id', 'aspect_type', 'owner_id', 'subscription_id', 'event_time', 'updates')}
+
+webhook_worker = StravaWebhookWorker(
+    activity_sync,
+    max_queue=int(os.environ.get('STRAVA_WEBHOOK_MAX_QUEUE', '1000')),
+    record_path=os.environ.get('STRAVA_WEBHOOK_RECORD') or None,
+)
+
+def start_background_workers():
+    """Start per-process background threads (called in each serving process)"""
+    analytics_writer.start()
+    athlete_writer.start()
+
+def shutdown_background_workers():
+    """Flush queued background work and close pooled connections (graceful shutdown)"""
+    webhook_worker.stop()
+    activity_sync.stop()
+    athlete_writer.stop()
+    analytics_writer.stop()
+    strava_proxy.close()
+    strava_http.close()
+    db_pool.close_all()
+
+def execute_sql_statements(cursor, sql_content, description="SQL"):
+    """Execute SQL statements, handling each one separately to avoid transaction issues"""
+    import re
+    
+    # Remove single-line comments (-- ...) but preserve line structure
+    lines = sql_content.split('\n')
+    cleaned_lines = []
+    for line in lines:
+        comment_pos = line.find('--')
+        if comment_pos >= 0:
+            line = line[:comment_pos]
+        cleaned_lines.append(line)
+    sql_content = '\n'.join(cleaned_lines)
+    
+    # Удаляем блоковые комментарии /* ... */ которые могут содержать MySQL синтаксис
+    sql_content = re.sub(r'/\*.*?\*/', '', sql_content, flags=re.DOTALL)
+    
+    # Split SQL into statements manually to support dollar-quoted functions
+    statements = []
+    current = []
+    in_single_quote = False
+    in_double_quote = False
+    in_dollar_quote = False
+    dollar_tag = ''
+    i = 0
+    length = len(sql_content)
+    
+    while i < length:
+        char = sql_content[i]
+        next_chars = sql_content[i:]
+        
+        # Handle start/end of dollar-quoted string ($$ or $tag$)
+        if not in_single_quote and not in_double_quote:
+            if char == '$':
+                # Attempt to match dollar tag
+                match = re.match(r'\$[A-Za-z0-9_]*\$', sql_content[i:])
+                if match:
+                    tag = match.group(0)
+                    if not in_dollar_quote:
+                        in_dollar_quote = True
+                        dollar_tag = tag
+                    elif tag == dollar_tag:
+                        in_dollar_quote = False
+                        dollar_tag = ''
+                    current.append(tag)
+                    i += len(tag)
+                    continue
+        
+        # Handle single quote strings
+        if not in_double_quote and not in_dollar_quote and char == "'":
+            if not in_single_quote:
+                in_single_quote = True
+            else:
+                # Check for escaped quote (two single quotes)
+                if i + 1 < length and sql_content[i + 1] == "'":
+                    current.append("'" * 2)
+                    i += 2
+                    continue
+                in_single_quote = False
+            current.append(char)
+            i += 1
+            continue
+        
+        # Handle double quote strings
+        if not in_single_quote and not in_dollar_quote and char == '"':
+            if not in_double_quote:
+                in_double_quote = True
+            else:
+                in_double_quote = False
+            current.append(char)
+            i += 1
+            continue
+        
+        # Statement delimiter ';' (when not inside quotes)
+        if char == ';' and not in_single_quote and not in_double_quote and not in_dollar_quote:
+            statement = ''.join(current).strip()
+            if statement:
+                statements.append(statement)
+            current = []
+            i += 1
+            continue
+        
+        current.append(char)
+        i += 1
+    
+    # Append remaining statement
+    statement = ''.join(current).strip()
+    if statement:
+        statements.append(statement)
+    
+    # Merge trailing fragments like "$$ language 'plpgsql'" with previous statement
+    merged_statements = []
+    for stmt in statements:
+        normalized = stmt.lstrip().lower()
+        if merged_statements and (
+            normalized.startswith('$$') or
+            normalized.startswith('language')
+        ):
+            merged_statements[-1] = merged_statements[-1].rstrip() + '\n' + stmt
+        else:
+            merged_statements.append(stmt)
+    statements = merged_statements
+    
+    # Execute each statement separately (autocommit is already enabled)
+    executed = 0
+    errors = 0
+    
+    for statement in statements:
+        statement = statement.strip()
+        if not statement:
+            continue
+        
+        try:
+            cursor.execute(statement)
+            executed += 1
+        except Exception as e:
+            error_msg = str(e).lower()
+            # Check if error is acceptable (object already exists)
+            if 'already exists' in error_msg or \
+               ('duplicate' in error_msg and 'key' in error_msg) or \
+               ('relation' in error_msg and 'already exists' in error_msg):
+                executed += 1  # Count as successful
+            else:
+                errors += 1
+                print(f"⚠️ {description} error: {e}")
+                # Show preview of problematic statement (first line)
+                first_line = statement.split('\n')[0][:100]
+                print(f"   First line: {first_line}...")
+    
+    return executed, errors
+
+def init_database():
+    """Initialize database with schema"""
+    conn = get_db_connection()
+    if not conn:
+        print("⚠️ No database connection, skipping DB init")
+        return
+    
+    try:
+        # Set autocommit mode to avoid transaction issues
+        conn.autocommit = True
+        cursor = conn.cursor()
+        
+        # Read main schema from file
+        schema_file = 'database_schema.sql'
+        if os.path.exists(schema_file):
+            with open(schema_file, 'r', encoding='utf-8') as f:
+                schema_sql = f.read()
+                executed, errors = execute_sql_statements(cursor, schema_sql, "Main schema")
                 print(f"✅ Main database schema: {executed} statements executed, {errors} errors")
         else:
             print("⚠️ database_schema.sql not found")
@@ -387,16 +3642,35 @@ def init_database():
         if conn:
             conn.close()
 
+# Каталоги и типы файлов в рабочем каталоге, которые не являются статикой сайта
+PRIVATE_DIRS = ('data', '__pycache__', 'node_modules')
+PRIVATE_SUFFIXES = ('.py', '.pyc', '.sqlite3', '.sqlite3-wal', '.sqlite3-shm', '.ndjson', '.sh', '.env')
+
+def is_private_path(path):
+    """True if a request path points into data/, at a dotfile or source/data file, or escapes the tree"""
+    segments = [segment for segment in unquote(path).replace('\\', '/').split('/') if segment]
+    if segments and segments[0] == 'route':
+        segments = segments[1:]
+    if not segments:
+        return False
+    if segments[0] in PRIVATE_DIRS:
+        return True
+    if any(segment.startswith('.') for segment in segments):
+        return True  # dot-файлы и каталоги (.git, .env), а также '..'
+    return segments[-1].lower().endswith(PRIVATE_SUFFIXES)
+
+# Сколько обратных прокси перед сервером дописывают адрес в X-Forwarded-For (Railway / nginx - один).
+# Левые элементы заголовка присылает сам клиент, доверять можно только последним TRUSTED_PROXY_COUNT.
+TRUSTED_PROXY_COUNT = max(0, int(os.environ.get('TRUSTED_PROXY_COUNT', '1')))
+
 def get_client_ip(handler):
-    """Get client IP address from request headers"""
-    # Check for forwarded headers (proxy/load balancer)
-    forwarded_for = handler.headers.get('X-Forwarded-For')
+    """Get client IP address: the X-Forwarded-For hop appended by the outermost trusted proxy, else the socket address"""
+    forwarded_for = handler.headers.get('X-Forwarded-For') if TRUSTED_PROXY_COUNT else None
     if forwarded_for:
-        return forwarded_for.split(',')[0].strip()
-    
-    real_ip = handler.headers.get('X-Real-IP')
-    if real_ip:
-        return real_ip
+        hops = [hop.strip() for hop in forwarded_for.split(',') if hop.strip()]
+        if hops:
+            # Короче ожидаемого - значит, крайний левый адрес уже записал наш прокси
+            return hops[-min(TRUSTED_PROXY_COUNT, len(hops))]
     
     # Fallback to direct connection
     return handler.client_address[0] if handler.client_address else 'unknown'
@@ -503,11 +3777,461 @@ console.log('🔑 Config injected - CLIENT_ID:', window.CONFIG.STRAVA.CLIENT_ID
         # Return original HTML if config injection fails
         return html_content
 
+# Content-codings in order of preference and the files worth compressing
+CONTENT_ENCODINGS = ('br', 'gzip') if BROTLI_AVAILABLE else ('gzip',)
+COMPRESSIBLE_EXTENSIONS = ('.html', '.css', '.js', '.svg', '.json', '.txt')
+PRELOAD_EXTENSIONS = ('.html', '.css', '.js', '.svg')
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))
+# Binary files from this size are not held in memory but sent with sendfile()
+SENDFILE_MIN_SIZE = int(os.environ.get('SENDFILE_MIN_SIZE', str(64 * 1024)))
+
+def compress_body(body, encoding, static=False):
+    """Compress bytes; static assets get the slow maximum level since it's done once"""
+    if encoding == 'br':
+        return brotli.compress(body, quality=11 if static else 5)
+    return gzip.compress(body, compresslevel=9 if static else 6, mtime=0)
+
+def negotiate_encoding(accept_encoding, available):
+    """Pick the best content-coding from `available` for an Accept-Encoding header (None = identity)"""
+    if not accept_encoding or not available:
+        return None
+    
+    accepted = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.partition(';')
+        q = 1.0
+        params = params.strip().lower()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    
+    best, best_q = None, 0.0
+    for encoding in CONTENT_ENCODINGS:
+        if encoding not in available:
+            continue
+        q = accepted.get(encoding, accepted.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+CachedAsset = namedtuple('CachedAsset', ['body', 'etag', 'mtime_ns', 'size', 'last_modified', 'variants', 'memory'])
+
+def build_cached_asset(body, mtime_ns, compressible):
+    """Build a CachedAsset with a strong ETag and (for text) precompressed variants"""
+    etag = '"%s"' % hashlib.blake2b(body, digest_size=12).hexdigest()
+    
+    variants = {}
+    if compressible and len(body) >= COMPRESSION_MIN_SIZE:
+        for encoding in CONTENT_ENCODINGS:
+            compressed = compress_body(body, encoding, static=True)
+            # Не храним вариант, если он почти не меньше оригинала
+            if len(compressed) < len(body) * 0.95:
+                variants[encoding] = (compressed, f'{etag[:-1]}-{encoding}"')
+    
+    return CachedAsset(
+        body,
+        etag,
+        mtime_ns,
+        len(body),
+        formatdate(mtime_ns / 1_000_000_000, usegmt=True),
+        variants,
+        len(body) + sum(len(data) for data, _ in variants.values()),
+    )
+
+class StaticAssetCache:
+    """In-memory LRU cache of static file bytes keyed by path.
+
+    Entries carry a strong ETag (content hash) and the file mtime, and are
+    reloaded whenever the file's mtime or size changes. Text assets also get
+    precompressed variants ({encoding: (bytes, etag)}) built once on load.
+    Large binary files (>= SENDFILE_MIN_SIZE) keep only their validators and
+    files larger than max_entry_bytes are not cached at all; for both the body
+    is None and the caller streams from disk.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_entry_bytes=4 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+
+    def get(self, path):
+        """Return a CachedAsset for path, loading or refreshing it if needed"""
+        st = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry.mtime_ns == st.st_mtime_ns and entry.size == st.st_size:
+                self._entries.move_to_end(path)
+                self._counters['hits'] += 1
+                return entry
+        
+        last_modified = formatdate(st.st_mtime, usegmt=True)
+        if st.st_size > self.max_entry_bytes:
+            with self._lock:
+                self._counters['uncached'] += 1
+            return CachedAsset(None, f'"{st.st_size:x}-{st.st_mtime_ns:x}"', st.st_mtime_ns, st.st_size,
+                               last_modified, {}, 0)
+        
+        with open(path, 'rb') as f:
+            body = f.read()
+            st = os.fstat(f.fileno())
+        compressible = path.lower().endswith(COMPRESSIBLE_EXTENSIONS)
+        entry = build_cached_asset(body, st.st_mtime_ns, compressible)
+        if not compressible and entry.size >= SENDFILE_MIN_SIZE:
+            # Держим только ETag, сами байты отдаёт sendfile() с диска
+            entry = entry._replace(body=None, memory=0)
+        
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self._bytes -= old.memory
+                self._counters['reloads'] += 1
+            else:
+                self._counters['misses'] += 1
+            self._entries[path] = entry
+            self._bytes += entry.memory
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.memory
+                self._counters['evictions'] += 1
+        return entry
+
+    def preload(self, root='.'):
+        """Load and precompress text assets ahead of the first request"""
+        loaded = 0
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.') and d not in ('data', '__pycache__', 'node_modules')]
+            for filename in filenames:
+                if not filename.lower().endswith(PRELOAD_EXTENSIONS):
+                    continue
+                try:
+                    self.get(os.path.relpath(os.path.join(dirpath, filename), root))
+                    loaded += 1
+                except OSError as e:
+                    print(f"⚠️ Could not preload {filename}: {e}")
+        return loaded
+
+    def stats(self):
+        """Snapshot of cache usage counters"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update({'entries': len(self._entries), 'bytes': self._bytes, 'max_bytes': self.max_bytes,
+                          'encodings': list(CONTENT_ENCODINGS)})
+        return stats
+
+static_cache = StaticAssetCache(
+    max_bytes=int(float(os.environ.get('STATIC_CACHE_MAX_MB', '32')) * 1024 * 1024),
+    max_entry_bytes=int(float(os.environ.get('STATIC_CACHE_MAX_FILE_MB', '4')) * 1024 * 1024),
+)
+
+def config_fingerprint():
+    """Values that inject_config() output depends on (server_config.py + env)"""
+    try:
+        st = os.stat('server_config.py')
+        config_file = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        config_file = None
+    return (
+        config_file,
+        os.environ.get('STRAVA_CLIENT_ID'),
+        os.environ.get('STRAVA_CLIENT_SECRET'),
+        os.environ.get('ENVIRONMENT'),
+        os.environ.get('RAILWAY_ENVIRONMENT'),
+    )
+
+class InjectedPageCache:
+    """Config-injected HTML pages (index.html) kept ready to send.
+
+    A page is rebuilt only when its file's mtime/size or config_fingerprint()
+    changes; the injected HTML is encoded, hashed and compressed once per build.
+    """
+
+    def __init__(self):
+        self._entries = {}  # path -> (key, CachedAsset)
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+
+    def get(self, path):
+        """Return the CachedAsset for the injected page at path"""
+        st = os.stat(path)
+        fingerprint = config_fingerprint()
+        key = (st.st_mtime_ns, st.st_size, fingerprint)
+        
+        cached = self._entries.get(path)
+        if cached is not None and cached[0] == key:
+            self._counters['hits'] += 1
+            return cached[1]
+        
+        with self._lock:
+            cached = self._entries.get(path)
+            if cached is not None and cached[0] == key:
+                return cached[1]
+            
+            # server_config.py изменился - перечитываем модуль
+            if cached is not None and cached[0][2][0] != fingerprint[0] and 'server_config' in sys.modules:
+                try:
+                    importlib.reload(sys.modules['server_config'])
+                except Exception as e:
+                    print(f"⚠️ Could not reload server_config: {e}")
+            
+            with open(path, 'r', encoding='utf-8') as f:
+                html_content = inject_config(f.read())
+            # Last-Modified = build time, since config changes don't touch the file mtime
+            entry = build_cached_asset(html_content.encode('utf-8'), time.time_ns(), True)
+            self._entries[path] = (key, entry)
+            self._counters['builds'] += 1
+            return entry
+
+    def invalidate(self):
+        """Drop all built pages (e.g. after a config reload)"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'pages': len(self._entries), **self._counters}
+
+injected_pages = InjectedPageCache()
+
+# Браузер хранит статику, но перепроверяет её через ETag/Last-Modified
+STATIC_CACHE_CONTROL = f"public, max-age={int(os.environ.get('STATIC_MAX_AGE', '0'))}, must-revalidate"
+
+def parse_rate_limit(value, default):
+    """Parse a 'requests/minute' env value into (capacity, refill per second)"""
+    try:
+        per_minute = float(value) if value else default
+    except ValueError:
+        per_minute = default
+    per_minute = max(1.0, per_minute)
+    return per_minute, per_minute / 60.0
+
+class RateLimitStore(abc.ABC):
+    """Storage backend interface for TokenBucketRateLimiter.
+
+    take(key, capacity, rate, now) must atomically refill the bucket stored
+    under key (rate tokens/second, at most capacity) and consume one token,
+    returning True if one was available. `now` is time.monotonic(); a store
+    shared between hosts should use its own clock instead. Any object with
+    this interface can be plugged in via RATE_LIMIT_BACKEND=module:Class.
+    """
+
+    name = 'base'
+
+    @abc.abstractmethod
+    def take(self, key, capacity, rate, now):
+        """Refill and consume one token; True if the request is allowed"""
+
+    def stats(self):
+        return {'backend': self.name}
+
+class LocalBucketStore(RateLimitStore):
+    """In-process dict of [tokens, last_refill] with periodic eviction of idle buckets"""
+
+    name = 'local'
+
+    def __init__(self, sweep_interval=60.0):
+        self.sweep_interval = sweep_interval
+        self._buckets = {}  # key -> [tokens, last_refill, capacity, rate]
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + sweep_interval
+        self._evicted = 0
+
+    def take(self, key, capacity, rate, now):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [capacity, now, capacity, rate]
+            else:
+                bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            
+            allowed = bucket[0] >= 1.0
+            if allowed:
+                bucket[0] -= 1.0
+            
+            if now >= self._next_sweep:
+                self._sweep(now)
+        return allowed
+
+    def _sweep(self, now):
+        """Drop buckets that would be full by now (caller holds the lock)"""
+        idle = [key for key, (tokens, last, capacity, rate) in self._buckets.items()
+                if tokens + (now - last) * rate >= capacity]
+        for key in idle:
+            del self._buckets[key]
+        self._evicted += len(idle)
+        self._next_sweep = now + self.sweep_interval
+
+    def stats(self):
+        with self._lock:
+            return {'backend': self.name, 'buckets': len(self._buckets), 'evicted': self._evicted}
+
+class SharedMemoryBucketStore(RateLimitStore):
+    """Token buckets in a shared mmap of an unlinked temp file, visible to all forked workers.
+
+    Must be created before forking. The table is set-associative: a key hashes
+    to one group of `ways` slots guarded by one of `lock_stripes` stripes, so
+    workers only contend when they hit the same stripe. A stripe is an
+    fcntl.lockf() lock on one byte of the file (between processes; the kernel
+    drops it when its owner dies, so a killed worker can't wedge the others)
+    plus a threading.Lock (between threads of one process, which lockf
+    doesn't separate). A slot is (key hash, tokens, last_refill); when a group
+    is full the slot with the oldest refill time is recycled, which at worst
+    resets an idle client.
+    """
+
+    name = 'shared'
+    SLOT = struct.Struct('<Qdd')
+
+    def __init__(self, slots=65536, ways=8, lock_stripes=64):
+        self.ways = ways
+        self.groups = max(1, slots // ways)
+        size = self.groups * ways * self.SLOT.size
+        self._file = tempfile.TemporaryFile(prefix='ratelimit-')
+        os.ftruncate(self._file.fileno(), size)
+        self._mm = mmap.mmap(self._file.fileno(), size, flags=mmap.MAP_SHARED)
+        self._locks = [threading.Lock() for _ in range(lock_stripes)]
+
+    @contextmanager
+    def _stripe(self, index):
+        with self._locks[index]:
+            fcntl.lockf(self._file, fcntl.LOCK_EX, 1, index)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._file, fcntl.LOCK_UN, 1, index)
+
+    def _hash(self, key):
+        # Ненулевой 64-битный хэш, одинаковый во всех процессах (в отличие от hash())
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+
+    def take(self, key, capacity, rate, now):
+        key_hash = self._hash(key)
+        group = key_hash % self.groups
+        base = group * self.ways * self.SLOT.size
+        size = self.SLOT.size
+        
+        with self._stripe(group % len(self._locks)):
+            target = None
+            oldest_offset, oldest_last = None, None
+            for way in range(self.ways):
+                offset = base + way * size
+                slot_hash, tokens, last = self.SLOT.unpack_from(self._mm, offset)
+                if slot_hash == key_hash:
+                    target = offset
+                    tokens = min(capacity, tokens + (now - last) * rate)
+                    break
+                if slot_hash == 0:
+                    last = float('-inf')
+                if oldest_last is None or last < oldest_last:
+                    oldest_offset, oldest_last = offset, last
+            
+            if target is None:
+                target, tokens = oldest_offset, capacity
+            
+            allowed = tokens >= 1.0
+            if allowed:
+                tokens -= 1.0
+            self.SLOT.pack_into(self._mm, target, key_hash, tokens, now)
+        return allowed
+
+    def stats(self):
+        return {'backend': self.name, 'slots': self.groups * self.ways, 'lock_stripes': len(self._locks)}
+
+def load_rate_limit_store(spec, prefork=False):
+    """Build the store named by RATE_LIMIT_BACKEND: auto, local, shared or module:Class"""
+    spec = (spec or 'auto').strip()
+    if spec == 'auto':
+        spec = 'shared' if prefork else 'local'
+    if spec == 'local':
+        return LocalBucketStore()
+    if spec == 'shared':
+        if not hasattr(mmap, 'MAP_SHARED') or fcntl is None:
+            print("⚠️ Shared-memory rate limiting needs mmap.MAP_SHARED and fcntl, using local store")
+            return LocalBucketStore()
+        return SharedMemoryBucketStore(slots=int(os.environ.get('RATE_LIMIT_SHARED_SLOTS', '65536')))
+    
+    module_name, _, class_name = spec.partition(':')
+    store_class = getattr(importlib.import_module(module_name), class_name)
+    return store_class()
+
+class TokenBucketRateLimiter:
+    """Per-route token buckets per client with constant-time checks.
+
+    Bucket state lives in a RateLimitStore: a local dict by default, shared
+    memory across pre-forked workers, or an external store. Counters are kept
+    per process.
+    """
+
+    def __init__(self, limits, store=None):
+        self.limits = limits  # route -> (capacity, tokens per second)
+        self.store = store or LocalBucketStore()
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+
+    def allow(self, route, client):
+        """Take one token for client on route; False when the bucket is empty"""
+        capacity, rate = self.limits.get(route) or self.limits['default']
+        try:
+            allowed = self.store.take(f'{route}:{client}', capacity, rate, time.monotonic())
+        except Exception as e:
+            # Недоступное внешнее хранилище не должно ронять сайт - пропускаем запрос
+            print(f"⚠️ Rate limit store error: {e}")
+            allowed = True
+        with self._lock:
+            self._counters[f'{route}_allowed' if allowed else f'{route}_limited'] += 1
+        return allowed
+
+    def stats(self):
+        """Snapshot of limiter counters"""
+        with self._lock:
+            stats = dict(self._counters)
+        stats.update(self.store.stats())
+        stats['limits_per_minute'] = {route: round(rate * 60) for route, (_, rate) in self.limits.items()}
+        return stats
+
+# Лимиты в запросах в минуту на IP: статика дешёвая, обмен токена - дорогой
+rate_limiter = TokenBucketRateLimiter({
+    'static': parse_rate_limit(os.environ.get('RATE_LIMIT_STATIC'), 300),
+    'api': parse_rate_limit(os.environ.get('RATE_LIMIT_API'), 100),
+    'token': parse_rate_limit(os.environ.get('RATE_LIMIT_TOKEN'), 10),
+    # Все события Strava приходят с небольшого набора адресов
+    'webhook': parse_rate_limit(os.environ.get('RATE_LIMIT_WEBHOOK'), 600),
+    'default': parse_rate_limit(os.environ.get('RATE_LIMIT_DEFAULT'), 100),
+})
+
+def get_server_metrics():
+    """Collect runtime counters for the admin metrics endpoint"""
+    return {
+        'db_pool': db_pool.stats(),
+        'static_cache': static_cache.stats(),
+        'injected_pages': injected_pages.stats(),
+        'rate_limiter': rate_limiter.stats(),
+        'analytics_writer': analytics_writer.stats(),
+        'analytics_spool': analytics_spool.stats(),
+        'analytics_rollup': analytics_rollup.stats(),
+        'analytics_sketches': analytics_sketches.stats(),
+        'stats_cache': stats_cache.stats(),
+        'athlete_store': athlete_store.stats(),
+        'athlete_writer': athlete_writer.stats(),
+        'strava_http': strava_http.stats(),
+        'strava_quota': strava_quota.stats(),
+        'strava_proxy': strava_proxy.stats(),
+        'activity_sync': activity_sync.stats(),
+        'strava_webhook': webhook_worker.stats(),
+        'db_breaker': db_breaker.stats(),
+    }
+
 class ProductionHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
-    # Rate limiting storage
-    rate_limit_store = defaultdict(list)
-    RATE_LIMIT_WINDOW = 60  # seconds
-    RATE_LIMIT_MAX_REQUESTS = 100  # max requests per window
+    # Socket timeout so an idle or slow client can't hold a worker thread forever
+    timeout = int(os.environ.get('REQUEST_TIMEOUT', '30'))
+    
+    # Cache-Control override for the current response (None = no-store)
+    _cache_control = None
     
     def end_headers(self):
         # Get origin for CORS
@@ -565,9 +4289,13 @@ class ProductionHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
             self.send_header('Strict-Transport-Security', 'max-age=31536000; includeSubDomains')
         
         # Cache control
-        self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
-        self.send_header('Pragma', 'no-cache')
-        self.send_header('Expires', '0')
+        if self._cache_control:
+            self.send_header('Cache-Control', self._cache_control)
+            self._cache_control = None
+        else:
+            self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
+            self.send_header('Pragma', 'no-cache')
+            self.send_header('Expires', '0')
         
         super().end_headers()
 
@@ -587,22 +4315,38 @@ class ProductionHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
             return
         
         # Admin API endpoint
-        if self.path == '/api/admin/users':
+        admin_path = urlparse(self.path).path
+        if admin_path == '/api/admin/users':
             self.handle_admin_users()
             return
+        if admin_path == '/api/admin/users/export':
+            self.handle_admin_users_export()
+            return
+        
+        # Admin metrics endpoint (pool usage etc.)
+        if self.path == '/api/admin/metrics':
+            self.send_body(json.dumps(get_server_metrics()).encode(), 'application/json')
+            return
+        
+        # Strava push subscription validation (hub.challenge)
+        if self.path.split('?')[0] in ('/api/strava/webhook', '/route/api/strava/webhook'):
+            self.handle_strava_webhook()
+            return
+        
+        # Strava API proxy (cached per athlete, see StravaProxy)
+        if self.path.startswith('/api/strava/v3/') or self.path.startswith('/route/api/strava/v3/'):
+            self.handle_strava_proxy()
+            return
+        
+        # Analytics stats API (summary, or range via ?from=&to=&club_id=&granularity=)
+        if self.path.startswith('/api/analytics/') or self.path.startswith('/route/api/analytics/'):
+            self.handle_analytics_api()
+            return
         
         # Support page endpoint
         if self.path == '/support':
             try:
-                with open('support.html', 'r', encoding='utf-8') as f:
-                    html_content = f.read()
-                
-                # Send response
-                self.send_response(200)
-                self.send_header('Content-Type', 'text/html; charset=utf-8')
-                self.send_header('Content-Length', len(html_content.encode('utf-8')))
-                self.end_headers()
-                self.wfile.write(html_content.encode('utf-8'))
+                self.send_static_file('support.html', 'text/html; charset=utf-8')
                 print(f"✅ Served support page via /support endpoint")
                 return
             except Exception as e:
@@ -613,15 +4357,7 @@ class ProductionHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         # Landing page on root domain
         if self.path == '/' or self.path == '/index.html':
             try:
-                with open('landing.html', 'r', encoding='utf-8') as f:
-                    html_content = f.read()
-                
-                # Send response
-                self.send_response(200)
-                self.send_header('Content-Type', 'text/html; charset=utf-8')
-                self.send_header('Content-Length', len(html_content.encode('utf-8')))
-                self.end_headers()
-                self.wfile.write(html_content.encode('utf-8'))
+                self.send_static_file('landing.html', 'text/html; charset=utf-8')
                 return
             except Exception as e:
                 print(f"❌ Error serving landing page: {e}")
@@ -630,23 +4366,18 @@ class ProductionHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         # Application on /route/ path
         if self.path == '/route/' or self.path == '/route' or self.path == '/route/index.html':
             try:
-                with open('index.html', 'r', encoding='utf-8') as f:
-                    html_content = f.read()
-                
-                # Inject configuration
-                html_content = inject_config(html_content)
-                
-                # Send response
-                self.send_response(200)
-                self.send_header('Content-Type', 'text/html; charset=utf-8')
-                self.send_header('Content-Length', len(html_content.encode('utf-8')))
-                self.end_headers()
-                self.wfile.write(html_content.encode('utf-8'))
+                # Config-injected page is built once and served from memory
+                self.send_cached_asset(injected_pages.get('index.html'), 'text/html; charset=utf-8')
                 return
             except Exception as e:
                 print(f"❌ Error injecting config: {e}")
                 # Fallback to default handling
         
+        # Служебные файлы (данные, исходники, dot-файлы) не раздаём ни по /route/, ни напрямую
+        if is_private_path(self.path.split('?')[0]):
+            self.send_error(404, 'File Not Found')
+            return
+        
         # Handle /route/ paths for application files and static assets
         if self.path.startswith('/route/'):
             # Remove /route/ prefix and serve from root
@@ -693,18 +4424,12 @@ class ProductionHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
                 # Now we know it's a file, serve it
                 # Handle HTML files
                 if file_path.endswith('.html'):
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        html_content = f.read()
-                    
                     # Inject config for index.html
                     if file_path == 'index.html' or file_path.endswith('/index.html') or file_path.endswith('\\index.html'):
-                        html_content = inject_config(html_content)
+                        self.send_cached_asset(injected_pages.get(file_path), 'text/html; charset=utf-8')
+                        return
                     
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'text/html; charset=utf-8')
-                    self.send_header('Content-Length', len(html_content.encode('utf-8')))
-                    self.end_headers()
-                    self.wfile.write(html_content.encode('utf-8'))
+                    self.send_static_file(file_path, 'text/html; charset=utf-8')
                     return
                 else:
                     # Handle static files (CSS, JS, images, etc.)
@@ -725,15 +4450,8 @@ class ProductionHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
                     elif file_path.endswith('.json'):
                         mime_type = 'application/json'
                     
-                    # Read and serve file (we already verified it's a file above)
-                    with open(file_path, 'rb') as f:
-                        file_content = f.read()
-                    
-                    self.send_response(200)
-                    self.send_header('Content-Type', mime_type)
-                    self.send_header('Content-Length', len(file_content))
-                    self.end_headers()
-                    self.wfile.write(file_content)
+                    # Serve from the in-memory cache (we already verified it's a file above)
+                    self.send_static_file(file_path, mime_type)
                     print(f"✅ Served /route/ file: {file_path}")
                     return
             except Exception as e:
@@ -750,15 +4468,7 @@ class ProductionHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
                 print(f"🔍 Looking for HTML file: {filename}")
                 if os.path.exists(filename):
                     print(f"✅ Found HTML file: {filename}")
-                    with open(filename, 'r', encoding='utf-8') as f:
-                        html_content = f.read()
-                    
-                    # Send response
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'text/html; charset=utf-8')
-                    self.send_header('Content-Length', len(html_content.encode('utf-8')))
-                    self.end_headers()
-                    self.wfile.write(html_content.encode('utf-8'))
+                    self.send_static_file(filename, 'text/html; charset=utf-8')
                     print(f"✅ Served HTML file: {filename}")
                     return
                 else:
@@ -771,6 +4481,13 @@ class ProductionHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         # Продолжаем как обычно
         super().do_GET()
     
+    def do_HEAD(self):
+        """HEAD for static files (private paths are hidden like in do_GET)"""
+        if is_private_path(self.path.split('?')[0]):
+            self.send_error(404, 'File Not Found')
+            return
+        super().do_HEAD()
+    
     def do_POST(self):
         """Handle POST requests with rate limiting"""
         # Rate limiting check
@@ -784,6 +4501,9 @@ class ProductionHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         # Analytics API endpoints
         elif self.path.startswith('/api/analytics/') or self.path.startswith('/route/api/analytics/'):
             self.handle_analytics_api()
+        # Strava push events
+        elif self.path.split('?')[0] in ('/api/strava/webhook', '/route/api/strava/webhook'):
+            self.handle_strava_webhook()
         else:
             self.send_error(404, 'Not Found')
 
@@ -792,29 +4512,273 @@ class ProductionHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         self.send_response(200)
         self.end_headers()
 
+    def rate_limit_route(self):
+        """Classify the request for per-route rate limits"""
+        path = self.path.split('?')[0]
+        if path.endswith('/api/strava/token'):
+            return 'token'
+        if path.endswith('/api/strava/webhook'):
+            return 'webhook'
+        if path.startswith('/api/') or path.startswith('/route/api/'):
+            return 'api'
+        return 'static'
+
     def check_rate_limit(self):
         """Check if request is within rate limit"""
-        # Получаем IP клиента
-        client_ip = self.client_address[0]
+        # Реальный IP клиента (за прокси Railway client_address - это прокси)
+        client_ip = get_client_ip(self)
+        route = self.rate_limit_route()
         
-        # Получаем текущее время
-        now = time.time()
+        if not rate_limiter.allow(route, client_ip):
+            print(f"⚠️ Rate limit exceeded for {client_ip} ({route})")
+            return False
+        return True
+
+    def send_static_file(self, file_path, mime_type):
+        """Serve a file from static_cache with validators and Accept-Encoding negotiation"""
+        self.send_cached_asset(static_cache.get(file_path), mime_type, file_path)
+
+    def send_cached_asset(self, asset, mime_type, file_path=None, cache_control=STATIC_CACHE_CONTROL):
+        """Send a CachedAsset (304 when the client copy is current); file_path streams uncached bodies"""
+        # Range requests are answered from the identity representation
+        range_header = self.headers.get('Range')
+        encoding = None
+        if not range_header:
+            encoding = negotiate_encoding(self.headers.get('Accept-Encoding', ''), asset.variants)
+        body, etag = asset.variants[encoding] if encoding else (asset.body, asset.etag)
+        length = len(body) if body is not None else asset.size
         
-        # Очищаем старые записи
-        self.rate_limit_store[client_ip] = [
-            req_time for req_time in self.rate_limit_store[client_ip]
-            if now - req_time < self.RATE_LIMIT_WINDOW
-        ]
+        self._cache_control = cache_control
+        if self.check_not_modified(etag, asset.mtime_ns):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', asset.last_modified)
+            if asset.variants:
+                self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            return
         
-        # Проверяем лимит
-        if len(self.rate_limit_store[client_ip]) >= self.RATE_LIMIT_MAX_REQUESTS:
-            print(f"⚠️ Rate limit exceeded for {client_ip}")
-            return False
+        start, end = 0, length - 1
+        byte_range = None
+        if range_header and self.check_if_range(etag, asset.last_modified):
+            byte_range = self.parse_range(range_header, length)
+            if byte_range == 'unsatisfiable':
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{length}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
         
-        # Добавляем текущий запрос
-        self.rate_limit_store[client_ip].append(now)
-        return True
+        if byte_range:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{length}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', mime_type)
+        self.send_header('Content-Length', end - start + 1)
+        self.send_header('Accept-Ranges', 'bytes')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        if asset.variants:
+            self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', asset.last_modified)
+        self.end_headers()
+        if end < start:
+            return
+        if body is not None:
+            self.wfile.write(memoryview(body)[start:end + 1])
+        else:
+            with open(file_path, 'rb') as f:
+                self.send_file_range(f, start, end - start + 1)
+
+    def send_file_range(self, f, offset, count):
+        """Copy part of an open file to the client, zero-copy via sendfile() when on a real socket"""
+        connection = getattr(self, 'connection', None)
+        if connection is not None and hasattr(connection, 'sendfile'):
+            self.wfile.flush()
+            connection.sendfile(f, offset, count)
+            return
+        if hasattr(self.wfile, 'sendfile'):
+            # Asyncio engine: loop.sendfile() on the transport
+            self.wfile.sendfile(f, offset, count)
+            return
+        
+        # In-memory wfile: plain buffered copy
+        f.seek(offset)
+        remaining = count
+        while remaining > 0:
+            chunk = f.read(min(remaining, 64 * 1024))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            remaining -= len(chunk)
+
+    def parse_range(self, range_header, length):
+        """Parse a single 'bytes=' range; returns (start, end), None to ignore it or 'unsatisfiable'"""
+        unit, _, spec = range_header.partition('=')
+        if unit.strip().lower() != 'bytes' or ',' in spec:
+            # Multipart ranges are not supported - fall back to the full body
+            return None
+        first, sep, last = spec.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if first == '':
+                suffix = int(last)
+                if suffix <= 0:
+                    return 'unsatisfiable'
+                start, end = max(0, length - suffix), length - 1
+            else:
+                start = int(first)
+                end = int(last) if last else length - 1
+        except ValueError:
+            return None
+        if start >= length:
+            return 'unsatisfiable'
+        if start > end:
+            # Invalid range-spec (last-pos < first-pos) is ignored
+            return None
+        return start, min(end, length - 1)
+
+    def check_if_range(self, etag, last_modified):
+        """If-Range: only honour Range when the client's validator still matches (strong comparison)"""
+        if_range = self.headers.get('If-Range')
+        if not if_range:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            return if_range == etag
+        return if_range == last_modified
+
+    def send_body(self, body, content_type, status=200):
+        """Send an in-memory response, compressing it on the fly above COMPRESSION_MIN_SIZE"""
+        encoding = None
+        negotiable = len(body) >= COMPRESSION_MIN_SIZE
+        if negotiable:
+            encoding = negotiate_encoding(self.headers.get('Accept-Encoding', ''), CONTENT_ENCODINGS)
+            if encoding:
+                body = compress_body(body, encoding)
+        
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', len(body))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        if negotiable:
+            self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def check_not_modified(self, etag, mtime_ns):
+        """Evaluate If-None-Match / If-Modified-Since against the current validators"""
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            # If-None-Match wins over If-Modified-Since (RFC 9110, weak comparison)
+            if if_none_match.strip() == '*':
+                return True
+            candidates = [tag.strip() for tag in if_none_match.split(',')]
+            bare_etag = etag[2:] if etag.startswith('W/') else etag
+            return any((tag[2:] if tag.startswith('W/') else tag) == bare_etag for tag in candidates)
+        
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                since = parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError, IndexError):
+                return False
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=timezone.utc)
+            return int(mtime_ns // 1_000_000_000) <= since.timestamp()
+        return False
 
+    def handle_strava_proxy(self):
+        """Proxy GET /api/strava/v3/<endpoint> to Strava through strava_proxy"""
+        parsed = urlparse(self.path)
+        api_path = parsed.path[parsed.path.index('/api/strava/v3') + len('/api/strava/v3'):]
+        route = strava_proxy_route(api_path, parsed.query)
+        if route is None:
+            self.send_body(json.dumps({'error': 'Unsupported Strava endpoint'}).encode(), 'application/json', status=404)
+            return
+        
+        authorization = self.headers.get('Authorization', '')
+        if not authorization.startswith('Bearer ') or not authorization[7:].strip():
+            self.send_body(json.dumps({'error': 'Missing Strava access token'}).encode(), 'application/json', status=401)
+            return
+        
+        ttl, query = route
+        token = authorization[7:].strip()
+        activity_id = None if api_path == '/athlete/activities' else int(api_path.rsplit('/', 1)[1])
+        
+        # Синхронизированные активности отдаём из БД, Strava не трогаем
+        if database_configured() and not db_breaker.is_open:
+            try:
+                body = (activity_sync.list_body(token, query) if activity_id is None
+                        else activity_sync.detail_body(token, activity_id))
+            except Exception as e:
+                print(f"⚠️ Error reading activities from DB: {e}")
+                body = None
+            if body is not None:
+                self._cache_control = STATS_CACHE_CONTROL
+                self.send_body(body, 'application/json')
+                return
+        
+        result = strava_proxy.get(token, api_path, query, ttl)
+        if result.status == 200:
+            if result.fresh and activity_id is not None and database_configured():
+                # Сохраняет фоновый поток: запрос не ждёт ни БД, ни проверки токена в Strava
+                activity_sync.save_detail(token, result.asset.body)
+            self.send_cached_asset(result.asset, 'application/json', cache_control=STATS_CACHE_CONTROL)
+            return
+        
+        self.send_response(result.status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(result.asset.body)))
+        if result.retry_after:
+            self.send_header('Retry-After', str(result.retry_after))
+        self.end_headers()
+        self.wfile.write(result.asset.body)
+    
+    def handle_strava_webhook(self):
+        """Strava push subscription: GET answers the validation challenge, POST queues an event"""
+        if self.command == 'GET':
+            params = parse_qs(urlparse(self.path).query)
+            challenge = params.get('hub.challenge', [''])[0]
+            verify_token = params.get('hub.verify_token', [''])[0]
+            if (params.get('hub.mode', [''])[0] != 'subscribe' or not challenge or not STRAVA_WEBHOOK_VERIFY_TOKEN
+                    or not hmac.compare_digest(verify_token, STRAVA_WEBHOOK_VERIFY_TOKEN)):
+                self.send_body(json.dumps({'error': 'Invalid subscription request'}).encode(), 'application/json', status=403)
+                return
+            print("✅ Strava webhook subscription validated")
+            self.send_body(json.dumps({'hub.challenge': challenge}).encode(), 'application/json')
+            return
+        
+        if not STRAVA_WEBHOOK_VERIFY_TOKEN or not STRAVA_WEBHOOK_SUBSCRIPTION_ID:
+            # Подписка не настроена - события не принимаем
+            self.send_error(404, 'Not Found')
+            return
+        
+        # Strava ждёт 200 в течение 2 секунд - только проверяем и ставим в очередь
+        content_length = int(self.headers.get('Content-Length', 0))
+        if content_length > 65536:
+            self.send_error(413, 'Event too large')
+            return
+        try:
+            event = parse_webhook_event(json.loads(self.rfile.read(content_length).decode('utf-8')))
+        except (ValueError, UnicodeDecodeError) as e:
+            self.send_body(json.dumps({'error': str(e)}).encode(), 'application/json', status=400)
+            return
+        if str(event['subscription_id']) != STRAVA_WEBHOOK_SUBSCRIPTION_ID:
+            self.send_body(json.dumps({'error': 'Unknown subscription'}).encode(), 'application/json', status=403)
+            return
+        
+        if not webhook_worker.enqueue(event):
+            # Strava повторит доставку
+            self.send_body(json.dumps({'error': 'Busy, retry later'}).encode(), 'application/json', status=503)
+            return
+        self.send_body(json.dumps({'status': 'ok'}).encode(), 'application/json')
+    
     def handle_token_exchange(self):
         """Handle OAuth token exchange"""
         try:
@@ -828,15 +4792,10 @@ class ProductionHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
                 self.send_error(400, 'Missing authorization code')
                 return
             
-            # Exchange code for token with Strava API
-            import urllib.request
-            import urllib.parse
-            
             # Get configuration
             try:
                 from server_config import STRAVA_CLIENT_ID, STRAVA_CLIENT_SECRET
             except ImportError:
-                import os
                 STRAVA_CLIENT_ID = os.environ.get('STRAVA_CLIENT_ID', 'YOUR_STRAVA_CLIENT_ID')
                 STRAVA_CLIENT_SECRET = os.environ.get('STRAVA_CLIENT_SECRET', 'YOUR_STRAVA_CLIENT_SECRET')
             
@@ -849,215 +4808,226 @@ class ProductionHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
                 'client_secret': client_secret,
                 'code': code,
                 'grant_type': 'authorization_code'
-            }
-            
-            # Make request to Strava token endpoint
-            data = urllib.parse.urlencode(token_data).encode()
-            req = urllib.request.Request(
-                'https://www.strava.com/oauth/token',
-                data=data,
-                method='POST'
-            )
-            
-            try:
-                with urllib.request.urlopen(req) as response:
-                    token_response = json.loads(response.read().decode())
-                    
-                    # Сохраняем данные пользователя
-                    athlete_data = token_response.get('athlete', {})
-                    if athlete_data:
-                        self.save_athlete_data(athlete_data, token_response.get('access_token'))
-                    
-                    # Send success response
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'application/json')
-                    self.end_headers()
-                    
-                    response_data = {
-                        'access_token': token_response.get('access_token'),
-                        'refresh_token': token_response.get('refresh_token'),
-                        'expires_at': token_response.get('expires_at'),
-                        'athlete': athlete_data
-                    }
-                    
-                    self.wfile.write(json.dumps(response_data).encode())
-                    print(f"✅ Token exchange successful for athlete: {athlete_data.get('firstname', 'Unknown')}")
-                    
-            except urllib.error.HTTPError as e:
-                error_body = e.read().decode()
-                print(f"❌ Strava API error: {e.code} - {error_body}")
+            }
+            
+            # Exchange code for token with Strava API (pooled keep-alive client with timeouts/retries)
+            try:
+                response = strava_http.request(
+                    'POST', STRAVA_TOKEN_URL,
+                    body=urlencode(token_data).encode(),
+                    headers={'Content-Type': 'application/x-www-form-urlencoded', 'Accept': 'application/json'},
+                )
+            except OutboundHTTPError as e:
+                print(f"❌ Strava token endpoint unavailable: {e}")
+                self.send_body(json.dumps({'error': 'Strava is not responding, please try again'}).encode(),
+                               'application/json', status=504)
+                return
+            
+            if response.status == 429 or response.status >= 500:
+                # Код одноразовый и запрос уже ушёл - не повторяем, пользователь начнёт вход заново
+                print(f"❌ Strava token endpoint error: {response.status}")
+                self.send_body(json.dumps({'error': 'Strava is not responding, please try again'}).encode(),
+                               'application/json', status=502)
+                return
+            
+            if response.status != 200:
+                print(f"❌ Strava API error: {response.status} - {response.body.decode(errors='replace')}")
                 
                 self.send_response(400)
                 self.send_header('Content-Type', 'application/json')
                 self.end_headers()
                 self.wfile.write(json.dumps({'error': 'Token exchange failed'}).encode())
-                
-        except Exception as e:
-            print(f"❌ Error handling token exchange: {e}")
-            self.send_error(500, f'Internal server error: {str(e)}')
-
-    def save_athlete_data(self, athlete_data, access_token):
-        """Save athlete data to PostgreSQL or fallback to JSON"""
-        # Try database first
-        conn = get_db_connection()
-        
-        if conn:
-            try:
-                cursor = conn.cursor()
-                
-                # Insert or update athlete
-                cursor.execute("""
-                    INSERT INTO athletes (
-                        athlete_id, username, firstname, lastname, email,
-                        city, country, profile_picture, access_token_hash,
-                        strava_created_at, strava_updated_at
-                    )
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (athlete_id) 
-                    DO UPDATE SET
-                        username = EXCLUDED.username,
-                        firstname = EXCLUDED.firstname,
-                        lastname = EXCLUDED.lastname,
-                        email = EXCLUDED.email,
-                        city = EXCLUDED.city,
-                        country = EXCLUDED.country,
-                        profile_picture = EXCLUDED.profile_picture,
-                        access_token_hash = EXCLUDED.access_token_hash,
-                        strava_updated_at = EXCLUDED.strava_updated_at,
-                        last_seen_at = CURRENT_TIMESTAMP
-                """, (
-                    athlete_data.get('id'),
-                    athlete_data.get('username'),
-                    athlete_data.get('firstname'),
-                    athlete_data.get('lastname'),
-                    athlete_data.get('email', 'not_provided'),
-                    athlete_data.get('city'),
-                    athlete_data.get('country'),
-                    athlete_data.get('profile'),
-                    self.hash_token(access_token),
-                    athlete_data.get('created_at'),
-                    athlete_data.get('updated_at')
-                ))
-                
-                conn.commit()
-                print(f"✅ Saved athlete to DB: {athlete_data.get('firstname')} {athlete_data.get('lastname')}")
-                
-                # Record auth event (unique connection per day)
-                try:
-                    athlete_id = athlete_data.get('id')
-                    ip_address = get_client_ip(self)
-                    user_agent = get_user_agent(self)
-                    
-                    # Insert auth event (using unique index for one connection per day)
-                    cursor.execute("""
-                        INSERT INTO auth_events (athlete_id, ip_address, user_agent)
-                        SELECT %s, %s, %s
-                        WHERE NOT EXISTS (
-                            SELECT 1 FROM auth_events 
-                            WHERE athlete_id = %s 
-                            AND DATE(created_at) = CURRENT_DATE
-                        )
-                    """, (athlete_id, ip_address, user_agent, athlete_id))
-                    
-                    conn.commit()
-                    print(f"✅ Recorded auth event for athlete: {athlete_id}")
-                except Exception as e:
-                    print(f"⚠️ Error recording auth event: {e}")
-                    # Continue even if analytics fails
-                
-                conn.close()
                 return
-                
-            except Exception as e:
-                print(f"⚠️ Error saving to database: {e}")
-                conn.rollback()
-                conn.close()
-                # Fallthrough to JSON fallback
-        
-        # Fallback to JSON
-        try:
-            athlete_info = {
-                'athlete_id': athlete_data.get('id'),
-                'username': athlete_data.get('username'),
-                'firstname': athlete_data.get('firstname'),
-                'lastname': athlete_data.get('lastname'),
-                'email': athlete_data.get('email', 'not_provided'),
-                'city': athlete_data.get('city'),
-                'country': athlete_data.get('country'),
-                'profile_picture': athlete_data.get('profile'),
-                'created_at': athlete_data.get('created_at'),
-                'updated_at': athlete_data.get('updated_at'),
-                'connected_at': datetime.now().isoformat(),
-                'access_token_hash': self.hash_token(access_token)
-            }
             
-            data_dir = 'data'
-            if not os.path.exists(data_dir):
-                os.makedirs(data_dir)
+            token_response = json.loads(response.body.decode())
             
-            filename = os.path.join(data_dir, f'athlete_{athlete_info["athlete_id"]}.json')
+            # Сохраняем данные пользователя
+            athlete_data = token_response.get('athlete', {})
+            if athlete_data:
+                self.save_athlete_data(athlete_data, token_response.get('access_token'), token_response.get('expires_at'))
+                # Подтягиваем новые активности в БД, пока пользователь открывает приложение
+                activity_sync.remember(token_response.get('access_token'), athlete_data.get('id'),
+                                       token_response.get('expires_at'))
+                activity_sync.schedule(athlete_data.get('id'), token_response.get('access_token'))
             
-            if os.path.exists(filename):
-                with open(filename, 'r', encoding='utf-8') as f:
-                    existing_data = json.load(f)
-                    existing_data.update(athlete_info)
-                    athlete_info = existing_data
-            
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(athlete_info, f, indent=2, ensure_ascii=False)
+            # Send success response
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
             
-            print(f"💾 Saved athlete data (JSON): {athlete_info.get('firstname')} {athlete_info.get('lastname')} (ID: {athlete_info.get('athlete_id')})")
+            response_data = {
+                'access_token': token_response.get('access_token'),
+                'refresh_token': token_response.get('refresh_token'),
+                'expires_at': token_response.get('expires_at'),
+                'athlete': athlete_data
+            }
             
+            self.wfile.write(json.dumps(response_data).encode())
+            print(f"✅ Token exchange successful for athlete: {athlete_data.get('firstname', 'Unknown')}")
+                
         except Exception as e:
-            print(f"⚠️ Error saving athlete data: {e}")
+            print(f"❌ Error handling token exchange: {e}")
+            self.send_error(500, f'Internal server error: {str(e)}')
+
+    def save_athlete_data(self, athlete_data, access_token, expires_at=None):
+        """Hand the athlete over to athlete_writer (written in the background, PostgreSQL or local store)"""
+        record = {
+            'athlete_id': athlete_data.get('id'),
+            'username': athlete_data.get('username'),
+            'firstname': athlete_data.get('firstname'),
+            'lastname': athlete_data.get('lastname'),
+            'email': athlete_data.get('email', 'not_provided'),
+            'city': athlete_data.get('city'),
+            'country': athlete_data.get('country'),
+            'profile_picture': athlete_data.get('profile'),
+            'access_token_hash': self.hash_token(access_token),
+            'access_token_expires_at': datetime.fromtimestamp(expires_at, timezone.utc).replace(tzinfo=None) if expires_at else None,
+            'strava_created_at': athlete_data.get('created_at'),
+            'strava_updated_at': athlete_data.get('updated_at'),
+            # Время входа фиксируем сейчас - запись происходит позже
+            'last_seen_at': datetime.now(),
+        }
+        
+        # Событие авторизации (одно в день) пишется через очередь аналитики
+        analytics_writer.enqueue('auth_events', (
+            record['athlete_id'], get_client_ip(self), get_user_agent(self), datetime.now(timezone.utc)
+        ))
+        
+        if not athlete_writer.submit(record):
+            # Очередь переполнена (или сервер останавливается) - пишем синхронно, вход не теряем
+            athlete_writer.write([record])
     
     def record_download(self, athlete_id=None, club_id=None):
-        """Record a download event"""
-        conn = get_db_connection()
-        if not conn:
-            return
-        
-        try:
-            cursor = conn.cursor()
-            ip_address = get_client_ip(self)
-            user_agent = get_user_agent(self)
-            
-            cursor.execute("""
-                INSERT INTO downloads (athlete_id, club_id, ip_address, user_agent, file_format)
-                VALUES (%s, %s, %s, %s, 'png')
-            """, (athlete_id, club_id, ip_address, user_agent))
-            
-            conn.commit()
-            print(f"✅ Recorded download: athlete_id={athlete_id}, club_id={club_id}")
-        except Exception as e:
-            print(f"⚠️ Error recording download: {e}")
-            conn.rollback()
-        finally:
-            conn.close()
+        """Record a download event (written in the background by analytics_writer)"""
+        ip_address = get_client_ip(self)
+        user_agent = get_user_agent(self)
+        # Время фиксируем сейчас - запись в БД происходит позже
+        analytics_writer.enqueue('downloads', (
+            athlete_id, club_id, ip_address, user_agent, 'png', datetime.now(timezone.utc)
+        ))
+        print(f"✅ Queued download: athlete_id={athlete_id}, club_id={club_id}")
     
     def record_visit(self, session_id, athlete_id=None, club_id=None, page_path='/'):
-        """Record a visit event"""
-        conn = get_db_connection()
-        if not conn:
+        """Record a visit event (written in the background by analytics_writer)"""
+        ip_address = get_client_ip(self)
+        user_agent = get_user_agent(self)
+        analytics_writer.enqueue('visits', (
+            session_id, athlete_id, club_id, ip_address, user_agent, page_path, datetime.now(timezone.utc)
+        ))
+    
+    def handle_analytics_batch(self, parsed_events):
+        """Validate a batch of (event, parse_error) pairs, queue the valid ones together, report per event"""
+        if len(parsed_events) > ANALYTICS_MAX_BATCH_EVENTS:
+            self.send_error(413, f'Too many events (max {ANALYTICS_MAX_BATCH_EVENTS})')
             return
         
+        ip_address = get_client_ip(self)
+        user_agent = get_user_agent(self)
+        now = datetime.now(timezone.utc)
+        results = []
+        rows = []
+        for index, (event, parse_error) in enumerate(parsed_events):
+            try:
+                if parse_error:
+                    raise ValueError(parse_error)
+                fields = validate_analytics_event(event)
+            except ValueError as e:
+                results.append({'index': index, 'status': 'error', 'error': str(e)})
+                continue
+            
+            if fields['type'] == 'visit':
+                rows.append(('visits', (
+                    fields['session_id'], fields['athlete_id'], fields['club_id'],
+                    ip_address, user_agent, fields['page_path'], now
+                )))
+            else:
+                rows.append(('downloads', (
+                    fields['athlete_id'], fields['club_id'], ip_address, user_agent, 'png', now
+                )))
+            results.append({'index': index, 'status': 'ok'})
+        
+        # Весь пакет уходит в БД одним сбросом writer'а
+        queued = analytics_writer.enqueue_many(rows) if rows else True
+        if not queued:
+            for result in results:
+                if result['status'] == 'ok':
+                    result.update(status='error', error='queue full')
+        
+        accepted = sum(1 for result in results if result['status'] == 'ok')
+        response = {
+            'status': 'ok' if accepted == len(results) else ('partial' if accepted else 'error'),
+            'accepted': accepted,
+            'rejected': len(results) - accepted,
+            'results': results,
+        }
+        self.send_body(json.dumps(response).encode(), 'application/json', status=200 if accepted or not results else 400)
+
+    def handle_stats_range(self, query):
+        """Range / per-club stats: ?from=YYYY-MM-DD&to=YYYY-MM-DD&club_id=...&granularity=day|week|month|year"""
         try:
-            cursor = conn.cursor()
-            ip_address = get_client_ip(self)
-            user_agent = get_user_agent(self)
+            params = parse_stats_params(query)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        key = ('stats-range', params['from'], params['to'], params['club_id'], params['granularity'])
+        asset = stats_cache.get(key, lambda: build_stats_range(params))
+        if asset is None:
+            self.send_error(503, 'Database not available')
+            return
+        self.send_cached_asset(asset, 'application/json', cache_control=STATS_CACHE_CONTROL)
+
+    def build_stats_body(self):
+        """Compute the /api/analytics/stats JSON (None if the database is unavailable)"""
+        with db_connection() as conn:
+            if not conn:
+                return None
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            stats = {}
             
+            # Все значения читаются из rollup-таблиц (AnalyticsRollup), не из сырых событий
             cursor.execute("""
-                INSERT INTO visits (session_id, athlete_id, club_id, ip_address, user_agent, page_path)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            """, (session_id, athlete_id, club_id, ip_address, user_agent, page_path))
-            
-            conn.commit()
-        except Exception as e:
-            print(f"⚠️ Error recording visit: {e}")
-            conn.rollback()
-        finally:
-            conn.close()
-    
+                SELECT COALESCE(SUM(new_connections), 0)::bigint as unique_connections,
+                       COALESCE(SUM(downloads), 0)::bigint as total_downloads
+                FROM analytics_daily_totals
+            """)
+            stats.update(cursor.fetchone())
+        
+            # Downloads by club
+            cursor.execute("""
+                SELECT NULLIF(club_id, '') as club_id, SUM(downloads)::bigint as count
+                FROM analytics_daily_rollup
+                WHERE downloads > 0
+                GROUP BY club_id
+            """)
+            stats['downloads_by_club'] = {row['club_id']: row['count'] for row in cursor.fetchall()}
+        
+            # Visits by day
+            cursor.execute("""
+                SELECT day as date, visits as total, unique_sessions as unique_visits
+                FROM analytics_daily_totals
+                WHERE visits > 0
+                ORDER BY day DESC
+                LIMIT 30
+            """)
+            stats['visits_by_day'] = [dict(row) for row in cursor.fetchall()]
+        
+            # Visits by month
+            cursor.execute("""
+                SELECT month, visits as total, unique_sessions as unique_visits
+                FROM analytics_monthly_totals
+                ORDER BY month DESC
+                LIMIT 12
+            """)
+            stats['visits_by_month'] = [dict(row) for row in cursor.fetchall()]
+        
+            # Уникальные за последние 30 дней - слияние дневных HLL-скетчей (погрешность ~1.6%)
+            today = datetime.now(timezone.utc).date()
+            month_ago = today - timedelta(days=29)
+            stats['unique_visitors_30d'] = analytics_sketches.estimate(cursor, 'visitors', month_ago, today)
+            stats['unique_connections_30d'] = analytics_sketches.estimate(cursor, 'connections', month_ago, today)
+        
+            return json.dumps(stats, default=str).encode()
+
     def handle_analytics_api(self):
         """Handle analytics API endpoints"""
         if self.command == 'POST':
@@ -1065,7 +5035,15 @@ class ProductionHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
             try:
                 content_length = int(self.headers.get('Content-Length', 0))
                 post_data = self.rfile.read(content_length)
+                
+                # Batch: NDJSON body or JSON array of events
+                if 'ndjson' in self.headers.get('Content-Type', ''):
+                    self.handle_analytics_batch(parse_ndjson_events(post_data.decode('utf-8')))
+                    return
                 data = json.loads(post_data.decode('utf-8'))
+                if isinstance(data, list):
+                    self.handle_analytics_batch([(event, None) for event in data])
+                    return
                 
                 event_type = data.get('type')
                 
@@ -1092,6 +5070,9 @@ class ProductionHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
                     self.end_headers()
                     self.wfile.write(json.dumps({'status': 'ok'}).encode())
                     return
+                
+                self.send_error(400, 'Unknown event type')
+                return
                     
             except json.JSONDecodeError:
                 self.send_error(400, 'Invalid JSON')
@@ -1105,68 +5086,26 @@ class ProductionHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         elif self.command == 'GET':
             # Get statistics
             try:
-                conn = get_db_connection()
-                if not conn:
-                    self.send_error(503, 'Database not available')
-                    return
-                
-                cursor = conn.cursor(cursor_factory=RealDictCursor)
                 # Handle both /api/analytics/ and /route/api/analytics/
-                path = self.path
+                parsed = urlparse(self.path)
+                path = parsed.path
                 if path.startswith('/route/api/analytics/'):
                     path = path.replace('/route/api/analytics/', '')
                 elif path.startswith('/api/analytics/'):
                     path = path.replace('/api/analytics/', '')
                 
+                if (path == 'stats' or path == '') and parsed.query:
+                    self.handle_stats_range(parsed.query)
+                    return
+                
                 if path == 'stats' or path == '':
-                    # Get all statistics
-                    stats = {}
-                    
-                    # Unique connections
-                    cursor.execute("SELECT COUNT(DISTINCT athlete_id) as count FROM auth_events")
-                    stats['unique_connections'] = cursor.fetchone()['count']
-                    
-                    # Total downloads
-                    cursor.execute("SELECT COUNT(*) as count FROM downloads")
-                    stats['total_downloads'] = cursor.fetchone()['count']
-                    
-                    # Downloads by club
-                    cursor.execute("""
-                        SELECT club_id, COUNT(*) as count 
-                        FROM downloads 
-                        GROUP BY club_id
-                    """)
-                    stats['downloads_by_club'] = {row['club_id']: row['count'] for row in cursor.fetchall()}
-                    
-                    # Visits by day
-                    cursor.execute("""
-                        SELECT DATE(created_at) as date, COUNT(*) as total, COUNT(DISTINCT session_id) as unique_visits
-                        FROM visits
-                        GROUP BY DATE(created_at)
-                        ORDER BY date DESC
-                        LIMIT 30
-                    """)
-                    stats['visits_by_day'] = [dict(row) for row in cursor.fetchall()]
-                    
-                    # Visits by month
-                    cursor.execute("""
-                        SELECT DATE_TRUNC('month', created_at) as month, COUNT(*) as total, COUNT(DISTINCT session_id) as unique_visits
-                        FROM visits
-                        GROUP BY DATE_TRUNC('month', created_at)
-                        ORDER BY month DESC
-                        LIMIT 12
-                    """)
-                    stats['visits_by_month'] = [dict(row) for row in cursor.fetchall()]
-                    
-                    conn.close()
-                    
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'application/json')
-                    self.end_headers()
-                    self.wfile.write(json.dumps(stats, default=str).encode())
+                    asset = stats_cache.get('stats', self.build_stats_body)
+                    if asset is None:
+                        self.send_error(503, 'Database not available')
+                        return
+                    self.send_cached_asset(asset, 'application/json', cache_control=STATS_CACHE_CONTROL)
                     return
                 
-                conn.close()
                 self.send_error(404, 'Not Found')
                 
             except Exception as e:
@@ -1180,77 +5119,160 @@ class ProductionHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
             self.send_error(405, 'Method Not Allowed')
     
     def handle_admin_users(self):
-        """Handle admin users API endpoint from database or JSON fallback"""
+        """Handle admin users API endpoint from database or JSON fallback.
+
+        Query: limit, cursor (next_cursor of the previous page), city, country.
+        The first page (no cursor) also carries total / recent counts.
+        """
+        try:
+            params = parse_admin_users_params(urlparse(self.path).query)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        
         try:
             # Try database first
-            conn = get_db_connection()
+            conn = db_pool.acquire()
             
             if conn:
                 try:
                     cursor = conn.cursor(cursor_factory=RealDictCursor)
-                    cursor.execute("""
-                        SELECT 
-                            athlete_id, username, firstname, lastname, email,
-                            city, country, connected_at, last_seen_at
-                        FROM athletes 
-                        WHERE is_active = TRUE 
-                        ORDER BY connected_at DESC
-                    """)
-                    
+                    sql, args = admin_users_query(params)
+                    cursor.execute(sql, args)
                     users = cursor.fetchall()
-                    # Convert datetime to string for JSON
-                    for user in users:
-                        if user.get('connected_at'):
-                            user['connected_at'] = user['connected_at'].isoformat()
-                        if user.get('last_seen_at'):
-                            user['last_seen_at'] = user['last_seen_at'].isoformat()
                     
-                    conn.close()
+                    response = {'users': users[:params['limit']], 'next_cursor': None}
+                    if len(users) > params['limit']:
+                        last = users[params['limit'] - 1]
+                        response['next_cursor'] = encode_users_cursor(last['connected_at'], last['athlete_id'])
                     
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'application/json')
-                    self.end_headers()
-                    self.wfile.write(json.dumps({'users': users}).encode())
+                    if params['cursor'] is None:
+                        where, args = admin_users_where(params, keyset=False)
+                        cursor.execute(f"""
+                            SELECT COUNT(*) as total,
+                                   COUNT(*) FILTER (WHERE connected_at > CURRENT_TIMESTAMP - INTERVAL '7 days') as recent
+                            FROM athletes
+                            WHERE {where}
+                        """, args)
+                        response.update(cursor.fetchone())
+                    
+                    db_pool.release(conn)
+                    
+                    self.send_body(json.dumps(response, default=lambda o: o.isoformat()).encode(), 'application/json')
                     return
                     
                 except Exception as e:
                     print(f"⚠️ Error querying database: {e}")
-                    conn.close()
+                    db_pool.release(conn)
                     # Fallthrough to JSON
             
-            # Fallback to JSON files
-            data_dir = 'data'
-            
-            if not os.path.exists(data_dir):
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({'users': []}).encode())
-                return
-            
-            users = []
-            for filename in os.listdir(data_dir):
-                if filename.startswith('athlete_') and filename.endswith('.json'):
-                    filepath = os.path.join(data_dir, filename)
-                    try:
-                        with open(filepath, 'r', encoding='utf-8') as f:
-                            user_data = json.load(f)
-                            users.append(user_data)
-                    except Exception as e:
-                        print(f"⚠️ Error reading {filename}: {e}")
-            
-            # Sort by connected_at descending
-            users.sort(key=lambda x: x.get('connected_at', ''), reverse=True)
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({'users': users}).encode())
+            # Fallback to the local SQLite store
+            response = athlete_store.page(params)
+            self.send_body(json.dumps(response).encode(), 'application/json')
             
         except Exception as e:
             print(f"❌ Error in admin users endpoint: {e}")
             self.send_error(500, 'Internal server error')
     
+    def handle_admin_users_export(self):
+        """Stream all matching users as NDJSON (default) or CSV (?format=csv).
+
+        Rows are read through a named (server-side) cursor in itersize batches
+        and written with chunked transfer encoding, so memory use does not grow
+        with the number of athletes.
+        """
+        try:
+            params = parse_admin_users_params(urlparse(self.path).query)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        if params['format'] not in ('ndjson', 'csv'):
+            self.send_error(400, 'format must be ndjson or csv')
+            return
+        
+        if params['format'] == 'csv':
+            content_type = 'text/csv; charset=utf-8'
+            header = io.StringIO()
+            csv.writer(header).writerow(ADMIN_USER_COLUMNS)
+            
+            def encode(rows):
+                out = io.StringIO()
+                writer = csv.writer(out)
+                for row in rows:
+                    writer.writerow([row[name].isoformat() if isinstance(row[name], datetime) else row[name]
+                                     for name in ADMIN_USER_COLUMNS])
+                return out.getvalue().encode()
+        else:
+            content_type = 'application/x-ndjson'
+            header = None
+            
+            def encode(rows):
+                return b''.join(json.dumps(row, default=lambda o: o.isoformat()).encode() + b'\n' for row in rows)
+        
+        conn = db_pool.acquire()
+        if conn is None:
+            # Без БД экспортируем из локального хранилища
+            def chunks():
+                if header is not None:
+                    yield header.getvalue().encode()
+                for rows in athlete_store.iter_rows(params):
+                    yield encode(rows)
+            self.send_stream(chunks(), content_type)
+            return
+        
+        def chunks():
+            cursor = conn.cursor(name='admin_users_export', cursor_factory=RealDictCursor)
+            cursor.itersize = 1000
+            try:
+                sql, args = admin_users_query(params, keyset=False)
+                cursor.execute(sql, args)
+                if header is not None:
+                    yield header.getvalue().encode()
+                while True:
+                    rows = cursor.fetchmany(cursor.itersize)
+                    if not rows:
+                        break
+                    yield encode(rows)
+            finally:
+                cursor.close()
+                conn.rollback()
+        
+        try:
+            self.send_stream(chunks(), content_type)
+        finally:
+            db_pool.release(conn)
+    
+    def send_stream(self, chunks, content_type, status=200):
+        """Send an iterable of byte chunks without buffering the whole body.
+
+        HTTP/1.1 clients get Transfer-Encoding: chunked; HTTP/1.0 clients get a
+        body delimited by closing the connection. If the producer fails midway
+        the terminating chunk is not sent, so the client sees a truncated body.
+        """
+        chunked = self.request_version == 'HTTP/1.1'
+        if chunked:
+            self.protocol_version = 'HTTP/1.1'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Connection', 'close')
+        self.close_connection = True
+        self.end_headers()
+        try:
+            for data in chunks:
+                if not data:
+                    continue
+                if chunked:
+                    self.wfile.write(b'%x\r\n' % len(data) + data + b'\r\n')
+                else:
+                    self.wfile.write(data)
+        except Exception as e:
+            print(f"❌ Streaming response aborted: {e}")
+            return
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+    
     def hash_token(self, token):
         """Create a hash of the token for logging purposes"""
         try:
@@ -1264,6 +5286,374 @@ class ProductionHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         print(f"📡 [{timestamp}] {format % args}")
 
+class ThreadPoolHTTPServer(socketserver.TCPServer):
+    """TCPServer that hands accepted connections to a fixed pool of worker threads.
+
+    The hand-off queue is bounded, so when every worker is busy the accept loop
+    blocks and further clients wait in the kernel listen backlog instead of
+    spawning unbounded threads.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, server_address, RequestHandlerClass, workers=16, backlog=128,
+                 bind_and_activate=True):
+        self.workers = max(1, workers)
+        self.request_queue_size = backlog
+        self._requests = queue.Queue(maxsize=self.workers * 2)
+        self._threads = []
+        super().__init__(server_address, RequestHandlerClass, bind_and_activate)
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"http-worker-{i}", daemon=self.daemon_threads)
+            thread.start()
+            self._threads.append(thread)
+
+    def _worker(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        """Queue the connection for a worker instead of handling it inline"""
+        self._requests.put((request, client_address))
+
+    def server_close(self):
+        super().server_close()
+        for _ in self._threads:
+            self._requests.put(None)
+        # Один общий срок на всех воркеров, а не по 5 с на каждого
+        deadline = time.monotonic() + 5
+        for thread in self._threads:
+            thread.join(timeout=max(0, deadline - time.monotonic()))
+
+class AsyncResponseWriter:
+    """wfile for handlers run by AsyncHTTPServer: streams to the asyncio transport.
+
+    Runs in the handler thread. Writes are gathered into chunks of up to
+    buffer_size and each chunk is handed to the event loop, waiting for
+    drain() so a slow client blocks its handler thread instead of growing a
+    buffer. The response head is rewritten to HTTP/1.1 framing before the
+    first byte goes out. A body the handler sent without Content-Length is
+    held back: if it ends within buffer_size it goes out with a
+    Content-Length, a longer one is sent chunked (or, to HTTP/1.0 clients,
+    delimited by closing the connection), so keep-alive survives either way.
+    sendfile() uses loop.sendfile() on the transport.
+    """
+
+    def __init__(self, loop, writer, keep_alive, head_request=False, chunked_ok=True, buffer_size=64 * 1024):
+        self.loop = loop
+        self.writer = writer
+        self.keep_alive = keep_alive
+        self.head_request = head_request
+        self.chunked_ok = chunked_ok
+        self.buffer_size = buffer_size
+        self.started = False
+        self._mode = None  # 'raw' (тело уже размечено), 'unframed' (ждём конца), 'chunked' или 'close'
+        self._head = None  # строки заголовка, пока тело unframed
+        self._buffer = bytearray()
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def _send(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def write(self, data):
+        self._buffer += data
+        if not self.started:
+            end = self._buffer.find(b'\r\n\r\n')
+            if end < 0:
+                return len(data)
+            head = bytes(self._buffer[:end])
+            del self._buffer[:end + 4]
+            self.started = True
+            self._start(head)
+        if len(self._buffer) >= self.buffer_size:
+            self._push()
+        return len(data)
+
+    def flush(self):
+        # Неразмеченное тело копим до finish(), чтобы посчитать Content-Length
+        if self._mode != 'unframed':
+            self._push()
+
+    def finish(self):
+        """End of the handler's response: send whatever is held back"""
+        if self._mode == 'unframed':
+            self._head.append(b'Content-Length: ' + str(len(self._buffer)).encode())
+            self._mode = 'raw'
+            self._buffer[:0] = self._render_head()
+        self._push()
+        if self._mode == 'chunked':
+            self._call(self._send(b'0\r\n\r\n'))
+
+    def sendfile(self, f, offset, count):
+        if self._mode != 'raw':
+            f.seek(offset)
+            self.write(f.read(count))
+            return
+        self.flush()
+        self._call(self.loop.sendfile(self.writer.transport, f, offset, count))
+
+    def _push(self):
+        if not self.started or (not self._buffer and self._mode != 'unframed'):
+            return
+        data, self._buffer = bytes(self._buffer), bytearray()
+        if self._mode == 'unframed':
+            # Тело оказалось больше буфера - длину заранее не узнать
+            if self.chunked_ok:
+                self._mode = 'chunked'
+                self._head.append(b'Transfer-Encoding: chunked')
+            else:
+                self._mode = 'close'
+                self.keep_alive = False
+            head = self._render_head()
+            data = head + (b'%x\r\n' % len(data) + data + b'\r\n' if self._mode == 'chunked' and data else data)
+        elif self._mode == 'chunked':
+            data = b'%x\r\n' % len(data) + data + b'\r\n'
+        self._call(self._send(data))
+
+    def _start(self, head):
+        """Upgrade the handler's status line and headers to HTTP/1.1 and pick the body framing"""
+        lines = head.split(b'\r\n')
+        status = lines[0].split(b' ', 1)
+        lines[0] = b'HTTP/1.1 ' + (status[1] if len(status) > 1 else b'500 Internal Server Error')
+        code = lines[0][9:12]
+        headers = lines[1:]
+        # Хендлер сам просит закрыть соединение (потоковая выгрузка, ошибки) - не спорим
+        if any(line.lower().replace(b' ', b'') == b'connection:close' for line in headers):
+            self.keep_alive = False
+        self._head = [lines[0]] + [line for line in headers if not line.lower().startswith(b'connection:')]
+        names = {line.split(b':', 1)[0].strip().lower() for line in headers}
+        bodyless = self.head_request or code in (b'204', b'304') or code.startswith(b'1')
+        if b'content-length' in names or b'transfer-encoding' in names or bodyless:
+            self._mode = 'raw'
+            self._buffer[:0] = self._render_head()
+        else:
+            self._mode = 'unframed'
+
+    def _render_head(self):
+        head = self._head + [b'Connection: keep-alive' if self.keep_alive else b'Connection: close']
+        self._head = None
+        return b'\r\n'.join(head) + b'\r\n\r\n'
+
+class AsyncHTTPServer:
+    """HTTP/1.1 keep-alive server built on asyncio streams.
+
+    Idle connections are parked on the event loop instead of holding a thread.
+    Each parsed request is dispatched to the regular ProductionHTTPRequestHandler
+    routes on a bounded executor, so blocking psycopg2 queries and Strava
+    requests never stall the loop. Responses are streamed back through an
+    AsyncResponseWriter; request bodies over max_body_size are refused with 413.
+    """
+
+    def __init__(self, handler_class, workers=16, keepalive_timeout=75.0, read_timeout=30.0,
+                 max_header_size=65536, max_body_size=1024 * 1024):
+        self.handler_class = handler_class
+        self.keepalive_timeout = keepalive_timeout
+        self.read_timeout = read_timeout
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers),
+                                                              thread_name_prefix='async-worker')
+        self.connections = 0
+
+    def _run_handler(self, raw_request, client_address, wfile):
+        """Run one request through the regular handler; the response goes straight to wfile"""
+        handler = self.handler_class.__new__(self.handler_class)
+        handler.server = self
+        handler.request = None
+        handler.client_address = client_address
+        handler.directory = os.getcwd()
+        handler.rfile = io.BytesIO(raw_request)
+        handler.wfile = wfile
+        handler.handle_one_request()
+        wfile.finish()
+
+    async def _handle_connection(self, reader, writer):
+        peer = writer.get_extra_info('peername') or ('unknown', 0)
+        client_address = (peer[0], peer[1])
+        loop = asyncio.get_running_loop()
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.keepalive_timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                
+                request_line, _, header_block = head.partition(b'\r\n')
+                headers = {}
+                for line in header_block.split(b'\r\n'):
+                    name, sep, value = line.partition(b':')
+                    if sep:
+                        headers[name.strip().lower()] = value.strip()
+                
+                version = request_line.rsplit(b' ', 1)[-1]
+                connection = headers.get(b'connection', b'').lower()
+                keep_alive = (version == b'HTTP/1.1' and connection != b'close') or connection == b'keep-alive'
+                
+                if b'transfer-encoding' in headers:
+                    # Chunked request bodies are not used by our clients
+                    writer.write(b'HTTP/1.1 411 Length Required\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                    await writer.drain()
+                    break
+                try:
+                    length = int(headers.get(b'content-length', b'0') or 0)
+                except ValueError:
+                    length = -1
+                if length < 0 or length > self.max_body_size:
+                    status = b'413 Payload Too Large' if length > 0 else b'400 Bad Request'
+                    writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                    await writer.drain()
+                    break
+                try:
+                    body = b''
+                    if length > 0:
+                        body = await asyncio.wait_for(reader.readexactly(length), self.read_timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                
+                wfile = AsyncResponseWriter(loop, writer, keep_alive,
+                                            head_request=request_line.startswith(b'HEAD '),
+                                            chunked_ok=version == b'HTTP/1.1')
+                await loop.run_in_executor(self.executor, self._run_handler, head + body, client_address, wfile)
+                if not wfile.started or not wfile.keep_alive:
+                    break
+        except Exception as e:
+            print(f"❌ Async connection error from {client_address[0]}: {e}")
+        finally:
+            self.connections -= 1
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def serve(self, host, port, backlog=128):
+        """Accept connections until SIGTERM/SIGINT"""
+        server = await asyncio.start_server(self._handle_connection, host or None, port, backlog=backlog,
+                                            limit=self.max_header_size, reuse_address=True)
+        loop = asyncio.get_running_loop()
+        stop = loop.create_future()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, lambda: stop.done() or stop.set_result(None))
+            except (NotImplementedError, RuntimeError):
+                pass
+        try:
+            async with server:
+                await stop
+        finally:
+            print("\n🛑 Server stopped")
+            self.executor.shutdown(wait=True)
+            shutdown_background_workers()
+
+def default_worker_processes():
+    """Number of CPUs available to this process (container-aware where possible)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        return os.cpu_count() or 1
+
+def serve_prefork(port, handler_class, processes, workers, backlog):
+    """Pre-fork worker processes that share one listening socket.
+
+    The parent binds the socket, forks `processes` children that each run a
+    ThreadPoolHTTPServer on the inherited fd, and restarts any child that exits
+    until it receives SIGTERM/SIGINT itself.
+    """
+    listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_sock.bind(("", port))
+    listen_sock.listen(backlog)
+    
+    # Соединения родителя не должны наследоваться дочерними процессами
+    db_pool.close_all()
+    
+    def run_child():
+        def _stop(signum, frame):
+            raise SystemExit(0)
+        signal.signal(signal.SIGTERM, _stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        
+        httpd = ThreadPoolHTTPServer(("", port), handler_class, workers=workers, backlog=backlog,
+                                     bind_and_activate=False)
+        httpd.socket.close()
+        httpd.socket = listen_sock
+        start_background_workers()
+        try:
+            httpd.serve_forever()
+        finally:
+            httpd.server_close()
+            shutdown_background_workers()
+    
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                run_child()
+            except SystemExit as e:
+                exit_code = e.code or 0
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                sys.stdout.flush()
+                os._exit(exit_code)
+        children[pid] = time.monotonic()
+        return pid
+    
+    def _shutdown(signum, frame):
+        raise KeyboardInterrupt
+    
+    children = {}
+    signal.signal(signal.SIGTERM, _shutdown)
+    signal.signal(signal.SIGINT, _shutdown)
+    
+    try:
+        for _ in range(processes):
+            spawn()
+        print(f"🍴 Pre-fork mode: {processes} processes × {workers} threads (pids: {', '.join(map(str, children))})")
+        
+        while True:
+            pid, status = os.wait()
+            started = children.pop(pid, None)
+            if started is None:
+                continue
+            print(f"⚠️ Worker {pid} exited with code {os.waitstatus_to_exitcode(status)}, restarting...")
+            # Не уходим в бесконечный цикл рестартов, если воркер падает сразу
+            if time.monotonic() - started < 1.0:
+                time.sleep(1.0)
+            spawn()
+    except KeyboardInterrupt:
+        print("\n🛑 Stopping worker processes...")
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in list(children):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        print("🛑 Server stopped")
+    finally:
+        listen_sock.close()
+
 def main():
     # Check if we're in production mode
     is_production = os.environ.get('ENVIRONMENT') == 'production'
@@ -1274,6 +5664,13 @@ def main():
     # Change to the directory containing the web files
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
     
+    if '--check-query-plans' in sys.argv[1:]:
+        sys.exit(0 if check_stats_query_plans() else 1)
+    
+    # Старые data/athlete_*.json переносятся в локальное хранилище один раз
+    migrate_legacy_data()
+    athlete_store.import_json_files()
+    
     # Initialize database (non-blocking)
     print("🔧 Initializing database...")
     try:
@@ -1284,35 +5681,88 @@ def main():
     
     Handler = ProductionHTTPRequestHandler
     
+    # Server mode: threaded (default), prefork (processes × threads), asyncio or single (one request at a time)
+    server_mode = os.environ.get('SERVER_MODE', 'threaded').strip().lower()
+    workers = int(os.environ.get('SERVER_WORKERS', '16'))
+    backlog = int(os.environ.get('SERVER_BACKLOG', '128'))
+    processes = int(os.environ.get('WEB_CONCURRENCY', '0')) or default_worker_processes()
+    keepalive_timeout = float(os.environ.get('KEEPALIVE_TIMEOUT', '75'))
+    
+    if server_mode == 'prefork' and not hasattr(os, 'fork'):
+        print("⚠️ Pre-fork mode needs os.fork(), falling back to threaded mode")
+        server_mode = 'threaded'
+    
     # Use reusable address to avoid "Address already in use" errors
     socketserver.TCPServer.allow_reuse_address = True
     
-    with socketserver.TCPServer(("", PORT), Handler) as httpd:
-        env = "RAILWAY" if is_railway else ("PRODUCTION" if is_production else "DEVELOPMENT")
-        print(f"🚀 addicted Web Server ({env}) running on port {PORT}")
-        print(f"📱 Server listening on 0.0.0.0:{PORT}")
-        
-        if is_railway:
-            print("☁️ Running on Railway Cloud")
-            print("✅ Database:", "Connected" if get_db_connection() else "Fallback to JSON")
-        elif not is_production:
-            print(f"🌐 Open your browser: http://localhost:{PORT}")
-            print("⚠️  IMPORTANT: Update CLIENT_ID and CLIENT_SECRET in server_config.py before using OAuth!")
-        
-        print("🔒 Security features: Rate limiting, CSP, CORS")
-        print("🛑 Press Ctrl+C to stop the server")
-        print("")
-        
-        try:
-            if not is_production and not is_railway:
-                webbrowser.open(f'http://localhost:{PORT}')
-        except:
-            pass
-        
-        try:
-            httpd.serve_forever()
-        except KeyboardInterrupt:
-            print("\n🛑 Server stopped")
+    if server_mode == 'single':
+        httpd = socketserver.TCPServer(("", PORT), Handler)
+    elif server_mode in ('prefork', 'asyncio'):
+        httpd = None
+    else:
+        server_mode = 'threaded'
+        httpd = ThreadPoolHTTPServer(("", PORT), Handler, workers=workers, backlog=backlog)
+    
+    env = "RAILWAY" if is_railway else ("PRODUCTION" if is_production else "DEVELOPMENT")
+    print(f"🚀 addicted Web Server ({env}) running on port {PORT}")
+    print(f"📱 Server listening on 0.0.0.0:{PORT}")
+    if server_mode == 'threaded':
+        print(f"🧵 Threaded mode: {workers} workers, backlog {backlog}")
+    elif server_mode == 'asyncio':
+        print(f"⚡ Asyncio mode: keep-alive {keepalive_timeout:.0f}s, {workers} handler threads")
+    
+    if is_railway:
+        print("☁️ Running on Railway Cloud")
+        print("✅ Database:", "Connected" if db_pool.warm() else "Fallback to JSON")
+    elif not is_production:
+        print(f"🌐 Open your browser: http://localhost:{PORT}")
+        print("⚠️  IMPORTANT: Update CLIENT_ID and CLIENT_SECRET in server_config.py before using OAuth!")
+    
+    print("🔒 Security features: Rate limiting, CSP, CORS")
+    print("🛑 Press Ctrl+C to stop the server")
+    print("")
+    
+    try:
+        if not is_production and not is_railway:
+            webbrowser.open(f'http://localhost:{PORT}')
+    except:
+        pass
+    
+    # Rate limit buckets must be shared before workers are forked
+    rate_limiter.store = load_rate_limit_store(os.environ.get('RATE_LIMIT_BACKEND'), prefork=server_mode == 'prefork')
+    print(f"🚦 Rate limit backend: {rate_limiter.store.name}")
+    
+    if server_mode == 'prefork':
+        # Прогреваем кэш до fork, чтобы воркеры унаследовали сжатые варианты
+        print(f"🗜️ Preloaded {static_cache.preload()} static assets ({', '.join(CONTENT_ENCODINGS)})")
+        serve_prefork(PORT, Handler, processes, workers, backlog)
+        return
+    
+    # Build compressed variants in the background so startup isn't delayed
+    threading.Thread(target=static_cache.preload, name='static-preload', daemon=True).start()
+    start_background_workers()
+    
+    if server_mode == 'asyncio':
+        async_server = AsyncHTTPServer(Handler, workers=workers, keepalive_timeout=keepalive_timeout,
+                                       read_timeout=Handler.timeout,
+                                       max_body_size=int(os.environ.get('MAX_REQUEST_BODY_KB', '1024')) * 1024)
+        asyncio.run(async_server.serve("", PORT, backlog))
+        return
+    
+    def _terminate(signum, frame):
+        # serve_forever() крутится в этом же потоке - shutdown() вызываем из другого
+        print("\n🛑 SIGTERM received, shutting down...")
+        threading.Thread(target=httpd.shutdown, name='shutdown', daemon=True).start()
+    signal.signal(signal.SIGTERM, _terminate)
+    
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("\n🛑 Server stopped")
+    finally:
+        # Сначала дожидаемся запросов в работе - их события тоже должны попасть в очередь до сброса
+        httpd.server_close()
+        shutdown_background_workers()
 
 if __name__ == "__main__":
     main()
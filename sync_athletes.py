@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# Bulk sync of the local athlete store (SQLite fallback + legacy data/athlete_*.json) into PostgreSQL.
+#
+# Rows are streamed with COPY into a temporary staging table and merged with a
+# single INSERT ... ON CONFLICT (athlete_id), all in one transaction. A local
+# row only overwrites a PostgreSQL row that was seen less recently, so the
+# sync is safe to re-run (a second run reports everything as unchanged).
+#
+# Usage: DATABASE_URL=... python3 sync_athletes.py [--store data/athletes.sqlite3] [--dry-run]
+
+import argparse
+import csv
+import io
+import os
+import sys
+import time
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import server
+
+COLUMNS = server.LocalAthleteStore.SYNC_COLUMNS
+
+STAGING_SQL = """
+    CREATE TEMP TABLE athletes_staging (
+        athlete_id BIGINT NOT NULL,
+        username VARCHAR(255),
+        firstname VARCHAR(255),
+        lastname VARCHAR(255),
+        email VARCHAR(255),
+        city VARCHAR(255),
+        country VARCHAR(255),
+        profile_picture TEXT,
+        access_token_hash VARCHAR(64),
+        strava_created_at TIMESTAMP,
+        strava_updated_at TIMESTAMP,
+        connected_at TIMESTAMP,
+        last_seen_at TIMESTAMP,
+        is_active BOOLEAN
+    ) ON COMMIT DROP
+"""
+
+# firstname NOT NULL в athletes - подставляем пустую строку, как и username-less профили Strava
+MERGE_SQL = f"""
+    INSERT INTO athletes ({', '.join(COLUMNS)})
+    SELECT DISTINCT ON (athlete_id)
+        athlete_id, username, COALESCE(firstname, ''), lastname, email, city, country,
+        profile_picture, access_token_hash, strava_created_at, strava_updated_at,
+        COALESCE(connected_at, CURRENT_TIMESTAMP), last_seen_at, COALESCE(is_active, TRUE)
+    FROM athletes_staging
+    ORDER BY athlete_id, last_seen_at DESC NULLS LAST
+    ON CONFLICT (athlete_id) DO UPDATE SET
+        username = EXCLUDED.username,
+        firstname = EXCLUDED.firstname,
+        lastname = EXCLUDED.lastname,
+        email = EXCLUDED.email,
+        city = EXCLUDED.city,
+        country = EXCLUDED.country,
+        profile_picture = EXCLUDED.profile_picture,
+        access_token_hash = COALESCE(EXCLUDED.access_token_hash, athletes.access_token_hash),
+        strava_updated_at = EXCLUDED.strava_updated_at,
+        connected_at = LEAST(athletes.connected_at, EXCLUDED.connected_at),
+        last_seen_at = EXCLUDED.last_seen_at
+    WHERE athletes.last_seen_at IS NULL
+       OR EXCLUDED.last_seen_at > athletes.last_seen_at
+    RETURNING (xmax = 0) AS inserted
+"""
+
+class CopySource(io.RawIOBase):
+    """File-like CSV stream over store batches for copy_expert(), reporting progress as it goes"""
+
+    def __init__(self, batches, total, progress_every):
+        self._batches = batches
+        self._buffer = b''
+        self.total = total
+        self.rows = 0
+        self.started = time.monotonic()
+        self._progress_every = progress_every
+        self._next_report = progress_every
+
+    def readable(self):
+        return True
+
+    def _encode(self, rows):
+        out = io.StringIO()
+        writer = csv.writer(out)
+        for row in rows:
+            # Пустая строка в CSV - это NULL для COPY ... (FORMAT csv)
+            writer.writerow(['' if row[name] is None else row[name] for name in COLUMNS])
+        return out.getvalue().encode('utf-8')
+
+    def read(self, size=-1):
+        while not self._buffer or (size >= 0 and len(self._buffer) < size):
+            try:
+                rows = next(self._batches)
+            except StopIteration:
+                break
+            self.rows += len(rows)
+            self._buffer += self._encode(rows)
+            if self.rows >= self._next_report:
+                self._next_report += self._progress_every
+                report('staged', self.rows, self.total, self.started)
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+def report(stage, rows, total, started):
+    elapsed = max(time.monotonic() - started, 1e-6)
+    progress = f"{rows}/{total}" if total else str(rows)
+    print(f"   {stage}: {progress} rows ({rows / elapsed:,.0f} rows/s)", flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Sync athletes saved while PostgreSQL was down into the athletes table')
+    parser.add_argument('--store', default=server.athlete_store.path, help='SQLite store path (default: %(default)s)')
+    parser.add_argument('--data-dir', default='data', help='directory with legacy athlete_*.json files to import first')
+    parser.add_argument('--batch-size', type=int, default=5000, help='rows read from the store per batch')
+    parser.add_argument('--dry-run', action='store_true', help='stage and merge, then roll back (legacy JSON files are left alone)')
+    args = parser.parse_args()
+    
+    if not server.database_configured():
+        print("❌ DATABASE_URL is not set (or psycopg2 is missing)")
+        return 1
+    
+    store = server.LocalAthleteStore(args.store)
+    if args.dry_run:
+        # Dry run ничего не меняет - ни хранилище, ни сами JSON файлы
+        try:
+            pending = sum(1 for f in os.listdir(args.data_dir) if f.startswith('athlete_') and f.endswith('.json'))
+        except OSError:
+            pending = 0
+        if pending:
+            print(f"ℹ️ Dry run - {pending} legacy JSON files in {args.data_dir} are not imported and not included")
+    else:
+        store.import_json_files(args.data_dir)
+    total = store.count()
+    print(f"🔄 Syncing {total} athletes from {args.store} to PostgreSQL")
+    if not total:
+        return 0
+    
+    conn = server.get_db_connection()
+    if conn is None:
+        print("❌ Could not connect to PostgreSQL")
+        return 1
+    
+    try:
+        cursor = conn.cursor()
+        started = time.monotonic()
+        cursor.execute(STAGING_SQL)
+        source = CopySource(store.iter_athletes(args.batch_size), total, max(args.batch_size, 1))
+        cursor.copy_expert(
+            f"COPY athletes_staging ({', '.join(COLUMNS)}) FROM STDIN WITH (FORMAT csv)", source)
+        report('staged', source.rows, total, started)
+        # DISTINCT ON в MERGE_SQL схлопывает повторы athlete_id - считаем их отдельно
+        cursor.execute("SELECT COUNT(DISTINCT athlete_id) FROM athletes_staging")
+        distinct = cursor.fetchone()[0]
+        duplicates = source.rows - distinct
+        
+        merge_started = time.monotonic()
+        cursor.execute(MERGE_SQL)
+        results = cursor.fetchall()
+        inserted = sum(1 for (is_insert,) in results if is_insert)
+        updated = len(results) - inserted
+        unchanged = distinct - len(results)
+        
+        if args.dry_run:
+            conn.rollback()
+            print("ℹ️ Dry run - changes rolled back")
+        else:
+            conn.commit()
+        
+        elapsed = time.monotonic() - started
+        print(f"✅ Merged in {time.monotonic() - merge_started:.2f}s: "
+              f"{inserted} inserted, {updated} updated, {unchanged} unchanged")
+        if duplicates:
+            print(f"ℹ️ {duplicates} duplicate rows collapsed into the most recently seen one per athlete")
+        print(f"⏱️ Total {elapsed:.2f}s, {source.rows / max(elapsed, 1e-6):,.0f} rows/s")
+        return 0
+    except Exception as e:
+        conn.rollback()
+        print(f"❌ Sync failed, nothing was changed: {e}")
+        return 1
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+import http.server
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def run_server(tmp_path):
+    """Start server.py in a subprocess: run_server(SERVER_MODE='asyncio', ...) -> port.
+
+    run_server.stop(port) sends SIGTERM, waits for the graceful shutdown and
+    returns the server's output.
+    """
+    processes = {}
+
+    def start(**env):
+        port = free_port()
+        environment = dict(os.environ, ENVIRONMENT='production', PORT=str(port), APP_DATA_DIR=str(tmp_path),
+                           DATABASE_URL='', PYTHONUNBUFFERED='1')
+        environment.update({name: str(value) for name, value in env.items()})
+        process = subprocess.Popen([sys.executable, 'server.py'], cwd=ROOT, env=environment,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        processes[port] = process
+        deadline = time.monotonic() + 15
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+                return port
+            except OSError:
+                if process.poll() is not None:
+                    raise RuntimeError(process.stdout.read().decode(errors='replace'))
+                time.sleep(0.1)
+        raise RuntimeError('server did not start')
+
+    def stop(port):
+        process = processes.pop(port)
+        process.terminate()
+        try:
+            output, _ = process.communicate(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            output, _ = process.communicate()
+        return output.decode(errors='replace')
+
+    start.stop = stop
+    yield start
+    for port in list(processes):
+        stop(port)
+
+
+class FakeStrava:
+    """Throwaway http.server standing in for Strava (token endpoint and API).
+
+    respond(method, path, *responses) scripts the answers to one endpoint; each
+    response is (status, body[, headers[, delay]]) and the last one repeats.
+    Every request is recorded as (method, path, headers, body).
+    """
+
+    def __init__(self):
+        self.responses = {}
+        self.requests = []
+        self._lock = threading.Lock()
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _answer(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                path = self.path.split('?')[0]
+                with fake._lock:
+                    fake.requests.append((self.command, self.path, dict(self.headers), body))
+                    scripted = fake.responses.get((self.command, path)) or [(404, {'message': 'Record Not Found'})]
+                    response = scripted.pop(0) if len(scripted) > 1 else scripted[0]
+                status, payload, headers, delay = (tuple(response) + ({}, 0))[:4]
+                if delay:
+                    time.sleep(delay)
+                data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_DELETE = _answer
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def respond(self, method, path, *responses):
+        with self._lock:
+            self.responses[(method, path)] = list(responses)
+
+    def calls(self, method, path):
+        with self._lock:
+            return [request for request in self.requests if request[0] == method and request[1].split('?')[0] == path]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def fake_strava():
+    fake = FakeStrava()
+    yield fake
+    fake.close()
@@ -0,0 +1,34 @@
+import threading
+
+from server import RateLimitStore
+
+
+class FakeRateLimitStore(RateLimitStore):
+    """In-process stand-in for an external module:Class store such as Redis.
+
+    Buckets are kept as serialized strings, the way a key-value store would
+    hold them, and refilled by the `now` the limiter passes in, so tests
+    control time. Loaded as RATE_LIMIT_BACKEND=fake_rate_limit_store:FakeRateLimitStore.
+    """
+
+    name = 'fake'
+
+    def __init__(self):
+        self.data = {}  # key -> "tokens:last_refill"
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate, now):
+        with self._lock:
+            self.calls += 1
+            raw = self.data.get(key)
+            tokens, last = (float(part) for part in raw.split(':')) if raw else (capacity, now)
+            tokens = min(capacity, tokens + (now - last) * rate)
+            allowed = tokens >= 1.0
+            if allowed:
+                tokens -= 1.0
+            self.data[key] = f'{tokens!r}:{now!r}'
+        return allowed
+
+    def stats(self):
+        return {'backend': self.name, 'keys': len(self.data), 'calls': self.calls}
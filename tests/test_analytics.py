@@ -0,0 +1,35 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+MOSCOW = timezone(timedelta(hours=3))
+
+
+def test_utc_naive_converts_aware_datetimes():
+    assert server.utc_naive(datetime(2024, 3, 2, 1, 30, tzinfo=MOSCOW)) == datetime(2024, 3, 1, 22, 30)
+    assert server.utc_naive(datetime(2024, 3, 1, 22, 30)) == datetime(2024, 3, 1, 22, 30)
+
+
+def test_sketch_days_match_stored_created_at():
+    created_at = datetime(2024, 3, 2, 1, 30, tzinfo=MOSCOW)
+    sketches = server.AnalyticsSketches(precision=4).sketch_rows('auth_events', [(1, '1.2.3.4', 'ua', created_at)])
+    assert list(sketches) == [('connections', server.utc_naive(created_at).date(), '')]
+
+
+@pytest.mark.skipif(not server.database_configured(), reason='needs psycopg2 and DATABASE_URL')
+def test_sketch_updates_merge_into_stored_sketches():
+    server.init_database()
+    sketches = server.AnalyticsSketches()
+    created_at = datetime(1999, 1, 1, 12, tzinfo=timezone.utc)
+    with server.db_connection() as conn:
+        assert conn is not None, 'database not reachable'
+        cursor = conn.cursor()
+        try:
+            assert sketches.update(conn, 'auth_events', [(1, '', '', created_at), (2, '', '', created_at)]) == 1
+            assert sketches.update(conn, 'auth_events', [(2, '', '', created_at), (3, '', '', created_at)]) == 1
+            assert sketches.estimate(cursor, 'connections', created_at.date(), created_at.date()) == 3
+        finally:
+            cursor.execute("DELETE FROM analytics_hll WHERE metric = 'connections' AND day = %s", (created_at.date(),))
+            conn.commit()
@@ -0,0 +1,118 @@
+import asyncio
+import socket
+import threading
+
+import pytest
+
+import server
+
+
+def read_response(sock_file):
+    """(status, headers, body) of one HTTP/1.1 response, honouring Content-Length and chunked framing"""
+    status = int(sock_file.readline().split()[1])
+    headers = {}
+    while True:
+        line = sock_file.readline().strip()
+        if not line:
+            break
+        name, _, value = line.decode().partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if headers.get('transfer-encoding') == 'chunked':
+        body = b''
+        while True:
+            size = int(sock_file.readline().strip(), 16)
+            chunk = sock_file.read(size + 2)[:size]
+            if not size:
+                break
+            body += chunk
+    else:
+        body = sock_file.read(int(headers.get('content-length', 0)))
+    return status, headers, body
+
+
+def test_pipelined_requests_share_one_connection(run_server):
+    port = run_server(SERVER_MODE='asyncio')
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+        sock.sendall(b'GET /health HTTP/1.1\r\nHost: x\r\n\r\n' * 2)
+        sock_file = sock.makefile('rb')
+        for _ in range(2):
+            status, headers, body = read_response(sock_file)
+            assert status == 200
+            assert headers['connection'] == 'keep-alive'
+            assert headers['content-length'] == str(len(body))
+            assert body == b'{"status":"ok"}'
+
+
+def test_oversized_request_body_is_refused(run_server):
+    port = run_server(SERVER_MODE='asyncio', MAX_REQUEST_BODY_KB=1)
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+        sock.sendall(b'POST /api/analytics/batch HTTP/1.1\r\nHost: x\r\nContent-Length: 4096\r\n\r\n')
+        status, headers, _ = read_response(sock.makefile('rb'))
+    assert status == 413
+    assert headers['connection'] == 'close'
+
+
+class RecordingStreamWriter:
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield loop
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def written_response(loop, body, chunked_ok=True):
+    stream = RecordingStreamWriter()
+    wfile = server.AsyncResponseWriter(loop, stream, keep_alive=True, chunked_ok=chunked_ok, buffer_size=16)
+    wfile.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\n\r\n')
+    for start in range(0, len(body), 7):
+        wfile.write(body[start:start + 7])
+        wfile.flush()
+    wfile.finish()
+    return wfile, bytes(stream.data)
+
+
+def test_unframed_small_body_gets_content_length(loop):
+    wfile, data = written_response(loop, b'short')
+    assert wfile.keep_alive
+    assert data == (b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: 5\r\n'
+                    b'Connection: keep-alive\r\n\r\nshort')
+
+
+def test_unframed_large_body_is_chunked(loop):
+    body = b'x' * 50
+    wfile, data = written_response(loop, body)
+    assert wfile.keep_alive
+    head, _, rest = data.partition(b'\r\n\r\n')
+    assert b'Transfer-Encoding: chunked' in head
+    assert rest.endswith(b'0\r\n\r\n')
+    decoded, position = b'', 0
+    while True:
+        line_end = rest.index(b'\r\n', position)
+        size = int(rest[position:line_end], 16)
+        if not size:
+            break
+        decoded += rest[line_end + 2:line_end + 2 + size]
+        position = line_end + 4 + size
+    assert decoded == body
+
+
+def test_unframed_large_body_closes_for_http10(loop):
+    wfile, data = written_response(loop, b'y' * 50, chunked_ok=False)
+    assert not wfile.keep_alive
+    head, _, rest = data.partition(b'\r\n\r\n')
+    assert b'Connection: close' in head
+    assert rest == b'y' * 50
@@ -0,0 +1,36 @@
+import server
+
+
+def make_store(tmp_path):
+    store = server.LocalAthleteStore(str(tmp_path / 'athletes.sqlite3'))
+    for athlete_id, country in [(1, 'Latvia'), (2, '100%s'), (3, 'Latvia'), (4, 'Latvia')]:
+        store.upsert({'athlete_id': athlete_id, 'firstname': f'A{athlete_id}', 'country': country,
+                      'connected_at': f'2024-01-0{athlete_id}T10:00:00'})
+    return store
+
+
+def test_admin_where_uses_the_backend_placeholder():
+    params = {'country': 'Latvia', 'city': None, 'cursor': ('2024-01-01T00:00:00', 5)}
+    assert server.admin_users_where(params)[0].count('%s') == 3
+    where, args = server.admin_users_where(params, placeholder='?')
+    assert where.count('?') == 3 and '%s' not in where
+    assert args == ['Latvia', '2024-01-01T00:00:00', 5]
+
+
+def test_local_store_pages_through_filtered_athletes(tmp_path):
+    store = make_store(tmp_path)
+    params = server.parse_admin_users_params('country=Latvia&limit=2')
+    first = store.page(params)
+    assert [user['athlete_id'] for user in first['users']] == [4, 3]
+    assert first['total'] == 3
+    params = server.parse_admin_users_params(f"country=Latvia&limit=2&cursor={first['next_cursor']}")
+    second = store.page(params)
+    assert [user['athlete_id'] for user in second['users']] == [1]
+    assert second['next_cursor'] is None
+
+
+def test_local_store_filter_values_are_bound_not_rewritten(tmp_path):
+    store = make_store(tmp_path)
+    params = server.parse_admin_users_params('country=100%25s')
+    assert [user['athlete_id'] for user in store.page(params)['users']] == [2]
+    assert [[user['athlete_id'] for user in rows] for rows in store.iter_rows(params)] == [[2]]
@@ -0,0 +1,167 @@
+import http.client
+import json
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import server
+from conftest import free_port
+
+
+def make_client(**options):
+    settings = dict(connect_timeout=1.0, read_timeout=2.0, deadline=5.0, max_retries=2, backoff=0.01)
+    settings.update(options)
+    return server.OutboundHTTPClient(**settings)
+
+
+def test_get_is_retried_on_5xx(fake_strava):
+    fake_strava.respond('GET', '/athlete', (503, {}), (502, {}), (200, {'id': 1}))
+    client = make_client()
+    response = client.request('GET', fake_strava.url + '/athlete')
+    assert response.status == 200
+    assert json.loads(response.body) == {'id': 1}
+    assert len(fake_strava.calls('GET', '/athlete')) == 3
+    assert client.stats()['retries'] == 2
+
+
+def test_throttled_get_is_not_retried(fake_strava):
+    fake_strava.respond('GET', '/athlete', (429, {}, {'X-RateLimit-Limit': '100,1000', 'X-RateLimit-Usage': '100,200'}),
+                        (200, {}))
+    client = make_client()
+    response = client.request('GET', fake_strava.url + '/athlete')
+    assert response.status == 429
+    assert len(fake_strava.calls('GET', '/athlete')) == 1
+
+    quota = server.StravaQuota()
+    quota.update(response.headers, throttled=True)
+    assert 0 < quota.retry_after() <= server.StravaQuota.SHORT_WINDOW + 1
+
+
+def test_quota_backs_off_after_429_without_limit_headers():
+    quota = server.StravaQuota()
+    assert quota.retry_after() == 0
+    quota.update({}, throttled=True)
+    assert 0 < quota.retry_after() <= server.StravaQuota.SHORT_WINDOW + 1
+
+
+def test_retries_stop_after_max_retries(fake_strava):
+    fake_strava.respond('GET', '/athlete', (500, {}))
+    response = make_client(max_retries=1).request('GET', fake_strava.url + '/athlete')
+    assert response.status == 500
+    assert len(fake_strava.calls('GET', '/athlete')) == 2
+
+
+def test_post_is_not_retried_once_sent(fake_strava):
+    fake_strava.respond('POST', '/oauth/token', (503, {}), (200, {}))
+    response = make_client().request('POST', fake_strava.url + '/oauth/token', body=b'code=abc')
+    assert response.status == 503
+    assert len(fake_strava.calls('POST', '/oauth/token')) == 1
+
+
+def test_retry_after_beyond_deadline_is_not_waited_for(fake_strava):
+    fake_strava.respond('GET', '/athlete', (503, {}, {'Retry-After': '30'}), (200, {}))
+    started = time.monotonic()
+    response = make_client(deadline=2.0).request('GET', fake_strava.url + '/athlete')
+    assert response.status == 503
+    assert time.monotonic() - started < 1.0
+    assert len(fake_strava.calls('GET', '/athlete')) == 1
+
+
+def test_read_timeout_is_retried_then_raises(fake_strava):
+    fake_strava.respond('GET', '/athlete', (200, {}, {}, 1.0))
+    with pytest.raises(server.OutboundHTTPError):
+        make_client(read_timeout=0.2, max_retries=1).request('GET', fake_strava.url + '/athlete')
+    assert len(fake_strava.calls('GET', '/athlete')) == 2
+
+
+def test_connect_failure_raises_outbound_error():
+    client = make_client(max_retries=1)
+    with pytest.raises(server.OutboundHTTPError):
+        client.request('POST', f'http://127.0.0.1:{free_port()}/oauth/token', body=b'code=abc')
+    assert client.stats()['errors'] == 2  # connect failures are retried even for POST
+
+
+def test_connections_are_reused(fake_strava):
+    fake_strava.respond('GET', '/athlete', (200, {}))
+    client = make_client()
+    for _ in range(3):
+        client.request('GET', fake_strava.url + '/athlete')
+    assert client.stats()['connections_reused'] == 2
+
+
+def test_excess_concurrency_fails_fast(fake_strava):
+    fake_strava.respond('GET', '/slow', (200, {}, {}, 1.0))
+    client = make_client(max_concurrency=1, queue_timeout=0.1)
+    slow = threading.Thread(target=client.request, args=('GET', fake_strava.url + '/slow'))
+    slow.start()
+    time.sleep(0.2)
+    with pytest.raises(server.OutboundHTTPError):
+        client.request('GET', fake_strava.url + '/slow')
+    slow.join()
+    assert client.stats()['rejected_busy'] == 1
+
+
+def test_circuit_breaker_opens_and_recovers():
+    breaker = server.CircuitBreaker(threshold=2, cooldown=0.2)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.is_open
+    assert not breaker.allow()
+    time.sleep(0.25)
+    assert breaker.allow()  # half-open trial
+    assert not breaker.allow()
+    breaker.record_failure()  # trial failed: open again
+    assert not breaker.allow()
+    time.sleep(0.25)
+    assert breaker.allow()
+    breaker.record_success()
+    assert not breaker.is_open
+    assert breaker.stats()['short_circuited'] == 3
+
+
+def post_code(port, code):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    conn.request('POST', '/api/strava/token', body=json.dumps({'code': code}),
+                 headers={'Content-Type': 'application/json'})
+    response = conn.getresponse()
+    return response.status, json.loads(response.read() or b'{}')
+
+
+TOKEN_RESPONSE = {
+    'access_token': 'access-1', 'refresh_token': 'refresh-1', 'expires_at': int(time.time()) + 6 * 3600,
+    'athlete': {'id': 134815, 'username': 'runner', 'firstname': 'Ann', 'lastname': 'Lee', 'city': 'Riga',
+                'country': 'Latvia', 'profile': 'https://example.com/a.jpg'},
+}
+
+
+def test_token_exchange_saves_athlete(run_server, fake_strava, tmp_path):
+    fake_strava.respond('POST', '/oauth/token', (200, TOKEN_RESPONSE))
+    port = run_server(STRAVA_TOKEN_URL=fake_strava.url + '/oauth/token', STRAVA_API_URL=fake_strava.url,
+                      STRAVA_CLIENT_ID='42', STRAVA_CLIENT_SECRET='secret')
+    status, body = post_code(port, 'code-1')
+    assert status == 200
+    assert body['access_token'] == 'access-1'
+    assert body['athlete']['id'] == 134815
+    (_, _, _, sent), = fake_strava.calls('POST', '/oauth/token')
+    assert b'code=code-1' in sent and b'client_id=42' in sent
+
+    # Запись в хранилище - фоновая; SIGTERM дожидается её
+    run_server.stop(port)
+    with sqlite3.connect(tmp_path / 'athletes.sqlite3') as store:
+        rows = store.execute("SELECT athlete_id, firstname, access_token_hash FROM athletes").fetchall()
+    assert [row[:2] for row in rows] == [(134815, 'Ann')]
+    assert rows[0][2]
+
+
+@pytest.mark.parametrize('status', [429, 500, 503])
+def test_token_exchange_is_not_retried(run_server, fake_strava, status):
+    fake_strava.respond('POST', '/oauth/token', (status, {'message': 'error'}), (200, TOKEN_RESPONSE))
+    port = run_server(STRAVA_TOKEN_URL=fake_strava.url + '/oauth/token', STRAVA_API_URL=fake_strava.url,
+                      STRAVA_CLIENT_ID='42', STRAVA_CLIENT_SECRET='secret')
+    response_status, body = post_code(port, 'code-1')
+    assert response_status == 502
+    assert 'error' in body
+    assert len(fake_strava.calls('POST', '/oauth/token')) == 1
@@ -0,0 +1,31 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.skipif(not server.database_configured(), reason='needs psycopg2 and DATABASE_URL')
+
+INDEX_SCANS = {'Index Scan', 'Index Only Scan', 'Bitmap Heap Scan', 'Bitmap Index Scan'}
+
+
+@pytest.fixture(scope='module')
+def plans():
+    server.init_database()
+    with server.db_connection() as conn:
+        assert conn is not None, 'database not reachable'
+        try:
+            yield server.explain_stats_range_queries(conn.cursor())
+        finally:
+            conn.rollback()
+
+
+def test_every_range_query_is_explained(plans):
+    assert set(plans) == {'series', 'pages', 'sketches', 'series (club)', 'pages (club)', 'sketches (club)'}
+
+
+@pytest.mark.parametrize('label', ['series', 'pages', 'sketches', 'series (club)', 'pages (club)', 'sketches (club)'])
+def test_range_query_reads_rollups_through_indexes(plans, label):
+    scans = plans[label]
+    assert scans, f'{label}: no table scans in plan'
+    for node_type, relation, index in scans:
+        assert relation in server.ROLLUP_TABLES, f'{label}: reads raw table {relation}'
+        assert node_type in INDEX_SCANS, f'{label}: {node_type} on {relation}'
@@ -0,0 +1,132 @@
+import os
+import threading
+
+import pytest
+
+import server
+from fake_rate_limit_store import FakeRateLimitStore
+
+
+def make_store(name):
+    if name == 'shared':
+        return server.SharedMemoryBucketStore(slots=64, ways=4, lock_stripes=4)
+    return server.load_rate_limit_store(name)
+
+
+STORES = ['local', 'shared', 'fake_rate_limit_store:FakeRateLimitStore']
+
+
+@pytest.mark.parametrize('spec, prefork, expected', [
+    ('auto', False, server.LocalBucketStore),
+    (None, False, server.LocalBucketStore),
+    ('auto', True, server.SharedMemoryBucketStore),
+    ('local', True, server.LocalBucketStore),
+    ('shared', False, server.SharedMemoryBucketStore),
+    ('fake_rate_limit_store:FakeRateLimitStore', False, FakeRateLimitStore),
+])
+def test_load_rate_limit_store(spec, prefork, expected):
+    assert isinstance(server.load_rate_limit_store(spec, prefork=prefork), expected)
+
+
+@pytest.mark.parametrize('spec', ['no_such_module:Store', 'fake_rate_limit_store:NoSuchClass'])
+def test_load_rate_limit_store_rejects_unknown_backends(spec):
+    with pytest.raises((ImportError, AttributeError)):
+        server.load_rate_limit_store(spec)
+
+
+def test_rate_limit_store_is_abstract():
+    with pytest.raises(TypeError):
+        server.RateLimitStore()
+
+
+@pytest.mark.parametrize('name', STORES)
+def test_full_bucket_allows_capacity_then_refuses(name):
+    store = make_store(name)
+    assert [store.take('static:1.2.3.4', 3, 1.0, 100.0) for _ in range(4)] == [True, True, True, False]
+
+
+@pytest.mark.parametrize('name', STORES)
+def test_bucket_refills_at_rate(name):
+    store = make_store(name)
+    for _ in range(2):
+        store.take('api:ip', 2, 0.5, 10.0)
+    assert not store.take('api:ip', 2, 0.5, 11.0)  # +0.5 token
+    assert store.take('api:ip', 2, 0.5, 12.0)  # +1 token
+    assert not store.take('api:ip', 2, 0.5, 12.0)
+
+
+@pytest.mark.parametrize('name', STORES)
+def test_refill_is_capped_at_capacity(name):
+    store = make_store(name)
+    store.take('api:ip', 2, 1.0, 0.0)
+    results = [store.take('api:ip', 2, 1.0, 1000.0) for _ in range(3)]
+    assert results == [True, True, False]
+
+
+@pytest.mark.parametrize('name', STORES)
+def test_keys_are_independent(name):
+    store = make_store(name)
+    assert store.take('token:a', 1, 0.01, 5.0)
+    assert not store.take('token:a', 1, 0.01, 5.0)
+    assert store.take('token:b', 1, 0.01, 5.0)
+
+
+def test_limiter_counts_through_pluggable_store(monkeypatch):
+    monkeypatch.setenv('RATE_LIMIT_BACKEND', 'fake_rate_limit_store:FakeRateLimitStore')
+    store = server.load_rate_limit_store(os.environ['RATE_LIMIT_BACKEND'])
+    limiter = server.TokenBucketRateLimiter({'token': (1, 1.0 / 60), 'default': (5, 1.0)}, store=store)
+    assert [limiter.allow('token', '1.2.3.4') for _ in range(2)] == [True, False]
+    assert limiter.allow('default', '1.2.3.4')
+    stats = limiter.stats()
+    assert stats['token_allowed'] == 1
+    assert stats['token_limited'] == 1
+    assert stats['backend'] == 'fake'
+    assert store.calls == 3
+
+
+def test_limiter_allows_requests_when_store_fails():
+    class BrokenStore(server.RateLimitStore):
+        def take(self, key, capacity, rate, now):
+            raise ConnectionError('store unavailable')
+
+    limiter = server.TokenBucketRateLimiter({'default': (1, 1.0)}, store=BrokenStore())
+    assert limiter.allow('default', 'ip')
+    assert limiter.allow('default', 'ip')
+
+
+def test_parse_rate_limit():
+    assert server.parse_rate_limit('120', 10) == (120.0, 2.0)
+    assert server.parse_rate_limit('', 60) == (60.0, 1.0)
+    assert server.parse_rate_limit('junk', 60) == (60.0, 1.0)
+    assert server.parse_rate_limit('0', 60) == (1.0, 1.0 / 60)
+
+
+def run_in_child(function):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            function()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+
+def test_shared_store_is_shared_with_forked_workers():
+    store = server.SharedMemoryBucketStore(slots=64, ways=4, lock_stripes=4)
+    run_in_child(lambda: [store.take('api:ip', 2, 0.01, 1.0) for _ in range(2)])
+    assert not store.take('api:ip', 2, 0.01, 1.0)
+
+
+def test_shared_store_survives_a_worker_dying_with_a_lock_held():
+    store = server.SharedMemoryBucketStore(slots=64, ways=4, lock_stripes=4)
+
+    def die_holding_every_stripe():
+        for index in range(4):
+            store._stripe(index).__enter__()
+
+    run_in_child(die_holding_every_stripe)
+    result = []
+    worker = threading.Thread(target=lambda: result.append(store.take('api:ip', 1, 1.0, 1.0)), daemon=True)
+    worker.start()
+    worker.join(5)
+    assert result == [True]
@@ -0,0 +1,130 @@
+import time
+
+import pytest
+
+import replay_webhooks
+import server
+
+ATHLETE_ID = 134815
+ACTIVITY_ID = 1360128428
+SUBSCRIPTION_ID = replay_webhooks.SAMPLE_EVENTS[0]['subscription_id']
+
+
+class RecordingSync(server.ActivitySync):
+    """ActivitySync against a fake Strava with the database writes recorded instead of executed"""
+
+    def __init__(self, base_url):
+        super().__init__(server.OutboundHTTPClient(max_retries=0, deadline=5.0), server.StravaQuota(), base_url)
+        self.writes = []
+
+    def delete_activity(self, athlete_id, activity_id):
+        self.writes.append(('delete_activity', athlete_id, activity_id))
+
+    def delete_athlete(self, athlete_id):
+        self.forget(athlete_id)
+        self.writes.append(('delete_athlete', athlete_id))
+
+    def mark_dirty(self, athlete_id):
+        self.writes.append(('mark_dirty', athlete_id))
+
+    def apply_updates(self, athlete_id, activity_id, updates):
+        self.writes.append(('apply_updates', athlete_id, activity_id, updates))
+
+    def _store_detail(self, athlete_id, body):
+        self.writes.append(('store_detail', athlete_id))
+
+
+def replay(sync, events=replay_webhooks.SAMPLE_EVENTS):
+    worker = server.StravaWebhookWorker(sync)
+    for event in events:
+        assert worker.enqueue(server.parse_webhook_event(event))
+    worker.stop()  # дообрабатывает очередь
+    return worker.stats()
+
+
+def deleted(sync):
+    return [write for write in sync.writes if write[0].startswith('delete')]
+
+
+def test_without_a_token_nothing_is_deleted(fake_strava):
+    sync = RecordingSync(fake_strava.url)
+    stats = replay(sync)
+    assert deleted(sync) == []
+    assert ('mark_dirty', ATHLETE_ID) in sync.writes
+    assert ('apply_updates', ATHLETE_ID, ACTIVITY_ID, {'title': 'Messy'}) in sync.writes
+    assert stats['deauth_unconfirmed'] == 1
+    assert stats['processed'] == len(replay_webhooks.SAMPLE_EVENTS)
+    assert fake_strava.requests == []
+
+
+def test_verified_delete_and_deauthorization_are_applied(fake_strava):
+    fake_strava.respond('GET', f'/activities/{ACTIVITY_ID}', (404, {'message': 'Record Not Found'}))
+    fake_strava.respond('GET', '/athlete', (401, {'message': 'Authorization Error'}))
+    sync = RecordingSync(fake_strava.url)
+    sync.remember('access-1', ATHLETE_ID)
+    replay(sync)
+    assert deleted(sync) == [('delete_activity', ATHLETE_ID, ACTIVITY_ID)] * 4 + [('delete_athlete', ATHLETE_ID)]
+    assert all(headers['Authorization'] == 'Bearer access-1' for _, _, headers, _ in fake_strava.requests)
+    assert sync.token_for(ATHLETE_ID) is None
+
+
+def test_forged_events_are_not_applied(fake_strava):
+    fake_strava.respond('GET', f'/activities/{ACTIVITY_ID}', (200, {'id': ACTIVITY_ID, 'athlete': {'id': ATHLETE_ID}}))
+    fake_strava.respond('GET', '/athlete', (200, {'id': ATHLETE_ID}))
+    sync = RecordingSync(fake_strava.url)
+    sync.remember('access-1', ATHLETE_ID)
+    stats = replay(sync)
+    assert deleted(sync) == []
+    assert stats['forged'] == 1
+    assert sync.token_for(ATHLETE_ID) == 'access-1'
+
+
+def test_unreachable_strava_marks_for_resync(fake_strava):
+    fake_strava.respond('GET', f'/activities/{ACTIVITY_ID}', (503, {}))
+    fake_strava.respond('GET', '/athlete', (503, {}))
+    sync = RecordingSync(fake_strava.url)
+    sync.remember('access-1', ATHLETE_ID)
+    stats = replay(sync)
+    assert deleted(sync) == []
+    assert ('mark_dirty', ATHLETE_ID) in sync.writes
+    assert stats['deauth_unconfirmed'] == 1
+    assert sync.token_for(ATHLETE_ID) is None  # токены будут перепроверены через /athlete
+
+
+@pytest.mark.parametrize('event, error', [
+    ({'object_type': 'club'}, 'object_type'),
+    ({'aspect_type': 'archive'}, 'aspect_type'),
+    ({'owner_id': '134815'}, 'owner_id'),
+])
+def test_parse_webhook_event_rejects_malformed_events(event, error):
+    with pytest.raises(ValueError, match=error):
+        server.parse_webhook_event(dict(replay_webhooks.SAMPLE_EVENTS[0], **event))
+
+
+def webhook_url(port):
+    return f'http://127.0.0.1:{port}/api/strava/webhook'
+
+
+def test_server_acknowledges_sample_events_in_time(run_server, fake_strava):
+    port = run_server(STRAVA_WEBHOOK_VERIFY_TOKEN='verify', STRAVA_WEBHOOK_SUBSCRIPTION_ID=SUBSCRIPTION_ID,
+                      STRAVA_API_URL=fake_strava.url)
+    assert replay_webhooks.validate_subscription(webhook_url(port), 'verify')
+    assert not replay_webhooks.validate_subscription(webhook_url(port), 'wrong')
+    for event in replay_webhooks.SAMPLE_EVENTS:
+        status, elapsed = replay_webhooks.post_event(webhook_url(port), event)
+        assert status == 200
+        assert elapsed < replay_webhooks.ACK_DEADLINE
+
+
+def test_server_refuses_other_subscriptions(run_server):
+    port = run_server(STRAVA_WEBHOOK_VERIFY_TOKEN='verify', STRAVA_WEBHOOK_SUBSCRIPTION_ID=SUBSCRIPTION_ID + 1)
+    event = replay_webhooks.SAMPLE_EVENTS[-1]
+    assert replay_webhooks.post_event(webhook_url(port), event)[0] == 403
+    assert replay_webhooks.post_event(webhook_url(port), {k: v for k, v in event.items() if k != 'subscription_id'})[0] == 403
+
+
+def test_server_refuses_events_without_a_configured_subscription(run_server):
+    port = run_server(STRAVA_WEBHOOK_VERIFY_TOKEN='verify', STRAVA_WEBHOOK_SUBSCRIPTION_ID='')
+    started = time.monotonic()
+    assert replay_webhooks.post_event(webhook_url(port), replay_webhooks.SAMPLE_EVENTS[0])[0] == 404
+    assert time.monotonic() - started < replay_webhooks.ACK_DEADLINE